@@ -7,11 +7,10 @@ This module defines FEFF XAS(XANES/EXAFS) workflows.
 
 import numpy as np
 
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
-
 from fireworks import Workflow
 
 from atomate.utils.utils import get_logger
+from atomate.utils.symmetry import get_symmetry
 from atomate.feff.fireworks.core import XASFW, EXAFSPathsFW, EELSFW
 from atomate.feff.firetasks.write_inputs import get_feff_input_set_obj
 
@@ -209,9 +208,7 @@ def get_absorbing_atom_indices(structure, absorbing_atom):
 
 
 def get_unique_site_indices(structure):
-    sa = SpacegroupAnalyzer(structure)
-    symm_data = sa.get_symmetry_dataset()
     # equivalency mapping for the structure
     # i'th site in the struct equivalent to eq_struct[i]'th site
-    eq_atoms = symm_data["equivalent_atoms"]
+    eq_atoms = get_symmetry(structure)["equivalent_atoms"]
     return np.unique(eq_atoms).tolist()
@@ -33,6 +33,5 @@ class LammpsCalcDb(CalcDb):
 
     def reset(self):
         self.collection.delete_many({})
-        self.db.counter.delete_one({"_id": "taskid"})
-        self.db.counter.insert_one({"_id": "taskid", "c": 0})
+        self.reset_counter()
         self.build_indexes()
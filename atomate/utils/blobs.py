@@ -0,0 +1,174 @@
+# coding: utf-8
+
+
+"""
+This module defines a compact binary container for numpy arrays, used to store
+large numerical data (charge densities, DOS, band structures, ...) in GridFS
+without going through JSON.
+
+Layout of a blob:
+
+    magic (8 bytes) | header length (8 bytes, little endian) | header (JSON) |
+    padding | array data
+
+The header holds the user metadata and, for each array, its dtype, shape and
+offset from the start of the array data. The arrays are stored raw and C
+ordered, so any single array can be read by seeking to it, without reading
+or decoding the rest of the blob, and a blob saved to a local file can be
+memory-mapped.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+from monty.json import jsanitize
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+BLOB_ENCODING = "atomate-array-blob"
+BLOB_MAGIC = b"ATMBLOB1"
+_ALIGNMENT = 64
+_CHUNK_SIZE = 1 << 22  # bytes per write
+
+
+def _aligned(n):
+    return (n + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def write_array_blob(f, arrays, meta=None):
+    """
+    Write arrays to a binary stream (e.g. a GridFS GridIn or an open file).
+    The arrays are written in chunks, so no serialized copy of the whole data
+    is ever held in memory.
+
+    Args:
+        f: writable binary stream
+        arrays (dict): name -> numpy array
+        meta (dict): JSON serializable metadata stored in the header
+
+    Returns:
+        (int): number of bytes written
+    """
+    arrays = {k: np.ascontiguousarray(v) for k, v in arrays.items()}
+    header = {"meta": jsanitize(meta or {}), "arrays": {}}
+    offset = 0
+    for name, arr in arrays.items():
+        header["arrays"][name] = {"dtype": arr.dtype.str, "shape": list(arr.shape),
+                                  "offset": offset, "nbytes": arr.nbytes}
+        offset = _aligned(offset + arr.nbytes)
+    header_bytes = json.dumps(header).encode()
+    preamble = BLOB_MAGIC + struct.pack("<Q", len(header_bytes)) + header_bytes
+    f.write(preamble + b"\0" * (_aligned(len(preamble)) - len(preamble)))
+    written = _aligned(len(preamble))
+
+    for name, arr in arrays.items():
+        flat = arr.reshape(-1)
+        step = max(1, _CHUNK_SIZE // max(1, arr.itemsize))
+        for i in range(0, flat.size, step):
+            f.write(flat[i:i + step].tobytes())
+        padding = _aligned(arr.nbytes) - arr.nbytes
+        if padding:
+            f.write(b"\0" * padding)
+        written += _aligned(arr.nbytes)
+    return written
+
+
+def read_blob_header(f):
+    """
+    Read the header of a blob from a binary stream positioned at its start.
+
+    Args:
+        f: readable binary stream
+
+    Returns:
+        (dict): header with the keys "meta", "arrays" and "data_offset" (position
+            of the array data from the start of the blob)
+    """
+    start = f.read(len(BLOB_MAGIC) + 8)
+    if start[:len(BLOB_MAGIC)] != BLOB_MAGIC:
+        raise ValueError("Not an array blob")
+    length = struct.unpack("<Q", start[len(BLOB_MAGIC):])[0]
+    header = json.loads(f.read(length).decode())
+    header["data_offset"] = _aligned(len(start) + length)
+    return header
+
+
+def read_blob_array(f, name, header=None, start=0, rows=None):
+    """
+    Read a single array of a blob. Only the bytes of that array are read if
+    the stream is seekable.
+
+    Args:
+        f: readable, seekable binary stream
+        name (str): name of the array
+        header (dict): header of the blob, if already read
+        start (int): position of the blob in the stream
+        rows ([int]): if set, only these rows (indices along the first axis)
+            of the array are read, e.g. the sites of one element
+
+    Returns:
+        (numpy.ndarray)
+    """
+    if header is None:
+        f.seek(start)
+        header = read_blob_header(f)
+    info = header["arrays"][name]
+    dtype = np.dtype(info["dtype"])
+    position = start + header["data_offset"] + info["offset"]
+    if rows is None:
+        f.seek(position)
+        data = bytearray(f.read(info["nbytes"]))
+        return np.frombuffer(data, dtype=dtype).reshape(info["shape"])
+
+    rows = [int(i) % info["shape"][0] for i in rows]
+    row_nbytes = info["nbytes"] // info["shape"][0]
+    data = bytearray()
+    i = 0
+    while i < len(rows):
+        # read runs of consecutive rows at once
+        j = i + 1
+        while j < len(rows) and rows[j] == rows[j - 1] + 1:
+            j += 1
+        f.seek(position + rows[i] * row_nbytes)
+        data += f.read((j - i) * row_nbytes)
+        i = j
+    return np.frombuffer(data, dtype=dtype).reshape([len(rows)] + info["shape"][1:])
+
+
+def read_array_blob(f, names=None):
+    """
+    Read the metadata and (some of) the arrays of a blob.
+
+    Args:
+        f: readable, seekable binary stream positioned at the start of the blob
+        names ([str]): names of the arrays to read. Default: all of them.
+
+    Returns:
+        (dict, dict): metadata, name -> numpy array
+    """
+    start = f.tell()
+    header = read_blob_header(f)
+    names = list(header["arrays"]) if names is None else names
+    return header["meta"], {n: read_blob_array(f, n, header, start) for n in names}
+
+
+def memmap_blob_array(filename, name):
+    """
+    Memory-map a single array of a blob saved to a local file.
+
+    Args:
+        filename (str): path to the blob file
+        name (str): name of the array
+
+    Returns:
+        (numpy.memmap): read-only array
+    """
+    with open(filename, "rb") as f:
+        header = read_blob_header(f)
+    info = header["arrays"][name]
+    return np.memmap(filename, dtype=np.dtype(info["dtype"]), mode="r",
+                     offset=header["data_offset"] + info["offset"],
+                     shape=tuple(info["shape"]))
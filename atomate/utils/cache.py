@@ -0,0 +1,164 @@
+# coding: utf-8
+
+
+"""
+This module defines a two-tier cache of decoded objects (DOS, band structures,
+charge densities, ...) read from GridFS: an in-memory LRU cache backed by an
+optional on-disk cache directory. Entries are keyed by the GridFS file id,
+and GridFS files are never modified in place, so an entry is never stale.
+"""
+
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+from atomate.utils.utils import get_logger
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+logger = get_logger(__name__)
+
+
+class ObjectCache(object):
+    """
+    Cache of decoded objects. The most recently used objects are kept in
+    memory; if cache_dir is set, every object is also pickled to disk, so that
+    it is shared between processes and sessions, and the least recently used
+    files are removed when the directory grows beyond max_disk_mb.
+
+    The cached objects are shared: copy an object before modifying it.
+    """
+
+    def __init__(self, maxsize=32, cache_dir=None, max_disk_mb=None):
+        """
+        Args:
+            maxsize (int): maximum number of objects kept in memory
+            cache_dir (str): directory of the on-disk cache. Default: no disk cache.
+            max_disk_mb (float): maximum size of the on-disk cache in MB.
+                Default: unbounded.
+        """
+        self.maxsize = maxsize
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
+        self.max_disk_mb = max_disk_mb
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, read):
+        """
+        Get an object from the cache, reading it and adding it to the cache
+        if it is neither in memory nor on disk.
+
+        Args:
+            key (str): key of the object, e.g. "dos_fs_<file id>"
+            read (callable): function returning the object
+
+        Returns:
+            the object
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        found, obj = self._load(key)
+        if not found:
+            obj = read()
+            self._dump(key, obj)
+
+        # the statistics are updated with the entries, so that they agree
+        with self._lock:
+            if found:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+            self._entries[key] = obj
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return obj
+
+    def get_stats(self):
+        """
+        Cache statistics.
+
+        Returns:
+            (dict): numbers of memory hits, disk hits, misses and objects
+                evicted from memory, hit rate, and number of objects in memory
+        """
+        with self._lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hit_rate": (self.hits + self.disk_hits) / total if total else None,
+                    "memory_entries": len(self._entries)}
+
+    def clear(self, disk=False):
+        """
+        Empty the in-memory cache and reset the statistics.
+
+        Args:
+            disk (bool): whether to also remove the files of the disk cache
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits, self.disk_hits, self.misses, self.evictions = 0, 0, 0, 0
+        if disk and self.cache_dir and os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".pkl"):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".pkl")
+
+    def _load(self, key):
+        if not self.cache_dir or not os.path.exists(self._path(key)):
+            return False, None
+        try:
+            with open(self._path(key), "rb") as f:
+                obj = pickle.load(f)
+            # the modification time orders the files for eviction
+            os.utime(self._path(key))
+            return True, obj
+        except (IOError, pickle.UnpicklingError, EOFError):
+            logger.warning("Ignoring unreadable cache entry {}".format(key))
+            return False, None
+
+    def _dump(self, key, obj):
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = "{}.{}.tmp".format(self._path(key), os.getpid())
+        with open(tmp, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self._path(key))
+        if self.max_disk_mb is not None:
+            self._evict()
+
+    def _evict(self):
+        """
+        Remove the least recently used files until the disk cache fits in max_disk_mb.
+        """
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".pkl"):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, name))
+        size = sum(f[1] for f in files)
+        for mtime, nbytes, name in sorted(files):
+            if size <= self.max_disk_mb * 1024 ** 2:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            size -= nbytes
@@ -0,0 +1,160 @@
+# coding: utf-8
+
+
+"""
+This module defines a registry of the compression codecs used for the data
+stored in GridFS, and a benchmark of the codecs on sample data.
+
+A codec is given as "name" or "name:level", e.g. "zlib:9" or "lzma". Only the
+name is recorded with the compressed data (in the "compression" field of the
+GridFS metadata), so data is always decompressed with the codec it was
+compressed with, whatever the current settings. zlib, bz2 and lzma are always
+available; lz4 and zstd are registered if the lz4 and zstandard packages are
+installed.
+"""
+
+import bz2
+import lzma
+import time
+import zlib
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+# name -> (compress(data, level), decompress(data), default level)
+_CODECS = {}
+
+
+def register_codec(name, compress, decompress, default_level=None):
+    """
+    Register a compression codec.
+
+    Args:
+        name (str): name of the codec, recorded with the compressed data
+        compress (callable): compress(data, level) -> bytes
+        decompress (callable): decompress(data) -> bytes
+        default_level (int): level used if the codec is given without one
+    """
+    _CODECS[name] = (compress, decompress, default_level)
+
+
+def available_codecs():
+    """
+    Names of the registered codecs.
+    """
+    return sorted(_CODECS)
+
+
+def parse_codec(codec):
+    """
+    Split a codec specification into its name and level.
+
+    Args:
+        codec (str): "name" or "name:level", or None for no compression
+
+    Returns:
+        (str, int): name and level; (None, None) for no compression
+    """
+    if codec is None:
+        return None, None
+    name, _, level = codec.partition(":")
+    if name not in _CODECS:
+        raise ValueError("Unknown compression codec {}, available codecs: {}".format(
+            name, ", ".join(available_codecs())))
+    return name, int(level) if level else _CODECS[name][2]
+
+
+def compress(data, codec):
+    """
+    Compress data.
+
+    Args:
+        data (bytes): the data
+        codec (str): "name" or "name:level", or None for no compression
+
+    Returns:
+        (bytes, str): the compressed data and the name of the codec to record
+    """
+    name, level = parse_codec(codec)
+    if name is None:
+        return data, None
+    return _CODECS[name][0](data, level), name
+
+
+def decompress(data, name):
+    """
+    Decompress data compressed with the given codec.
+
+    Args:
+        data (bytes): the compressed data
+        name (str): name of the codec, None if the data is not compressed
+
+    Returns:
+        (bytes)
+    """
+    if name is None:
+        return data
+    if name not in _CODECS:
+        raise ValueError("Unknown compression codec {}, available codecs: {}".format(
+            name, ", ".join(available_codecs())))
+    return _CODECS[name][1](data)
+
+
+def benchmark_codecs(samples, codecs=None, repeat=3):
+    """
+    Measure the compression ratio and speed of codecs on sample data, e.g.
+    GridFS files of one collection. Times are the best of several runs.
+
+    Args:
+        samples ([bytes]): the data
+        codecs ([str]): codecs to compare. Default: zlib, bz2 and lzma at low
+            and high levels, and lz4 and zstd if they are installed.
+        repeat (int): number of runs of each codec
+
+    Returns:
+        ([dict]): for every codec, "codec", "ratio" (uncompressed over
+            compressed size), "compress_mb_s" and "decompress_mb_s" (MB of
+            uncompressed data per second)
+    """
+    if codecs is None:
+        codecs = ["zlib:1", "zlib:6", "zlib:9", "bz2:9", "lzma:0", "lzma:6"]
+        codecs += [c for c in ["lz4", "zstd:3", "zstd:19"] if c.split(":")[0] in _CODECS]
+    size = sum(len(s) for s in samples)
+    results = []
+    for codec in codecs:
+        compress_time, decompress_time = float("inf"), float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            compressed = [compress(s, codec) for s in samples]
+            compress_time = min(compress_time, time.perf_counter() - start)
+            start = time.perf_counter()
+            for data, name in compressed:
+                decompress(data, name)
+            decompress_time = min(decompress_time, time.perf_counter() - start)
+        compressed_size = sum(len(data) for data, name in compressed)
+        results.append({"codec": codec,
+                        "ratio": size / max(compressed_size, 1),
+                        "compress_mb_s": size / 1e6 / max(compress_time, 1e-9),
+                        "decompress_mb_s": size / 1e6 / max(decompress_time, 1e-9)})
+    return results
+
+
+register_codec("zlib", zlib.compress, zlib.decompress, 6)
+register_codec("bz2", bz2.compress, bz2.decompress, 9)
+register_codec("lzma", lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 6)
+
+try:
+    import lz4.frame
+
+    register_codec("lz4", lambda data, level: lz4.frame.compress(data, compression_level=level),
+                   lz4.frame.decompress, 0)
+except ImportError:
+    pass
+
+try:
+    import zstandard
+
+    register_codec("zstd", lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+                   lambda data: zstandard.ZstdDecompressor().decompress(data), 3)
+except ImportError:
+    pass
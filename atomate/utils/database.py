@@ -5,14 +5,25 @@
 This module defines a base class for derived database classes that store calculation data.
 """
 
+import atexit
 import datetime
+import hashlib
+import json
+import os
+import socket
+import threading
 from abc import ABCMeta, abstractmethod
-from pymongo import MongoClient, ReturnDocument
+
+from bson import BSON, ObjectId
+from pymongo import ReturnDocument, UpdateOne, ASCENDING, DESCENDING
 
 from monty.json import jsanitize
 from monty.serialization import loadfn
 
-from atomate.utils.utils import get_logger
+from atomate.utils.cache import ObjectCache
+from atomate.utils.compression import compress as compress_data, decompress as decompress_data
+from atomate.utils.embedded import get_embedded_client, get_gridfs
+from atomate.utils.utils import get_logger, get_mongo_client
 
 __author__ = 'Kiran Mathew'
 __credits__ = 'Anubhav Jain'
@@ -20,37 +31,402 @@ __email__ = 'kmathew@lbl.gov'
 
 logger = get_logger(__name__)
 
+# task_id allocators shared by the CalcDbs of a process, per process id and
+# database, so that a forked process does not use the leases of its parent
+_task_id_allocators = {}
+_task_id_allocators_lock = threading.Lock()
+
+# databases whose credentials were checked by the process, see CalcDb
+_authenticated_databases = set()
+
+# task collections whose task_id counter and indexes were checked by the process
+_initialized_collections = set()
+
+# GridFS collections whose content hash index was checked by the process
+_hashed_collections = set()
+
+# top-level fields of a task document that are never moved to GridFS, see offload_fields
+_PINNED_FIELDS = ("_id", "task_id", "dir_name", "last_updated", "_field_hashes", "_offloaded")
+
+# approximate encoded size of the stub of a field moved to GridFS
+_STUB_SIZE = 96
+
+
+def get_hash_tree(value, depth):
+    """
+    Tree of the hashes of a value and of its fields and array elements, down
+    to the given depth: a hash for a leaf, {"#": hash, field: subtree, ...}
+    for a dict and {"#": hash, "[]": [subtree, ...]} for a list. Every value
+    is serialized once.
+
+    Args:
+        value: a JSON-like value
+        depth (int): number of levels of fields and array elements
+
+    Returns:
+        (str or dict) the hash tree
+    """
+    if depth > 0 and isinstance(value, dict):
+        tree = {k: get_hash_tree(v, depth - 1) for k, v in value.items()}
+        tree["#"] = _hash(sorted((k, _root_hash(t)) for k, t in tree.items()))
+        return tree
+    if depth > 0 and isinstance(value, list):
+        items = [get_hash_tree(v, depth - 1) for v in value]
+        return {"#": _hash(["[]"] + [_root_hash(t) for t in items]), "[]": items}
+    return _hash(value)
+
+
+def _hash(value):
+    data = json.dumps(value, sort_keys=True, default=str).encode()
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+def _root_hash(tree):
+    return tree["#"] if isinstance(tree, dict) else tree
+
+
+def _diff_update(value, tree, stored, path, set_fields, unset_fields):
+    """
+    Add the $set and $unset updates of the parts of a value that changed,
+    comparing its hash tree with the stored one.
+    """
+    if _root_hash(tree) == _root_hash(stored):
+        return
+    if isinstance(value, dict) and isinstance(stored, dict) and "[]" not in stored:
+        for k, v in value.items():
+            if k in stored and k != "#":
+                _diff_update(v, tree[k], stored[k], "{}.{}".format(path, k), set_fields, unset_fields)
+            else:
+                set_fields["{}.{}".format(path, k)] = v
+        for k in stored:
+            if k != "#" and k not in value:
+                unset_fields["{}.{}".format(path, k)] = ""
+    elif isinstance(value, list) and isinstance(stored, dict) and len(stored.get("[]", ())) == len(value):
+        for i, v in enumerate(value):
+            _diff_update(v, tree["[]"][i], stored["[]"][i], "{}.{}".format(path, i),
+                         set_fields, unset_fields)
+    else:
+        set_fields[path] = value
+
+
+def _get_offload_candidates(value, path, depth, min_size, candidates):
+    """
+    Encoded size of a value in bytes, summed from the sizes of its fields and
+    array elements down to the given depth, so that every part is encoded
+    once. The parts of at least min_size bytes are added to candidates, keyed
+    by their paths.
+    """
+    if depth > 0 and isinstance(value, (dict, list)):
+        items = value.items() if isinstance(value, dict) else enumerate(value)
+        # length, elements (type, key and value) and terminator of a document or array
+        size = 5 + sum(2 + len(str(k).encode()) +
+                       _get_offload_candidates(v, path + (k,), depth - 1, min_size, candidates)
+                       for k, v in items)
+    else:
+        size = len(BSON.encode({"v": value})) - 8
+    if size >= min_size:
+        candidates[path] = size
+    return size
+
+
+def _select_offloads(candidates, excess, min_size):
+    """
+    Choose the subtrees to move out of a document to shrink it by excess
+    bytes: the largest of the candidates without a candidate below them,
+    until enough is saved. A candidate becomes eligible once the candidates
+    below it are moved, if it is still at least min_size bytes.
+
+    Returns:
+        ([tuple], int): the paths, and the bytes still in excess
+    """
+    sizes = dict(candidates)
+    paths = []
+    while excess > 0 and sizes:
+        leaves = [p for p in sizes if not any(len(q) > len(p) and q[:len(p)] == p for q in sizes)]
+        path = max(leaves, key=sizes.get)
+        saved = sizes.pop(path) - _STUB_SIZE
+        paths.append(path)
+        excess -= saved
+        for p in [p for p in sizes if p == path[:len(p)]]:
+            sizes[p] -= saved
+            if sizes[p] < min_size:
+                del sizes[p]
+    return paths, excess
+
+
+def _get_parent(d, path):
+    """
+    Container and key of the value at a dotted path of a document.
+    """
+    keys = path.split(".")
+    for k in keys[:-1]:
+        d = d[int(k)] if isinstance(d, list) else d[k]
+    return d, int(keys[-1]) if isinstance(d, list) else keys[-1]
+
+
+class TaskIdAllocator(object):
+    """
+    Hand out task_ids from blocks of consecutive ids leased from the task_id
+    counter, so that many concurrent workers update the counter document once
+    per block instead of once per task. The ids are unique and roughly ordered.
+
+    Leases are recorded in the lease_collection. Every hand-out records the
+    next unused id and a heartbeat in the lease, and only succeeds while the
+    allocator still holds the lease, so that ids handed out are never leased
+    again. The ids a process did not use are released when it exits (or with
+    release()), and released ids are leased again before new blocks are taken
+    from the counter. The unused ids of processes that died without releasing
+    them are recovered with reclaim().
+    """
+
+    lease_collection = "task_id_leases"
+
+    def __init__(self, db, block_size=100, owner=None):
+        """
+        Args:
+            db (Database): the database with the counter collection
+            block_size (int): number of ids leased from the counter at once
+            owner (str): name of the lease holder. Default: host:pid
+        """
+        self.db = db
+        self.block_size = block_size
+        self.owner = owner or "{}:{}".format(socket.gethostname(), os.getpid())
+        self._pid = os.getpid()
+        self._lease = None
+        self._lock = threading.Lock()
+        atexit.register(self.release)
+
+    def get_ids(self, n=1):
+        """
+        Get new task_ids.
+
+        Args:
+            n (int): number of ids
+
+        Returns:
+            ([int]): the ids, in increasing order within a lease
+        """
+        ids = []
+        with self._lock:
+            while len(ids) < n:
+                if self._lease is None or self._lease["next"] > self._lease["end"]:
+                    self._lease = self._take_lease(n - len(ids))
+                start = self._lease["next"]
+                count = min(n - len(ids), self._lease["end"] - start + 1)
+                if not self._hand_out(start + count):
+                    logger.warning("The lease of the task_ids {} to {} was reclaimed".format(
+                        start, self._lease["end"]))
+                    self._lease = None
+                    continue
+                ids.extend(range(start, start + count))
+                self._lease["next"] += count
+        return ids
+
+    def release(self):
+        """
+        Release the unused ids of the current lease, so that other processes
+        can use them.
+        """
+        with self._lock:
+            # a forked process does not hold the leases of its parent
+            if self._lease is None or os.getpid() != self._pid:
+                return
+            leases = self.db[self.lease_collection]
+            query = {"_id": self._lease["_id"], "owner": self.owner}
+            try:
+                if self._lease["next"] > self._lease["end"]:
+                    leases.delete_one(query)
+                else:
+                    leases.update_one(query, {"$set": {"state": "released", "owner": None,
+                                                       "next": self._lease["next"]}})
+            except Exception:
+                logger.warning("Could not release the task_ids {} to {}".format(
+                    self._lease["next"], self._lease["end"]))
+            self._lease = None
+
+    def reclaim(self, max_age=86400):
+        """
+        Release the leases whose holder handed out no id for longer than
+        max_age seconds, e.g. workers that were killed. The ids after the
+        last one handed out are released; a holder that is still alive takes
+        a new lease at its next hand-out.
+
+        Args:
+            max_age (float): time without a heartbeat, in seconds, after
+                which the holder of a lease is assumed to be dead
+
+        Returns:
+            (int): number of reclaimed ids
+        """
+        leases = self.db[self.lease_collection]
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age)
+        reclaimed = 0
+        for lease in leases.find({"state": "leased", "heartbeat": {"$lt": cutoff}}):
+            # unless the holder handed out ids since the lease was read
+            query = {"_id": lease["_id"], "owner": lease["owner"], "heartbeat": lease["heartbeat"]}
+            if lease["next"] > lease["end"]:
+                leases.delete_one(query)
+            elif leases.update_one(query, {"$set": {"state": "released", "owner": None}}).modified_count:
+                reclaimed += lease["end"] - lease["next"] + 1
+        return reclaimed
+
+    def reset(self):
+        """
+        Forget the current lease, e.g. after the counter was reset.
+        """
+        with self._lock:
+            self._lease = None
+
+    def _hand_out(self, next_id):
+        """
+        Record the next unused id and the heartbeat of the current lease.
+
+        Returns:
+            (bool) whether the allocator still holds the lease
+        """
+        return bool(self.db[self.lease_collection].update_one(
+            {"_id": self._lease["_id"], "owner": self.owner, "state": "leased"},
+            {"$set": {"next": next_id, "heartbeat": datetime.datetime.utcnow()}}).matched_count)
+
+    def _take_lease(self, n):
+        """
+        Lease a released range of ids, or a new block from the counter.
+        """
+        leases = self.db[self.lease_collection]
+        if self._lease is not None:
+            leases.delete_one({"_id": self._lease["_id"], "owner": self.owner})
+        now = datetime.datetime.utcnow()
+        lease = leases.find_one_and_update(
+            {"state": "released"},
+            {"$set": {"state": "leased", "owner": self.owner, "leased_at": now, "heartbeat": now}},
+            sort=[("next", ASCENDING)], return_document=ReturnDocument.AFTER)
+        if lease is None:
+            size = max(self.block_size, n)
+            end = self.db.counter.find_one_and_update(
+                {"_id": "taskid"}, {"$inc": {"c": size}}, upsert=True,
+                return_document=ReturnDocument.AFTER)["c"]
+            lease = {"_id": ObjectId(), "start": end - size + 1, "next": end - size + 1, "end": end,
+                     "state": "leased", "owner": self.owner, "leased_at": now, "heartbeat": now}
+            leases.insert_one(lease)
+        logger.debug("Leased task_ids {} to {}".format(lease["next"], lease["end"]))
+        return lease
+
 
 class CalcDb(metaclass=ABCMeta):
 
+    # levels of fields compared by the diff updates, see write_task
+    diff_depth = 3
+
+    # codec of the GridFS collections without an entry in the gridfs_compression
+    # policy, see get_gridfs_codec
+    default_gridfs_codec = "zlib:1"
+
+    # largest encoded size of a task document, in bytes, beyond which its
+    # largest fields are moved to GridFS (see offload_fields), e.g. 15 MB to
+    # stay below the 16 MB limit of MongoDB. None to write the documents as
+    # they are.
+    max_doc_size = None
+
+    # smallest field moved to GridFS, in bytes, levels of fields and array
+    # elements considered, and GridFS collection of the moved fields
+    offload_min_size = 256 * 1024
+    offload_depth = 4
+    offload_collection = "offloaded_fs"
+
+    # keys of a db_file passed to __init__ as keyword arguments, see from_db_file
+    db_file_keys = ("task_id_block_size", "gridfs_compression", "object_cache", "backend",
+                    "diff_updates", "max_doc_size")
+
     def __init__(self, host, port, database, collection, user, password, **kwargs):
+        """
+        Args:
+            host (str): database host, or the directory of the database files
+                of the embedded backend
+            port (int): database port
+            database (str): database name
+            collection (str): name of the tasks collection
+            user (str): user name
+            password (str): password
+            kwargs: MongoClient keyword arguments, and
+                task_id_block_size (int): if set, the task_ids are handed out
+                    from blocks of that many ids leased by the process, see
+                    TaskIdAllocator. Default: one update of the counter per task_id.
+                gridfs_compression (dict): GridFS collection name -> compression
+                    codec (see atomate.utils.compression), with the key
+                    "default" for the other collections
+                object_cache (dict or ObjectCache): cache of the objects decoded
+                    from GridFS, or the keyword arguments of an ObjectCache, e.g.
+                    {"maxsize": 16, "cache_dir": "~/.atomate_cache"}. Default: no cache.
+                backend (str): "mongodb", or "sqlite" for the embedded, file-backed
+                    database of atomate.utils.embedded, for machines without a
+                    MongoDB server. Default: "mongodb".
+                diff_updates (bool): whether the task documents that replace a
+                    stored one only update the fields that changed, see
+                    write_task. Default: False.
+                max_doc_size (int): size budget of the task documents in bytes,
+                    see offload_fields, e.g. 15 * 1024 ** 2. Readers must then
+                    put back the moved fields (see retrieve_task). Default:
+                    None, the documents are written as they are.
+        """
+        task_id_block_size = kwargs.pop("task_id_block_size", None)
+        self.gridfs_compression = kwargs.pop("gridfs_compression", None) or {}
+        object_cache = kwargs.pop("object_cache", None)
+        backend = kwargs.pop("backend", "mongodb")
+        self.diff_updates = kwargs.pop("diff_updates", False)
+        self.max_doc_size = kwargs.pop("max_doc_size", self.max_doc_size)
+        self.object_cache = ObjectCache(**object_cache) if isinstance(object_cache, dict) \
+            else object_cache
         self.host = host
         self.db_name = database
         self.user = user
         self.password = password
         self.port = int(port)
 
-        try:
-            self.connection = MongoClient(host=self.host, port=self.port,
-                                          username=self.user,
-                                          password=self.password, **kwargs)
+        if backend == "sqlite":
+            self.connection = get_embedded_client(self.host)
             self.db = self.connection[self.db_name]
-        except:
-            logger.error("Mongodb connection failed")
-            raise Exception
-        try:
-            if self.user:
+        elif backend == "mongodb":
+            try:
+                self.connection = get_mongo_client(self.host, self.port, username=self.user,
+                                                   password=self.password, **kwargs)
+                self.db = self.connection[self.db_name]
+            except:
+                logger.error("Mongodb connection failed")
+                raise Exception
+        else:
+            raise ValueError("Unknown database backend {}".format(backend))
+        self.collection = self.db[collection]
+
+        # the client is shared by the process (see get_mongo_client), so the
+        # credentials are checked once per process, keyed as the client is
+        key = (os.getpid(), backend, self.host, self.port, self.user,
+               hashlib.sha1(self.password.encode()).hexdigest() if self.password else None,
+               kwargs.get("authsource", None), self.db_name)
+        if self.user and key not in _authenticated_databases:
+            try:
                 self.db.authenticate(self.user, self.password,
                                      source=kwargs.get("authsource", None))
-        except:
-            logger.error("Mongodb authentication failed")
-            raise ValueError
-        self.collection = self.db[collection]
+            except:
+                logger.error("Mongodb authentication failed")
+                raise ValueError
+            _authenticated_databases.add(key)
+
+        # set counter collection, and the indexes of a new (or dropped)
+        # database, once per process and collection
+        key = (backend, self.host, self.port, self.db_name, collection)
+        if key not in _initialized_collections:
+            if self.db.counter.find_one({"_id": "taskid"}, ["_id"]) is None:
+                self.db.counter.insert_one({"_id": "taskid", "c": 0})
+                self.build_indexes()
+            _initialized_collections.add(key)
 
-        # set counter collection
-        if self.db.counter.find({"_id": "taskid"}).count() == 0:
-            self.db.counter.insert_one({"_id": "taskid", "c": 0})
-            self.build_indexes()
+        self.task_id_allocator = None
+        if task_id_block_size:
+            key = (os.getpid(), self.host, self.port, self.db_name)
+            with _task_id_allocators_lock:
+                if key not in _task_id_allocators:
+                    _task_id_allocators[key] = TaskIdAllocator(self.db, task_id_block_size)
+            self.task_id_allocator = _task_id_allocators[key]
 
     @abstractmethod
     def build_indexes(self, indexes=None, background=True):
@@ -71,25 +447,485 @@ class CalcDb(metaclass=ABCMeta):
             d (dict): task document
             update_duplicates (bool): whether to update the duplicates
         """
+        if self.assign_task_id(d, update_duplicates) is None:
+            return None
+        return self.write_task(d)
+
+    def assign_task_id(self, d, update_duplicates=True):
+        """
+        Set the task_id of a task document before it is written: the task_id of
+        the document with the same dir_name if there is one, else a new task_id
+        from the counter (unless the document already has one).
+
+        Args:
+            d (dict): task document
+            update_duplicates (bool): whether to update the duplicates
+
+        Returns:
+            task_id, or None if the document is a duplicate that is skipped
+        """
         result = self.collection.find_one({"dir_name": d["dir_name"]}, ["dir_name", "task_id"])
-        if result is None or update_duplicates:
-            d["last_updated"] = datetime.datetime.utcnow()
-            if result is None:
-                if ("task_id" not in d) or (not d["task_id"]):
-                    d["task_id"] = self.db.counter.find_one_and_update(
-                        {"_id": "taskid"}, {"$inc": {"c": 1}},
-                        return_document=ReturnDocument.AFTER)["c"]
-                logger.info("Inserting {} with taskid = {}".format(d["dir_name"], d["task_id"]))
-            elif update_duplicates:
-                d["task_id"] = result["task_id"]
-                logger.info("Updating {} with taskid = {}".format(d["dir_name"], d["task_id"]))
-            d = jsanitize(d, allow_bson=True)
-            self.collection.update_one({"dir_name": d["dir_name"]},
-                                       {"$set": d}, upsert=True)
-            return d["task_id"]
+        if result is None:
+            if ("task_id" not in d) or (not d["task_id"]):
+                d["task_id"] = self.get_new_task_ids(1)[0]
+            logger.info("Inserting {} with taskid = {}".format(d["dir_name"], d["task_id"]))
+        elif update_duplicates:
+            d["task_id"] = result["task_id"]
+            logger.info("Updating {} with taskid = {}".format(d["dir_name"], d["task_id"]))
         else:
             logger.info("Skipping duplicate {}".format(d["dir_name"]))
             return None
+        return d["task_id"]
+
+    def write_task(self, d):
+        """
+        Write a task document whose task_id is set (see assign_task_id),
+        replacing the fields of the document with the same dir_name.
+
+        With diff_updates, the hashes of the fields of the document, down to
+        diff_depth levels (e.g. calcs_reversed.0.output), are stored with it
+        in the "_field_hashes" field, and replacing a stored document only
+        sends the fields whose hash changed. The update only applies if the
+        stored hashes are still the ones it was computed from; otherwise, e.g.
+        if another process wrote the document meanwhile, every field is set.
+        Fields changed by writers that do not update the hashes are not
+        detected.
+
+        Documents larger than max_doc_size are shrunk first, see offload_fields.
+        The fields of the stored document that were moved to GridFS stay
+        listed in its "_offloaded" field unless the document replaces them.
+
+        Args:
+            d (dict): task document
+
+        Returns:
+            task_id
+        """
+        d["last_updated"] = datetime.datetime.utcnow()
+        d = self.offload_fields(jsanitize(d, allow_bson=True))
+        stored = self.collection.find_one({"dir_name": d["dir_name"]}, self._get_stored_fields())
+        update = self._get_update(d, stored)
+        if not self.collection.update_one(self._get_update_filter(d, stored), update,
+                                          upsert=stored is None).matched_count and stored:
+            # removed or written by another process since it was read
+            stored = self.collection.find_one({"dir_name": d["dir_name"]}, ["_offloaded"]) or {}
+            update = self._get_update(d, {"_offloaded": stored.get("_offloaded", [])})
+            self.collection.update_one({"dir_name": d["dir_name"]}, update, upsert=True)
+        return d["task_id"]
+
+    def insert_tasks(self, docs, update_duplicates=True):
+        """
+        Insert a batch of task documents with a few database operations: the
+        duplicates of the whole batch are looked up with a single query, a
+        block of consecutive task_ids is reserved for the new documents with a
+        single update of the counter, and all the documents are written with
+        one unordered bulk write. The documents are otherwise written as with
+        insert; of several documents with the same dir_name, the last one is
+        written.
+
+        Args:
+            docs ([dict]): task documents
+            update_duplicates (bool): whether to update the duplicates
+
+        Returns:
+            (dict): dir_name -> task_id, None for the skipped duplicates
+        """
+        task_ids = self.assign_task_ids(docs, update_duplicates)
+        self.write_tasks([d for d in {d["dir_name"]: d for d in docs}.values()
+                          if task_ids[d["dir_name"]] is not None])
+        return task_ids
+
+    def assign_task_ids(self, docs, update_duplicates=True):
+        """
+        Set the task_ids of a batch of task documents before they are written,
+        as assign_task_id does for one document, with a single query for the
+        duplicates and a single update of the counter.
+
+        Args:
+            docs ([dict]): task documents
+            update_duplicates (bool): whether to update the duplicates
+
+        Returns:
+            (dict): dir_name -> task_id, None for the skipped duplicates
+        """
+        docs = list({d["dir_name"]: d for d in docs}.values())
+        if not docs:
+            return {}
+        existing = {r["dir_name"]: r["task_id"] for r in self.collection.find(
+            {"dir_name": {"$in": [d["dir_name"] for d in docs]}}, ["dir_name", "task_id"])}
+
+        new = [d for d in docs if d["dir_name"] not in existing and not d.get("task_id")]
+        for task_id, d in zip(self.get_new_task_ids(len(new)), new):
+            d["task_id"] = task_id
+
+        task_ids = {}
+        for d in docs:
+            if d["dir_name"] in existing:
+                if not update_duplicates:
+                    logger.info("Skipping duplicate {}".format(d["dir_name"]))
+                    task_ids[d["dir_name"]] = None
+                    continue
+                d["task_id"] = existing[d["dir_name"]]
+                logger.info("Updating {} with taskid = {}".format(d["dir_name"], d["task_id"]))
+            else:
+                logger.info("Inserting {} with taskid = {}".format(d["dir_name"], d["task_id"]))
+            task_ids[d["dir_name"]] = d["task_id"]
+        return task_ids
+
+    def write_tasks(self, docs):
+        """
+        Write task documents whose task_ids are set (see assign_task_ids) with
+        one unordered bulk write, as write_task does for one document.
+
+        Args:
+            docs ([dict]): task documents
+        """
+        if not docs:
+            return
+        stored = {r["dir_name"]: r for r in self.collection.find(
+            {"dir_name": {"$in": [d["dir_name"] for d in docs]}},
+            ["dir_name"] + self._get_stored_fields())}
+        requests, roots = [], {}
+        for d in docs:
+            d["last_updated"] = datetime.datetime.utcnow()
+            d = self.offload_fields(jsanitize(d, allow_bson=True))
+            update = self._get_update(d, stored.get(d["dir_name"]))
+            if d["dir_name"] in stored:
+                roots[d["dir_name"]] = (d, update["$set"].get("_field_hashes", {}).get("#"))
+            requests.append(UpdateOne(self._get_update_filter(d, stored.get(d["dir_name"])),
+                                      update, upsert=d["dir_name"] not in stored))
+        result = self.collection.bulk_write(requests, ordered=False)
+        if result.matched_count < len(stored):
+            # some documents were removed or written by another process since
+            # they were read: set every field of the ones not written
+            current = {r["dir_name"]: r for r in self.collection.find(
+                {"dir_name": {"$in": list(roots)}}, ["dir_name", "_field_hashes.#", "_offloaded"])}
+            for dir_name, (d, root) in roots.items():
+                r = current.get(dir_name)
+                if r and (root is None or (r.get("_field_hashes") or {}).get("#") == root):
+                    continue
+                update = self._get_update(d, {"_offloaded": (r or {}).get("_offloaded", [])})
+                self.collection.update_one({"dir_name": dir_name}, update, upsert=True)
+
+    def _get_stored_fields(self):
+        """
+        Fields of the stored task documents read to compute their updates,
+        see _get_update.
+        """
+        return ["_offloaded", "_field_hashes"] if self.diff_updates else ["_offloaded"]
+
+    @staticmethod
+    def _get_update_filter(d, stored):
+        """
+        Filter of the update of a task document computed from the stored
+        "_field_hashes" (see _get_update): it only matches the stored document
+        while its hashes are unchanged.
+        """
+        tree = (stored or {}).get("_field_hashes")
+        if not tree:
+            return {"dir_name": d["dir_name"]}
+        return {"dir_name": d["dir_name"], "_field_hashes.#": _root_hash(tree)}
+
+    def _get_update(self, d, stored):
+        """
+        Update writing a sanitized task document: every field, or with
+        diff_updates only the fields that changed from the stored document.
+
+        Args:
+            d (dict): the sanitized task document
+            stored (dict): the "_field_hashes" and "_offloaded" fields of the
+                stored document, None if there is no stored document
+
+        Returns:
+            (dict) the update
+        """
+        d = {k: v for k, v in d.items() if k != "_field_hashes"}
+        # the fields a previous write moved to GridFS stay listed while the
+        # top-level fields holding their stubs are not replaced
+        offloaded = d.pop("_offloaded", []) + [
+            p for p in (stored or {}).get("_offloaded", []) if p.split(".")[0] not in d]
+        stale = {}
+        if offloaded:
+            d["_offloaded"] = offloaded
+        else:
+            stale = {"_offloaded": ""}
+        if not self.diff_updates:
+            # the hashes of a previous diff update are stale
+            return {"$set": d, "$unset": dict(stale, _field_hashes="")}
+        fields = {k: v for k, v in d.items() if k not in ("_id", "last_updated")}
+        tree = get_hash_tree(fields, self.diff_depth)
+        stored_tree = (stored or {}).get("_field_hashes")
+        if not stored_tree:
+            update = {"$set": dict(d, _field_hashes=tree)}
+            if stale:
+                update["$unset"] = stale
+            return update
+        set_fields, unset_fields = {}, dict(stale)
+        for k, v in fields.items():
+            if k in stored_tree and k != "#":
+                _diff_update(v, tree[k], stored_tree[k], k, set_fields, unset_fields)
+            else:
+                set_fields[k] = v
+        set_fields.update(last_updated=d["last_updated"], _field_hashes=tree)
+        update = {"$set": set_fields}
+        if unset_fields:
+            update["$unset"] = unset_fields
+        return update
+
+    def offload_fields(self, d):
+        """
+        Keep a task document within max_doc_size bytes of BSON by moving its
+        largest fields to GridFS, e.g. the ionic steps of a long MD run or the
+        custodian logs, so that it can be written. The encoded sizes of the
+        fields and array elements are measured down to offload_depth levels
+        (e.g. calcs_reversed.0.output.ionic_steps), and the largest of the
+        innermost ones of at least offload_min_size bytes are moved until the
+        document fits. A moved value is stored as BSON in the
+        offload_collection and replaced with the stub {"fs_id": file id,
+        "compression": codec, "nbytes": encoded size}; the dotted paths of the
+        moved values are listed in the "_offloaded" field of the document.
+        They are put back by load_offloaded_fields. A value already stored
+        by another write is not stored again, see find_gridfs_file.
+
+        Args:
+            d (dict): the sanitized task document, with its task_id set. It
+                is modified in place.
+
+        Returns:
+            (dict) the document
+        """
+        if not self.max_doc_size:
+            return d
+        size = len(BSON.encode(d))
+        if size <= self.max_doc_size:
+            return d
+
+        candidates = {}
+        for k, v in d.items():
+            if k not in _PINNED_FIELDS:
+                _get_offload_candidates(v, (k,), self.offload_depth - 1, self.offload_min_size,
+                                        candidates)
+        paths, excess = _select_offloads(candidates, size - self.max_doc_size,
+                                         self.offload_min_size)
+        if excess > 0:
+            logger.warning("Task {} is {} bytes larger than the document size budget after "
+                           "moving its large fields to GridFS".format(d["task_id"], excess))
+
+        fs = get_gridfs(self.db, self.offload_collection)
+        codec = self.get_gridfs_codec(self.offload_collection)
+        offloaded = list(d.get("_offloaded", []))
+        for path in paths:
+            parent = d
+            for k in path[:-1]:
+                parent = parent[k]
+            name = ".".join(str(k) for k in path)
+            data = BSON.encode({"v": parent[path[-1]]})
+            content_hash = hashlib.sha256(data).hexdigest()
+            existing = self.find_gridfs_file(self.offload_collection, content_hash)
+            if existing:
+                fs_id, compression = existing["_id"], existing["metadata"]["compression"]
+            else:
+                data, compression = compress_data(data, codec)
+                fs_id = fs.put(data, metadata={"task_id": d["task_id"], "compression": compression,
+                                               "encoding": "bson", "path": name,
+                                               "content_hash": content_hash})
+            parent[path[-1]] = {"fs_id": fs_id, "compression": compression,
+                                "nbytes": candidates[path]}
+            offloaded.append(name)
+        d["_offloaded"] = offloaded
+        logger.info("Moved {} of task {} to GridFS".format(", ".join(offloaded), d["task_id"]))
+        return d
+
+    def load_offloaded_fields(self, d):
+        """
+        Put back the fields of a stored task document that were moved to
+        GridFS by offload_fields.
+
+        Args:
+            d (dict): the task document. It is modified in place.
+
+        Returns:
+            (dict) the document
+        """
+        for name in d.pop("_offloaded", []):
+            parent, key = _get_parent(d, name)
+            parent[key] = self.load_offloaded_value(parent[key])
+        return d
+
+    def load_offloaded_value(self, stub):
+        """
+        Value of a field moved to GridFS by offload_fields.
+
+        Args:
+            stub (dict): the stub that replaced the field, with the keys
+                "fs_id" and "compression"
+
+        Returns:
+            the value
+        """
+        f = get_gridfs(self.db, self.offload_collection).get(stub["fs_id"])
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        return BSON(decompress_data(data, stub["compression"])).decode()["v"]
+
+    def find_gridfs_file(self, collection, content_hash, before=None):
+        """
+        Find a GridFS file by the SHA-256 hash of its uncompressed content,
+        recorded as "content_hash" in its metadata, so that identical data is
+        stored once. The file is marked as reused ("reused_at" in its
+        metadata), so that collect_gridfs_garbage keeps it until the task
+        document that references it is written.
+
+        Args:
+            collection (string): the GridFS collection name
+            content_hash (str): the hex digest
+            before (ObjectId): only find a file with a smaller id
+
+        Returns:
+            (dict) the "_id" and "metadata" of the oldest such file, None if
+                there is none
+        """
+        files = self.db["{}.files".format(collection)]
+        key = (os.getpid(), self.host, self.port, self.db_name, collection)
+        if key not in _hashed_collections:
+            files.create_index("metadata.content_hash", background=True)
+            _hashed_collections.add(key)
+        query = {"metadata.content_hash": content_hash}
+        if before is not None:
+            query["_id"] = {"$lt": before}
+        return files.find_one_and_update(
+            query, {"$set": {"metadata.reused_at": datetime.datetime.utcnow()}},
+            projection=["_id", "metadata"], sort=[("_id", ASCENDING)])
+
+    def get_task_collections(self):
+        """
+        Names of the collections of the database that may hold documents
+        referencing GridFS files: all but the GridFS and the task_id
+        collections. The GridFS collections are shared by the task
+        collections of the database, and by the database classes, and a
+        file can be referenced from several of them (see find_gridfs_file).
+
+        Returns:
+            ([str]): the collection names
+        """
+        excluded = {"counter", TaskIdAllocator.lease_collection}
+        return sorted(c for c in self.db.collection_names(include_system_collections=False)
+                      if not c.endswith((".files", ".chunks")) and c not in excluded)
+
+    def get_gridfs_references(self):
+        """
+        Ids of the GridFS files referenced by the documents of all the task
+        collections of the database (see get_task_collections), per GridFS
+        collection, for the collections written by the database class (see
+        collect_gridfs_garbage).
+
+        Returns:
+            (dict): collection -> set of file ids, as strings
+        """
+        references = set()
+        for name in self.get_task_collections():
+            collection = self.db[name]
+            for d in collection.find({"_offloaded": {"$exists": True}}, ["_offloaded"]):
+                paths = d["_offloaded"]
+                # the stubs are read with the top-level fields that hold them
+                stored = collection.find_one({"_id": d["_id"]},
+                                             list({p.split(".")[0] for p in paths}))
+                for path in paths:
+                    parent, key = _get_parent(stored, path)
+                    references.add(str(parent[key]["fs_id"]))
+        return {self.offload_collection: references}
+
+    def collect_gridfs_garbage(self, min_age=86400, dry_run=False):
+        """
+        Remove the GridFS files that no document of the task collections of
+        the database references, e.g. the files of the tasks that were
+        inserted again or deleted, in the collections of
+        get_gridfs_references. The files uploaded or reused
+        (see find_gridfs_file) less than min_age seconds ago are kept, since
+        the files of a task are uploaded before its document is written.
+
+        Args:
+            min_age (float): age in seconds of the files that may be removed
+            dry_run (bool): whether to only count the files that would be removed
+
+        Returns:
+            (dict): GridFS collection -> {"files": number of files removed,
+                "bytes": their length}
+        """
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=min_age)
+        report = {}
+        for collection, references in self.get_gridfs_references().items():
+            files = self.db["{}.files".format(collection)]
+            fs = get_gridfs(self.db, collection)
+            removed, nbytes = 0, 0
+            for f in list(files.find({}, ["uploadDate", "length", "metadata.reused_at"])):
+                reused_at = (f.get("metadata") or {}).get("reused_at")
+                if str(f["_id"]) in references or f["uploadDate"] >= cutoff or \
+                        (reused_at and reused_at >= cutoff):
+                    continue
+                if not dry_run:
+                    # unless it was reused since it was read
+                    if not files.delete_one({"_id": f["_id"],
+                                             "metadata.reused_at": reused_at}).deleted_count:
+                        continue
+                    fs.delete(f["_id"])
+                removed += 1
+                nbytes += f["length"]
+            report[collection] = {"files": removed, "bytes": nbytes}
+            logger.info("{} {} unreferenced files ({} bytes) of {}".format(
+                "Found" if dry_run else "Removed", removed, nbytes, collection))
+        return report
+
+    def get_gridfs_codec(self, collection, blob=False):
+        """
+        Compression codec of a GridFS collection, from the gridfs_compression
+        policy (see __init__), e.g. {"dos_fs": "zlib:1", "chgcar_fs": "lzma:9"}.
+        Collections without an entry use the "default" codec, zlib at level 1
+        unless set, except the binary array blobs, which are not compressed
+        unless their collection has an entry: a compressed blob must be
+        downloaded in full to read any part of it.
+
+        Args:
+            collection (string): the GridFS collection name
+            blob (bool): whether the data is a binary array blob
+        Returns:
+            (str) codec, or None for no compression
+        """
+        if collection in self.gridfs_compression:
+            return self.gridfs_compression[collection]
+        return None if blob else self.gridfs_compression.get("default", self.default_gridfs_codec)
+
+    def get_new_task_ids(self, n):
+        """
+        Get new task_ids, from the task_id allocator if there is one, else
+        with a single update of the counter.
+
+        Args:
+            n (int): number of task_ids
+
+        Returns:
+            ([int]): the task_ids
+        """
+        if n == 0:
+            return []
+        if self.task_id_allocator is not None:
+            return self.task_id_allocator.get_ids(n)
+        last = self.db.counter.find_one_and_update(
+            {"_id": "taskid"}, {"$inc": {"c": n}}, upsert=True,
+            return_document=ReturnDocument.AFTER)["c"]
+        return list(range(last - n + 1, last + 1))
+
+    def reset_counter(self):
+        """
+        Reset the task_id counter and drop the task_id leases.
+        """
+        self.db.counter.delete_one({"_id": "taskid"})
+        self.db.counter.insert_one({"_id": "taskid", "c": 0})
+        self.db[TaskIdAllocator.lease_collection].delete_many({})
+        if self.task_id_allocator is not None:
+            self.task_id_allocator.reset()
 
     @abstractmethod
     def reset(self):
@@ -100,7 +936,11 @@ class CalcDb(metaclass=ABCMeta):
         """
         Create MMDB from database file. File requires host, port, database,
         collection, and optionally admin_user/readonly_user and
-        admin_password/readonly_password
+        admin_password/readonly_password, task_id_block_size (see
+        TaskIdAllocator), gridfs_compression, object_cache, diff_updates and
+        max_doc_size (see __init__), and the other db_file_keys of the class.
+        For the embedded backend, the file requires "backend": "sqlite", the
+        directory of the database files as "path", database and collection.
 
         Args:
             db_file (str): path to the file containing the credentials
@@ -131,5 +971,12 @@ class CalcDb(metaclass=ABCMeta):
         else:
             kwargs["authsource"] = creds["database"]
 
+        for k in cls.db_file_keys:
+            if k in creds:
+                kwargs[k] = creds[k]
+
+        if creds.get("backend") == "sqlite":
+            return cls(creds["path"], int(creds.get("port", 0)), creds["database"],
+                       creds["collection"], user, password, **kwargs)
         return cls(creds["host"], int(creds["port"]), creds["database"], creds["collection"],
                    user, password, **kwargs)
@@ -0,0 +1,1055 @@
+# coding: utf-8
+
+
+"""
+This module defines an embedded, file-backed stand-in for a MongoDB database,
+for the CalcDbs and the builders on machines without a database server, e.g.
+air-gapped compute partitions or laptops. A database is an SQLite file with a
+table per collection, holding the documents as MongoDB extended JSON, next to
+a directory of GridFS files.
+
+The part of the pymongo and gridfs APIs used by atomate is implemented: find
+(with projections, $slice, sort, skip and limit), find_one, find_one_and_update,
+insert, update, replace, delete, bulk_write, distinct, count, create_index, and
+GridFS put, new_file, get and delete, with the common query ($in, $gt, $regex,
+$exists, $elemMatch, $or, ...) and update ($set, $unset, $inc, $max, $push, ...)
+operators. Aggregations are not supported.
+
+The fields of an index (see EmbeddedCollection.create_index) are copied to
+indexed columns, so that lookups by task_id, dir_name, formula, ... do not scan
+the collection; the indexed fields are assumed to hold scalar values. Other
+queries are evaluated on every document of the collection.
+
+Several threads and processes can use the same database: every thread has its
+own SQLite connection, and writes are serialized by SQLite. The databases are
+in WAL mode, so readers and the writer do not block each other; the files
+must be on a local file system.
+"""
+
+import calendar
+import datetime
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from bson import ObjectId, json_util
+from gridfs.errors import FileExists, NoFile
+from pymongo import InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany, \
+    ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+# naive UTC datetimes, as returned by a MongoClient by default
+_JSON_OPTIONS = json_util.JSONOptions(tz_aware=False)
+
+# clients of the process, see get_embedded_client
+_clients = {}
+_clients_lock = threading.Lock()
+
+_PATTERN_TYPE = type(re.compile(""))
+
+_TYPE_CODES = {1: "double", 2: "string", 3: "object", 4: "array", 7: "objectId", 8: "bool",
+               9: "date", 10: "null", 16: "int", 18: "long"}
+
+
+def get_embedded_client(path):
+    """
+    Get the EmbeddedClient of the process for a directory of databases,
+    creating it on first use.
+
+    Args:
+        path (str): directory of the database files
+
+    Returns:
+        EmbeddedClient
+    """
+    key = (os.getpid(), os.path.abspath(os.path.expanduser(path)))
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = EmbeddedClient(key[1])
+        return _clients[key]
+
+
+def close_embedded_client(path):
+    """
+    Close the EmbeddedClient of the process for a directory of databases, if
+    there is one, and forget it, e.g. before the directory is removed.
+
+    Args:
+        path (str): directory of the database files
+    """
+    key = (os.getpid(), os.path.abspath(os.path.expanduser(path)))
+    with _clients_lock:
+        client = _clients.pop(key, None)
+    if client is not None:
+        client.close()
+
+
+def get_gridfs(database, collection="fs"):
+    """
+    GridFS collection of a pymongo or embedded database.
+
+    Args:
+        database (Database or EmbeddedDatabase): the database
+        collection (str): the GridFS collection name
+
+    Returns:
+        GridFS or EmbeddedGridFS
+    """
+    if isinstance(database, EmbeddedDatabase):
+        return EmbeddedGridFS(database, collection)
+    import gridfs
+    return gridfs.GridFS(database, collection)
+
+
+class _Result(object):
+    """
+    Result of a write operation, with the attributes of the pymongo results.
+    """
+
+    def __init__(self, **kwargs):
+        self.acknowledged = True
+        self.__dict__.update(kwargs)
+
+
+class EmbeddedClient(object):
+    """
+    Directory of embedded databases: the database "vasp" is the SQLite file
+    vasp.sqlite, and its GridFS files are in the directory vasp_files.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): directory of the database files, created if needed
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._databases = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._databases:
+                self._databases[name] = EmbeddedDatabase(self, name)
+            return self._databases[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def close(self):
+        for database in self._databases.values():
+            database.close()
+
+
+class EmbeddedDatabase(object):
+    """
+    SQLite database with the interface of a pymongo Database.
+    """
+
+    def __init__(self, client, name):
+        """
+        Args:
+            client (EmbeddedClient): the client
+            name (str): name of the database
+        """
+        self.client = client
+        self.name = name
+        self.path = os.path.join(client.path, "{}.sqlite".format(name))
+        self.files_dir = os.path.join(client.path, "{}_files".format(name))
+        self._local = threading.local()
+        self._columns = {}
+
+    def __getitem__(self, name):
+        return EmbeddedCollection(self, name)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def connection(self):
+        """
+        SQLite connection of the current thread.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=600, isolation_level=None)
+            # readers do not block the writers of other processes, and vice versa
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager running the enclosed operations in a write transaction.
+        The indexed columns are read again in every transaction, since other
+        processes may have added some (see EmbeddedCollection.create_index);
+        they do not change while the transaction holds the write lock.
+        """
+        conn = self.connection()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._columns = {}
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def authenticate(self, *args, **kwargs):
+        # access is controlled by the file permissions
+        return True
+
+    def collection_names(self, include_system_collections=True):
+        rows = self.connection().execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        return sorted(r[0] for r in rows)
+
+    list_collection_names = collection_names
+
+    def drop_collection(self, name):
+        self[name].drop()
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def index_columns(self, name, refresh=False):
+        """
+        The indexed fields of a collection, that have a column in its table.
+        """
+        if refresh or name not in self._columns:
+            rows = self.connection().execute("PRAGMA table_info({})".format(_quote(name)))
+            self._columns[name] = [r[1][1:] for r in rows if r[1].startswith("$")]
+        return self._columns[name]
+
+
+class EmbeddedCollection(object):
+    """
+    Table of documents with the interface of a pymongo Collection.
+    """
+
+    def __init__(self, database, name):
+        """
+        Args:
+            database (EmbeddedDatabase): the database
+            name (str): name of the collection
+        """
+        self.database = database
+        self.name = name
+        self.full_name = "{}.{}".format(database.name, name)
+        self._table = _quote(name)
+
+    def __getitem__(self, name):
+        return self.database["{}.{}".format(self.name, name)]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def find(self, filter=None, projection=None, skip=0, limit=0, sort=None, **kwargs):
+        return EmbeddedCursor(self, filter, projection, skip=skip, limit=limit, sort=sort)
+
+    def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {"_id": filter}
+        for doc in self.find(filter, projection, limit=1, sort=sort):
+            return doc
+        return None
+
+    def count_documents(self, filter, skip=0, limit=0):
+        return self.find(filter, skip=skip, limit=limit).count(with_limit_and_skip=True)
+
+    def count(self, filter=None, **kwargs):
+        return self.find(filter).count()
+
+    def estimated_document_count(self):
+        try:
+            return self.database.connection().execute(
+                "SELECT COUNT(*) FROM {}".format(self._table)).fetchone()[0]
+        except sqlite3.OperationalError:
+            return 0
+
+    def distinct(self, key, filter=None):
+        values = []
+        for doc in self.find(filter):
+            for v in _expand(_lookup(doc, key.split("."))):
+                if not isinstance(v, list) and not any(_equal(v, u) for u in values):
+                    values.append(v)
+        return values
+
+    def insert_one(self, document):
+        with self.database.transaction() as conn:
+            self._insert(conn, document)
+        return _Result(inserted_id=document["_id"])
+
+    def insert_many(self, documents, ordered=True):
+        documents = list(documents)
+        with self.database.transaction() as conn:
+            for document in documents:
+                self._insert(conn, document)
+        return _Result(inserted_ids=[d["_id"] for d in documents])
+
+    def update_one(self, filter, update, upsert=False):
+        with self.database.transaction() as conn:
+            return self._update(conn, filter, update, upsert, multi=False)
+
+    def update_many(self, filter, update, upsert=False):
+        with self.database.transaction() as conn:
+            return self._update(conn, filter, update, upsert, multi=True)
+
+    def replace_one(self, filter, replacement, upsert=False):
+        if any(k.startswith("$") for k in replacement):
+            raise ValueError("replacement can not include $ operators")
+        with self.database.transaction() as conn:
+            return self._update(conn, filter, replacement, upsert, multi=False)
+
+    def delete_one(self, filter):
+        with self.database.transaction() as conn:
+            return self._delete(conn, filter, multi=False)
+
+    def delete_many(self, filter):
+        with self.database.transaction() as conn:
+            return self._delete(conn, filter, multi=True)
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                            return_document=ReturnDocument.BEFORE, **kwargs):
+        with self.database.transaction() as conn:
+            docs = self._select(conn, filter, sort=sort, limit=1)
+            if docs:
+                before = docs[0]
+                after = _apply_update(_loads(_dumps(before)), update)
+                self._write(conn, after)
+            elif upsert:
+                before = None
+                after = self._upsert(conn, filter, update)
+            else:
+                return None
+        doc = after if return_document == ReturnDocument.AFTER else before
+        return _project(doc, projection) if doc is not None and projection is not None else doc
+
+    def bulk_write(self, requests, ordered=True):
+        counts = {"inserted_count": 0, "matched_count": 0, "modified_count": 0,
+                  "deleted_count": 0, "upserted_ids": {}}
+        with self.database.transaction() as conn:
+            for i, request in enumerate(requests):
+                if isinstance(request, InsertOne):
+                    self._insert(conn, request._doc)
+                    counts["inserted_count"] += 1
+                    continue
+                if isinstance(request, (DeleteOne, DeleteMany)):
+                    result = self._delete(conn, request._filter, isinstance(request, DeleteMany))
+                    counts["deleted_count"] += result.deleted_count
+                    continue
+                if not isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+                    raise TypeError("Unsupported bulk write operation {}".format(request))
+                result = self._update(conn, request._filter, request._doc, request._upsert,
+                                      isinstance(request, UpdateMany))
+                counts["matched_count"] += result.matched_count
+                counts["modified_count"] += result.modified_count
+                if result.upserted_id is not None:
+                    counts["upserted_ids"][i] = result.upserted_id
+        return _Result(upserted_count=len(counts["upserted_ids"]), **counts)
+
+    def create_index(self, keys, unique=False, **kwargs):
+        """
+        Create an index, copying the indexed fields to columns of the table.
+
+        Args:
+            keys (str or [(str, int)]): the field, or the fields and directions
+            unique (bool): whether the index is unique
+
+        Returns:
+            (str) name of the index
+        """
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        name = "_".join("{}_{}".format(k, d) for k, d in keys)
+        with self.database.transaction() as conn:
+            self._ensure_table(conn)
+            columns = self.database.index_columns(self.name, refresh=True)
+            new = [k for k, d in keys if k not in columns]
+            for key in new:
+                conn.execute("ALTER TABLE {} ADD COLUMN {}".format(self._table, _quote("$" + key)))
+            if new:
+                columns = self.database.index_columns(self.name, refresh=True)
+                for row_id, text in conn.execute(
+                        "SELECT id, doc FROM {}".format(self._table)).fetchall():
+                    doc = _loads(text)
+                    conn.execute("UPDATE {} SET {} WHERE id = ?".format(
+                        self._table, ", ".join("{} = ?".format(_quote("$" + k)) for k in new)),
+                        [_column_value(doc, k) for k in new] + [row_id])
+            conn.execute("CREATE {}INDEX IF NOT EXISTS {} ON {} ({})".format(
+                "UNIQUE " if unique else "", _quote("{}.{}".format(self.name, name)), self._table,
+                ", ".join("{} {}".format(_quote("$" + k), "DESC" if d == -1 else "ASC")
+                          for k, d in keys)))
+        return name
+
+    def drop(self):
+        with self.database.transaction() as conn:
+            conn.execute("DROP TABLE IF EXISTS {}".format(self._table))
+        self.database._columns.pop(self.name, None)
+
+    def _ensure_table(self, conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS {} (id TEXT PRIMARY KEY, doc TEXT NOT NULL)".format(
+            self._table))
+
+    def _select(self, conn, filter, sort=None, skip=0, limit=0, projection=None):
+        """
+        Matching documents, in a transaction.
+        """
+        docs = list(self._iter(conn, filter, None if sort else skip, None if sort else limit))
+        if sort:
+            docs = _sort(docs, sort)[skip:skip + limit if limit else None]
+        return [_project(d, projection) for d in docs] if projection is not None else docs
+
+    def _iter(self, conn, filter, skip=0, limit=0):
+        """
+        Generate the matching documents, with the indexed conditions of the
+        query evaluated by SQLite.
+        """
+        filter = filter or {}
+        where, params = _pushdown(filter, self.database.index_columns(self.name))
+        sql = "SELECT doc FROM {}".format(self._table)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        try:
+            cursor = conn.execute(sql, params)
+        except sqlite3.OperationalError as e:
+            if "no such table" in str(e):
+                return
+            if "no such column" not in str(e):
+                raise
+            # the table was recreated by another process
+            where, params = _pushdown(filter, self.database.index_columns(self.name, refresh=True))
+            cursor = conn.execute(sql.split(" WHERE ")[0] + (
+                " WHERE " + " AND ".join(where) if where else ""), params)
+        try:
+            found = 0
+            while True:
+                rows = cursor.fetchmany(100)
+                if not rows:
+                    return
+                for (text,) in rows:
+                    doc = _loads(text)
+                    if not _matches(doc, filter):
+                        continue
+                    found += 1
+                    if skip and found <= skip:
+                        continue
+                    yield doc
+                    if limit and found >= limit + (skip or 0):
+                        return
+        finally:
+            cursor.close()
+
+    def _insert(self, conn, document):
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        self._ensure_table(conn)
+        self._write(conn, document, new=True)
+
+    def _write(self, conn, doc, new=False):
+        columns = self.database.index_columns(self.name)
+        names = ["id", "doc"] + [_quote("$" + k) for k in columns]
+        values = [_dumps(doc["_id"]), _dumps(doc)] + [_column_value(doc, k) for k in columns]
+        try:
+            if new:
+                conn.execute("INSERT INTO {} ({}) VALUES ({})".format(
+                    self._table, ", ".join(names), ", ".join("?" * len(names))), values)
+            else:
+                conn.execute("UPDATE {} SET {} WHERE id = ?".format(
+                    self._table, ", ".join("{} = ?".format(n) for n in names[1:])),
+                    values[1:] + values[:1])
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError("Duplicate key in {}: {}".format(self.full_name, e))
+        except sqlite3.OperationalError as e:
+            if "no such column" not in str(e):
+                raise
+            self.database.index_columns(self.name, refresh=True)
+            self._write(conn, doc, new)
+
+    def _update(self, conn, filter, update, upsert, multi):
+        docs = self._select(conn, filter, limit=0 if multi else 1)
+        modified = 0
+        for doc in docs:
+            before = _dumps(doc)
+            new = _apply_update(doc, update)
+            if _dumps(new) != before:
+                self._write(conn, new)
+                modified += 1
+        upserted_id = None
+        if not docs and upsert:
+            upserted_id = self._upsert(conn, filter, update)["_id"]
+        return _Result(matched_count=len(docs), modified_count=modified, upserted_id=upserted_id)
+
+    def _upsert(self, conn, filter, update):
+        doc = {}
+        for key, cond in (filter or {}).items():
+            if key.startswith("$"):
+                continue
+            if _is_operator(cond):
+                if "$eq" not in cond:
+                    continue
+                cond = cond["$eq"]
+            _set(doc, key, cond)
+        doc = _apply_update(doc, update, insert=True)
+        self._insert(conn, doc)
+        return doc
+
+    def _delete(self, conn, filter, multi):
+        docs = self._select(conn, filter, limit=0 if multi else 1)
+        for doc in docs:
+            conn.execute("DELETE FROM {} WHERE id = ?".format(self._table), [_dumps(doc["_id"])])
+        return _Result(deleted_count=len(docs))
+
+
+class EmbeddedCursor(object):
+    """
+    Cursor over the results of a query, with the interface of a pymongo Cursor.
+    """
+
+    def __init__(self, collection, filter=None, projection=None, skip=0, limit=0, sort=None):
+        self.collection = collection
+        self._filter = filter or {}
+        self._projection = projection
+        self._skip = skip
+        self._limit = limit
+        self._sort = _sort_spec(sort) if sort else None
+        self._docs = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _sort_spec(key_or_list, direction)
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        conn = self.collection.database.connection()
+        if with_limit_and_skip:
+            return len(self.collection._select(conn, self._filter, skip=self._skip,
+                                               limit=self._limit))
+        return sum(1 for _ in self.collection._iter(conn, self._filter))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._docs is None:
+            conn = self.collection.database.connection()
+            if self._sort:
+                self._docs = iter(self.collection._select(conn, self._filter, self._sort,
+                                                          self._skip, self._limit))
+            else:
+                self._docs = self.collection._iter(conn, self._filter, self._skip, self._limit)
+        doc = next(self._docs)
+        return _project(doc, self._projection) if self._projection is not None else doc
+
+    next = __next__
+
+    def close(self):
+        if hasattr(self._docs, "close"):
+            self._docs.close()
+
+
+class EmbeddedGridFS(object):
+    """
+    GridFS collection with the interface of gridfs.GridFS: the files are
+    stored in a directory, and their documents in the "<collection>.files"
+    collection.
+    """
+
+    def __init__(self, database, collection="fs"):
+        """
+        Args:
+            database (EmbeddedDatabase): the database
+            collection (str): the GridFS collection name
+        """
+        self.database = database
+        self.files = database["{}.files".format(collection)]
+        self.directory = os.path.join(database.files_dir, collection)
+
+    def new_file(self, **kwargs):
+        return EmbeddedGridIn(self, **kwargs)
+
+    def put(self, data, **kwargs):
+        with self.new_file(**kwargs) as f:
+            f.write(data)
+        return f._id
+
+    def get(self, file_id):
+        doc = self.files.find_one({"_id": file_id})
+        if doc is None:
+            raise NoFile("no file in gridfs collection {} with _id {}".format(self.files.name, file_id))
+        f = open(self.path(file_id), "rb")
+        f._id = file_id
+        f.length = doc["length"]
+        f.upload_date = doc["uploadDate"]
+        f.metadata = doc.get("metadata")
+        return f
+
+    def exists(self, file_id):
+        return self.files.find_one({"_id": file_id}, ["_id"]) is not None
+
+    def delete(self, file_id):
+        self.files.delete_one({"_id": file_id})
+        try:
+            os.remove(self.path(file_id))
+        except OSError:
+            pass
+
+    def path(self, file_id):
+        """
+        Path of the file with the given id.
+        """
+        return os.path.join(self.directory, str(file_id))
+
+
+class EmbeddedGridIn(object):
+    """
+    Writable GridFS file, published when it is closed.
+    """
+
+    def __init__(self, fs, _id=None, **kwargs):
+        self._fs = fs
+        self._id = _id if _id is not None else ObjectId()
+        self._kwargs = kwargs
+        os.makedirs(fs.directory, exist_ok=True)
+        self._tmp = "{}.{}.tmp".format(fs.path(self._id), os.getpid())
+        self._file = open(self._tmp, "wb")
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode(self._kwargs.get("encoding", "utf-8"))
+        self._file.write(data)
+
+    def close(self):
+        if self._file.closed:
+            return
+        length = self._file.tell()
+        self._file.close()
+        if self._fs.exists(self._id):
+            os.remove(self._tmp)
+            raise FileExists("file with _id {} already exists".format(self._id))
+        os.replace(self._tmp, self._fs.path(self._id))
+        doc = dict(self._kwargs, _id=self._id, length=length,
+                   uploadDate=datetime.datetime.utcnow())
+        doc.pop("encoding", None)
+        self._fs.files.insert_one(doc)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def _quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _dumps(value):
+    return json_util.dumps(value, json_options=_JSON_OPTIONS)
+
+
+def _loads(text):
+    return json_util.loads(text, json_options=_JSON_OPTIONS)
+
+
+def _is_operator(cond):
+    return isinstance(cond, dict) and len(cond) > 0 and all(k.startswith("$") for k in cond)
+
+
+def _sql_value(value):
+    """
+    Value of an indexed column for a field value, None if it is not a scalar.
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, int):
+        return value if -2 ** 63 <= value < 2 ** 63 else None
+    if isinstance(value, (float, str)):
+        return value
+    if isinstance(value, datetime.datetime):
+        if value.utcoffset() is not None:
+            value = value.replace(tzinfo=None) - value.utcoffset()
+        # milliseconds, the precision of the stored dates
+        return calendar.timegm(value.timetuple()) * 1000 + value.microsecond // 1000
+    return None
+
+
+def _column_value(doc, key):
+    values = _lookup(doc, key.split("."))
+    return _sql_value(values[0]) if len(values) == 1 else None
+
+
+def _pushdown(query, columns):
+    """
+    SQL conditions of the conditions of a query on indexed fields. They select
+    a superset of the matching documents: a document whose field is not a
+    scalar has a NULL column, and is then matched by the query itself.
+    """
+    where, params = [], []
+    for key, cond in query.items():
+        if key == "_id":
+            values = cond.get("$in") if _is_operator(cond) and list(cond) == ["$in"] else [cond]
+            if values and all(isinstance(v, (ObjectId, str)) for v in values):
+                where.append("id IN ({})".format(", ".join("?" * len(values))))
+                params.extend(_dumps(v) for v in values)
+            continue
+        if key not in columns:
+            continue
+        column = _quote("$" + key)
+        for op, arg in (cond.items() if _is_operator(cond) else [("$eq", cond)]):
+            if op == "$in":
+                values = [_sql_value(a) for a in arg]
+                if values and all(v is not None for v in values):
+                    where.append("({0} IN ({1}) OR {0} IS NULL)".format(
+                        column, ", ".join("?" * len(values))))
+                    params.extend(values)
+            elif op in ("$eq", "$gt", "$gte", "$lt", "$lte") and _sql_value(arg) is not None:
+                sql_op = {"$eq": "=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}[op]
+                where.append("({0} {1} ? OR {0} IS NULL)".format(column, sql_op))
+                params.append(_sql_value(arg))
+    return where, params
+
+
+def _lookup(value, keys):
+    """
+    Values at a path in a document, traversing the arrays as MongoDB does.
+    """
+    if not keys:
+        return [value]
+    key, rest = keys[0], keys[1:]
+    if isinstance(value, dict):
+        return _lookup(value[key], rest) if key in value else []
+    if isinstance(value, list):
+        found = []
+        if key.isdigit() and int(key) < len(value):
+            found.extend(_lookup(value[int(key)], rest))
+        for v in value:
+            if isinstance(v, dict):
+                found.extend(_lookup(v, keys))
+        return found
+    return []
+
+
+def _expand(values):
+    """
+    Values and the elements of the array values.
+    """
+    expanded = []
+    for v in values:
+        expanded.append(v)
+        if isinstance(v, list):
+            expanded.extend(v)
+    return expanded
+
+
+def _equal(a, b):
+    if isinstance(a, bool) or isinstance(b, bool):
+        return isinstance(a, bool) and isinstance(b, bool) and a == b
+    return a == b
+
+
+def _type_bracket(value):
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    return type(value).__name__
+
+
+def _compare(value, arg, op):
+    if _type_bracket(value) != _type_bracket(arg):
+        return False
+    try:
+        return {"$gt": value > arg, "$gte": value >= arg, "$lt": value < arg,
+                "$lte": value <= arg}[op]
+    except TypeError:
+        return False
+
+
+def _has_type(value, type_):
+    type_ = _TYPE_CODES.get(type_, type_)
+    if type_ == "number":
+        return _type_bracket(value) == "number"
+    checks = {"double": float, "string": str, "object": dict, "array": list,
+              "objectId": ObjectId, "date": datetime.datetime, "null": type(None)}
+    if type_ in checks:
+        return isinstance(value, checks[type_]) and not isinstance(value, bool)
+    if type_ == "bool":
+        return isinstance(value, bool)
+    if type_ in ("int", "long"):
+        return isinstance(value, int) and not isinstance(value, bool)
+    raise ValueError("Unsupported $type {}".format(type_))
+
+
+def _regex(pattern, options=""):
+    if isinstance(pattern, _PATTERN_TYPE):
+        return pattern
+    flags = 0
+    for option, flag in [("i", re.I), ("m", re.M), ("s", re.S), ("x", re.X)]:
+        if option in options:
+            flags |= flag
+    return re.compile(pattern, flags)
+
+
+def _match_op(values, op, arg, cond):
+    if op == "$eq":
+        if isinstance(arg, _PATTERN_TYPE):
+            return _match_op(values, "$regex", arg, {})
+        return any(_equal(v, arg) for v in _expand(values)) or (arg is None and not values)
+    if op == "$ne":
+        return not _match_op(values, "$eq", arg, cond)
+    if op in ("$gt", "$gte", "$lt", "$lte"):
+        return any(_compare(v, arg, op) for v in _expand(values))
+    if op == "$in":
+        return any(_match_op(values, "$eq", a, cond) for a in arg)
+    if op == "$nin":
+        return not _match_op(values, "$in", arg, cond)
+    if op == "$all":
+        return all(_match_op(values, "$eq", a, cond) for a in arg)
+    if op == "$exists":
+        return bool(values) == bool(arg)
+    if op == "$regex":
+        pattern = _regex(arg, cond.get("$options", ""))
+        return any(isinstance(v, str) and pattern.search(v) for v in _expand(values))
+    if op == "$options":
+        return True
+    if op == "$not":
+        return not _match_condition(values, arg)
+    if op == "$size":
+        return any(isinstance(v, list) and len(v) == arg for v in values)
+    if op == "$type":
+        return any(_has_type(v, arg) for v in _expand(values))
+    if op == "$elemMatch":
+        return any(isinstance(v, list) and any(
+            _matches(e, arg) if isinstance(e, dict) and not _is_operator(arg)
+            else _match_condition([e], arg) for e in v) for v in values)
+    raise ValueError("Unsupported query operator {}".format(op))
+
+
+def _match_condition(values, cond):
+    if _is_operator(cond):
+        return all(_match_op(values, op, arg, cond) for op, arg in cond.items())
+    return _match_op(values, "$eq", cond, {})
+
+
+def _matches(doc, query):
+    """
+    Whether a document matches a query.
+    """
+    for key, cond in query.items():
+        if key == "$and":
+            if not all(_matches(doc, q) for q in cond):
+                return False
+        elif key == "$or":
+            if not any(_matches(doc, q) for q in cond):
+                return False
+        elif key == "$nor":
+            if any(_matches(doc, q) for q in cond):
+                return False
+        elif key.startswith("$"):
+            raise ValueError("Unsupported query operator {}".format(key))
+        elif not _match_condition(_lookup(doc, key.split(".")), cond):
+            return False
+    return True
+
+
+def _sort_spec(key_or_list, direction=None):
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    return list(key_or_list)
+
+
+def _sort(docs, sort):
+    """
+    Sort documents in the order of MongoDB: missing and null values first,
+    then numbers, strings, documents, arrays, ObjectIds, booleans and dates.
+    """
+    ranks = {"NoneType": 0, "number": 1, "string": 2, "dict": 3, "list": 4, "ObjectId": 5,
+             "bool": 6, "datetime": 7}
+
+    def key(doc, field):
+        values = _lookup(doc, field.split("."))
+        value = values[0] if values else None
+        rank = ranks.get(_type_bracket(value), 8)
+        return (rank, value) if rank in (1, 2, 5, 6, 7) else (rank, _dumps(value))
+
+    for field, direction in reversed(_sort_spec(sort)):
+        docs.sort(key=lambda d: key(d, field), reverse=direction == -1)
+    return docs
+
+
+def _project(doc, projection):
+    """
+    Apply a projection (list of fields, or dict of included or excluded
+    fields and $slice operators) to a document.
+    """
+    if isinstance(projection, (list, tuple)):
+        projection = {k: 1 for k in projection}
+    slices = {k: v["$slice"] for k, v in projection.items() if isinstance(v, dict)}
+    included = [k for k, v in projection.items() if not isinstance(v, dict) and v and k != "_id"]
+    excluded = [k for k, v in projection.items() if not isinstance(v, dict) and not v]
+    if included or (projection.get("_id") and not excluded and not slices):
+        projected = _include(doc, [k.split(".") for k in included + list(slices)])
+        if projection.get("_id", 1) and "_id" in doc:
+            projected["_id"] = doc["_id"]
+    else:
+        projected = doc
+        for k in excluded:
+            _unset(projected, k)
+    for k, s in slices.items():
+        parent, key = _parent(projected, k, create=False)
+        if isinstance(parent, dict) and isinstance(parent.get(key), list):
+            skip, limit = (s if s >= 0 else len(parent[key]) + s, abs(s)) if isinstance(s, int) \
+                else (s[0] if s[0] >= 0 else max(len(parent[key]) + s[0], 0), s[1])
+            parent[key] = parent[key][max(skip, 0):max(skip, 0) + limit]
+    return projected
+
+
+def _include(value, paths):
+    if isinstance(value, list):
+        return [_include(v, paths) for v in value if isinstance(v, (dict, list))]
+    projected = {}
+    for key in value:
+        sub = [p[1:] for p in paths if p[0] == key]
+        if not sub:
+            continue
+        if any(not p for p in sub):
+            projected[key] = value[key]
+        elif isinstance(value[key], (dict, list)):
+            projected[key] = _include(value[key], sub)
+    return projected
+
+
+def _parent(doc, path, create=True):
+    """
+    Container of the last key of a path, and that key (an int for arrays).
+    """
+    keys = path.split(".")
+    target = doc
+    for key in keys[:-1]:
+        if isinstance(target, list):
+            key = int(key)
+            if key >= len(target):
+                if not create:
+                    return None, None
+                target.extend([None] * (key + 1 - len(target)))
+            if target[key] is None and create:
+                target[key] = {}
+        elif key not in target:
+            if not create:
+                return None, None
+            target[key] = {}
+        target = target[key]
+        if not isinstance(target, (dict, list)):
+            if create:
+                raise ValueError("Cannot create field {} in {}".format(path, target))
+            return None, None
+    key = keys[-1]
+    if isinstance(target, list):
+        key = int(key)
+    return target, key
+
+
+def _get(doc, path, default=None):
+    parent, key = _parent(doc, path, create=False)
+    try:
+        return parent[key]
+    except (TypeError, KeyError, IndexError):
+        return default
+
+
+def _set(doc, path, value):
+    parent, key = _parent(doc, path)
+    if isinstance(parent, list) and key >= len(parent):
+        parent.extend([None] * (key + 1 - len(parent)))
+    parent[key] = value
+
+
+def _unset(doc, path):
+    parent, key = _parent(doc, path, create=False)
+    if isinstance(parent, dict):
+        parent.pop(key, None)
+    elif isinstance(parent, list) and key < len(parent):
+        parent[key] = None
+
+
+def _apply_update(doc, update, insert=False):
+    """
+    Apply an update (with $ operators) or a replacement to a document.
+    """
+    if not any(k.startswith("$") for k in update):
+        replaced = dict(update)
+        if "_id" in doc:
+            replaced["_id"] = doc["_id"]
+        return replaced
+    missing = object()
+    for op, fields in update.items():
+        for path, arg in fields.items():
+            current = _get(doc, path, missing)
+            if op == "$set":
+                _set(doc, path, arg)
+            elif op == "$setOnInsert":
+                if insert:
+                    _set(doc, path, arg)
+            elif op == "$unset":
+                _unset(doc, path)
+            elif op == "$inc":
+                _set(doc, path, arg if current is missing else current + arg)
+            elif op == "$mul":
+                _set(doc, path, 0 if current is missing else current * arg)
+            elif op in ("$max", "$min"):
+                if current is missing or _compare(arg, current, "$gt" if op == "$max" else "$lt"):
+                    _set(doc, path, arg)
+            elif op in ("$push", "$addToSet"):
+                items = arg["$each"] if isinstance(arg, dict) and "$each" in arg else [arg]
+                array = [] if current is missing else current
+                for item in items:
+                    if op == "$push" or not any(_equal(item, a) for a in array):
+                        array.append(item)
+                _set(doc, path, array)
+            elif op == "$pull":
+                if isinstance(current, list):
+                    _set(doc, path, [a for a in current if not _match_condition([a], arg)])
+            elif op == "$rename":
+                if current is not missing:
+                    _unset(doc, path)
+                    _set(doc, arg, current)
+            else:
+                raise ValueError("Unsupported update operator {}".format(op))
+    return doc
@@ -0,0 +1,303 @@
+# coding: utf-8
+
+
+"""
+This module defines a bulk ingestion engine that parses many calculation
+directories with a drone and inserts the task documents into a CalcDb.
+"""
+
+import json
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from atomate.utils.utils import get_logger, get_uri, get_fingerprint
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+logger = get_logger(__name__)
+
+
+def _assimilate(drone, path, fingerprint=None, patterns=None):
+    """
+    Assimilate a directory in a worker process. Errors are returned rather
+    than raised, so that a bad directory does not stop the batch.
+
+    If patterns is set, the fingerprint of the directory is computed and
+    compared to the stored fingerprint first: a directory whose files have the
+    same sizes and modification times, or failing that the same content hash
+    of the key outputs, is not parsed again.
+
+    Returns:
+        (path, state, result): state is "parsed" (result is the task doc),
+            "unchanged" (result is the current fingerprint) or "failed" (result
+            is the error message)
+    """
+    try:
+        new_fingerprint = None
+        if patterns is not None:
+            new_fingerprint = get_fingerprint(path, patterns, stored=fingerprint)
+            if fingerprint and fingerprint["hash"] == new_fingerprint["hash"]:
+                return path, "unchanged", new_fingerprint
+        doc = drone.assimilate(path)
+        if new_fingerprint:
+            doc["fingerprint"] = new_fingerprint
+        return path, "parsed", doc
+    except Exception:
+        return path, "failed", traceback.format_exc()
+
+
+class BulkIngester(object):
+    """
+    Ingest a directory tree of calculations into a database. The valid run
+    directories are found with drone.get_valid_paths, assimilated in a pool
+    of worker processes and inserted in batches. The outcome of every directory
+    is appended to a checkpoint file once its batch has been written, so an
+    interrupted ingestion resumes where it stopped.
+
+    Documents are inserted a batch at a time with db.insert_tasks, except the
+    ones that db.needs_insert_task reports as needing db.insert_task, e.g. the
+    documents whose large data VaspCalcDb moves to GridFS. A database with an
+    insert_task method but no needs_insert_task inserts every document with
+    insert_task.
+
+    With skip_unchanged, a fingerprint of every directory (file sizes, mtimes
+    and the content hash of the key outputs given by drone.fingerprint_patterns)
+    is stored in its task doc, and directories whose fingerprint matches the
+    stored one are not parsed again on re-ingestion.
+    """
+
+    def __init__(self, drone, db, checkpoint_file=None, nworkers=None, batch_size=50,
+                 insert_kwargs=None, skip_unchanged=False):
+        """
+        Args:
+            drone (AbstractDrone): drone used to parse the directories
+            db (CalcDb): database to insert the task documents into
+            checkpoint_file (str): path to the checkpoint file (JSON lines). If
+                it exists, the directories recorded as inserted or skipped in it
+                are not parsed again. Default: no checkpointing.
+            nworkers (int): number of worker processes. Default: number of cpus.
+                Set to 1 to parse in the current process.
+            batch_size (int): number of task documents written per batch
+            insert_kwargs (dict): keyword arguments for the insertion, e.g.
+                {"use_gridfs": True}
+            skip_unchanged (bool): whether to fingerprint the directories and
+                skip the ones that did not change since they were inserted
+        """
+        self.drone = drone
+        self.db = db
+        self.checkpoint_file = checkpoint_file
+        self.nworkers = nworkers or os.cpu_count()
+        self.batch_size = batch_size
+        self.insert_kwargs = insert_kwargs or {}
+        self.skip_unchanged = skip_unchanged
+
+    def get_valid_paths(self, rootpath):
+        """
+        Walk the directory tree and collect the run directories recognized by
+        the drone.
+
+        Args:
+            rootpath (str): root of the directory tree
+
+        Returns:
+            ([str]): run directories
+        """
+        paths = []
+        for parent, subdirs, files in os.walk(rootpath):
+            paths.extend(self.drone.get_valid_paths((parent, subdirs, files)))
+        return paths
+
+    def load_checkpoint(self):
+        """
+        Read the checkpoint file.
+
+        Returns:
+            (dict): path -> last recorded outcome, a dict with the keys "path",
+                "state" ("inserted", "skipped", "unchanged" or "failed"), "task_id"
+                and "error"
+        """
+        records = {}
+        if self.checkpoint_file and os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        record = json.loads(line)
+                        records[record["path"]] = record
+        return records
+
+    def run(self, rootpath=None, paths=None):
+        """
+        Ingest the run directories under rootpath, or the given paths.
+        Directories already inserted or skipped according to the checkpoint
+        file are left out; failed ones are tried again.
+
+        Args:
+            rootpath (str): root of the directory tree to ingest
+            paths ([str]): run directories to ingest, instead of walking rootpath
+
+        Returns:
+            (dict): summary with the keys "inserted" (path -> task_id),
+                "skipped" (list of paths of duplicates that were not updated),
+                "unchanged" (list of paths not parsed again because their
+                fingerprint matched) and "failed" (path -> error message)
+        """
+        if paths is None:
+            paths = self.get_valid_paths(rootpath)
+        done = {p for p, r in self.load_checkpoint().items() if r["state"] != "failed"}
+        todo = [p for p in paths if p not in done]
+        logger.info("Ingesting {} directories ({} already done)".format(
+            len(todo), len(paths) - len(todo)))
+
+        summary = {"inserted": {}, "skipped": [], "unchanged": [], "failed": {}}
+        batch = []
+        for path, state, result in self._assimilate_all(todo):
+            if state == "unchanged":
+                record = self._update_fingerprint(path, result)
+                if record:
+                    self._record(summary, [record])
+                    continue
+                logger.warning("The task of {} was removed since its fingerprint was read, "
+                               "parsing it again".format(path))
+                path, state, result = _assimilate(
+                    self.drone, path, patterns=getattr(self.drone, "fingerprint_patterns", ("*",)))
+            if state == "failed":
+                logger.error("Failed to assimilate {}:\n{}".format(path, result))
+                self._record(summary, [{"path": path, "state": "failed", "error": result}])
+                continue
+            batch.append((path, result))
+            if len(batch) >= self.batch_size:
+                self._record(summary, self._insert_batch(batch))
+                batch = []
+        if batch:
+            self._record(summary, self._insert_batch(batch))
+
+        logger.info("Inserted {}, skipped {}, unchanged {}, failed {} directories".format(
+            len(summary["inserted"]), len(summary["skipped"]), len(summary["unchanged"]),
+            len(summary["failed"])))
+        return summary
+
+    def get_dir_name(self, path):
+        """
+        The dir_name the drone sets in the task doc of a run directory.
+        """
+        if getattr(self.drone, "use_full_uri", False):
+            return get_uri(path)
+        return os.path.abspath(path)
+
+    def get_stored_fingerprints(self, paths, chunk_size=1000):
+        """
+        Fingerprints stored in the database for the given run directories.
+
+        Returns:
+            (dict): path -> fingerprint, for the paths that have one
+        """
+        fingerprints = {}
+        for i in range(0, len(paths), chunk_size):
+            dir_names = {self.get_dir_name(p): p for p in paths[i:i + chunk_size]}
+            for doc in self.db.collection.find({"dir_name": {"$in": list(dir_names)},
+                                                "fingerprint": {"$exists": True}},
+                                               ["dir_name", "fingerprint"]):
+                fingerprints[dir_names[doc["dir_name"]]] = doc["fingerprint"]
+        return fingerprints
+
+    def _update_fingerprint(self, path, fingerprint):
+        """
+        Store the current fingerprint of an unchanged directory (its mtimes
+        may differ from the stored ones) and return the outcome record, or
+        None if its task document is no longer in the database.
+        """
+        result = self.db.collection.find_one_and_update(
+            {"dir_name": self.get_dir_name(path)}, {"$set": {"fingerprint": fingerprint}},
+            projection=["task_id"])
+        if result is None:
+            return None
+        return {"path": path, "state": "unchanged", "task_id": result["task_id"]}
+
+    def _assimilate_all(self, paths):
+        """
+        Yield (path, state, result) for the given paths, see _assimilate. At
+        most twice as many directories as there are workers are in flight, so
+        that parsed documents do not pile up in memory while a batch is written.
+        """
+        fingerprints = {}
+        patterns = None
+        if self.skip_unchanged:
+            fingerprints = self.get_stored_fingerprints(paths)
+            patterns = getattr(self.drone, "fingerprint_patterns", ("*",))
+
+        if self.nworkers == 1:
+            for path in paths:
+                yield _assimilate(self.drone, path, fingerprints.get(path), patterns)
+            return
+
+        with ProcessPoolExecutor(max_workers=self.nworkers) as executor:
+            pending = set()
+            for path in paths:
+                pending.add(executor.submit(_assimilate, self.drone, path,
+                                            fingerprints.get(path), patterns))
+                if len(pending) >= 2 * self.nworkers:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        yield future.result()
+            for future in pending:
+                yield future.result()
+
+    def _insert_batch(self, batch):
+        """
+        Insert a batch of (path, doc) and return the records of the outcomes.
+        """
+        insert = getattr(self.db, "insert_task", None)
+        bulk_kwargs = self.insert_kwargs
+        single = []
+        if insert is not None:
+            # insert_tasks only takes the options of insert
+            bulk_kwargs = {k: v for k, v in self.insert_kwargs.items() if k == "update_duplicates"}
+            needs_insert_task = getattr(self.db, "needs_insert_task", lambda doc, **kwargs: True)
+            single = [(path, doc) for path, doc in batch
+                      if needs_insert_task(doc, **self.insert_kwargs)]
+            batch = [(path, doc) for path, doc in batch
+                     if not needs_insert_task(doc, **self.insert_kwargs)]
+
+        records = []
+        if batch and hasattr(self.db, "insert_tasks"):
+            try:
+                task_ids = self.db.insert_tasks([doc for path, doc in batch], **bulk_kwargs)
+                records = [{"path": path, "task_id": task_ids[doc["dir_name"]],
+                            "state": "inserted" if task_ids[doc["dir_name"]] is not None else "skipped"}
+                           for path, doc in batch]
+                batch = []
+            except Exception:
+                # insert the documents one by one to find the ones that fail
+                logger.warning("Bulk insertion failed, inserting the batch one document at a time")
+        for path, doc in single + batch:
+            try:
+                if insert:
+                    task_id = insert(doc, **self.insert_kwargs)
+                else:
+                    task_id = self.db.insert(doc, **self.insert_kwargs)
+                state = "inserted" if task_id is not None else "skipped"
+                records.append({"path": path, "state": state, "task_id": task_id})
+            except Exception:
+                error = traceback.format_exc()
+                logger.error("Failed to insert {}:\n{}".format(path, error))
+                records.append({"path": path, "state": "failed", "error": error})
+        return records
+
+    def _record(self, summary, records):
+        """
+        Add outcome records to the summary and append them to the checkpoint file.
+        """
+        for r in records:
+            if r["state"] == "inserted":
+                summary["inserted"][r["path"]] = r["task_id"]
+            elif r["state"] in ("skipped", "unchanged"):
+                summary[r["state"]].append(r["path"])
+            else:
+                summary["failed"][r["path"]] = r["error"]
+        if self.checkpoint_file:
+            with open(self.checkpoint_file, "a") as f:
+                for r in records:
+                    f.write(json.dumps(r) + "\n")
@@ -0,0 +1,126 @@
+# coding: utf-8
+
+
+"""
+This module defines a lightweight profiler that records the wall time and the
+peak memory of the stages of the ingestion of a calculation (parsing, symmetry
+analysis, GridFS upload, ...), and the aggregation of these profiles in a
+database collection.
+"""
+
+import sys
+import time
+from contextlib import contextmanager
+
+from pymongo import UpdateOne
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+
+def get_peak_rss():
+    """
+    Peak resident set size of the current process in MB, or None if it is
+    not available on this platform.
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kB elsewhere
+    return maxrss / 1024 ** 2 if sys.platform == "darwin" else maxrss / 1024
+
+
+class StageProfiler(object):
+    """
+    Record the wall time and the peak RSS of named stages. A stage that is
+    entered several times (e.g. "vasprun" for relax1 and relax2) accumulates
+    its time and keeps the largest peak RSS.
+
+    The peak RSS is that of the whole process at the end of the stage; the
+    growth of the peak during the stage tells which stage made it grow. In
+    worker processes, only the stages run in the worker are seen.
+    """
+
+    def __init__(self, enabled=True):
+        """
+        Args:
+            enabled (bool): whether to record anything. A disabled profiler
+                can be used in the same way at no cost.
+        """
+        self.enabled = enabled
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager timing the enclosed block as the given stage.
+        """
+        if not self.enabled:
+            yield
+            return
+        rss_start = get_peak_rss()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            rss = get_peak_rss()
+            self.add(name, {"wall_time": time.perf_counter() - start, "count": 1,
+                            "peak_rss_mb": rss,
+                            "peak_rss_growth_mb": rss - rss_start if rss is not None else None})
+
+    def add(self, name, record):
+        """
+        Add a stage record, merging it with the existing record of that stage.
+        """
+        if name not in self.stages:
+            self.stages[name] = dict(record)
+            return
+        current = self.stages[name]
+        current["wall_time"] += record["wall_time"]
+        current["count"] += record["count"]
+        for k in ["peak_rss_mb", "peak_rss_growth_mb"]:
+            if record[k] is not None:
+                current[k] = max(current[k] or 0, record[k])
+
+    def update(self, stages):
+        """
+        Merge the stage records of another profiler, e.g. one of a worker process.
+
+        Args:
+            stages (dict): stage name -> record
+        """
+        for name, record in stages.items():
+            self.add(name, record)
+
+    def as_dict(self):
+        return {"stages": self.stages,
+                "wall_time": sum(r["wall_time"] for r in self.stages.values()),
+                "peak_rss_mb": get_peak_rss()}
+
+
+def aggregate_profile(collection, profile, task_type):
+    """
+    Add a profile to the per task type statistics of a collection: for every
+    stage, the number of runs, the total and the largest wall time and the
+    largest peak RSS. The expensive stages of a task type can then be found
+    with e.g. collection.find({"task_type": "static"}).sort("total_time", -1).
+
+    Args:
+        collection (Collection): the statistics collection
+        profile (dict): profile as returned by StageProfiler.as_dict
+        task_type (str): the task type, e.g. the task_label of the task doc
+    """
+    requests = []
+    for name, record in profile["stages"].items():
+        update = {"$inc": {"count": record["count"], "total_time": record["wall_time"]},
+                  "$max": {"max_time": record["wall_time"]}}
+        if record.get("peak_rss_mb") is not None:
+            update["$max"]["max_peak_rss_mb"] = record["peak_rss_mb"]
+        requests.append(UpdateOne({"task_type": task_type, "stage": name}, update, upsert=True))
+    if requests:
+        collection.bulk_write(requests, ordered=False)
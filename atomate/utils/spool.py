@@ -0,0 +1,289 @@
+# coding: utf-8
+
+
+"""
+This module defines a local spool of task documents, for the ToDb firetasks
+of allocations whose database is slow or unreachable: the task documents are
+written, with their GridFS data in the final encoding, to embedded databases
+(see atomate.utils.embedded) in a spool directory, and a separate sync process
+drains the spool into the database in batches, retrying until it succeeds.
+"""
+
+import datetime
+import json
+import os
+import shutil
+import time
+import uuid
+
+from monty.serialization import loadfn
+from pymongo.errors import ConnectionFailure
+from gridfs.errors import FileExists
+
+from atomate.utils.embedded import close_embedded_client, get_gridfs
+from atomate.utils.utils import get_logger
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+logger = get_logger(__name__)
+
+
+class TaskSpool(object):
+    """
+    Spool directory of task documents. Every spooled task is an entry: a
+    directory holding an embedded database with the task document and its
+    GridFS files, which is published atomically once complete. The task_ids
+    are assigned by the database when the entry is synced; the dir_name ->
+    task_id of the synced entries are appended to the "synced.log" file of
+    the spool.
+
+    An entry can hold the children of the Firework that spooled it, which
+    its spooler paused: once the entry is synced, the task_id is set in
+    their spec and they are resumed, so that they never query the database
+    before the task is in it.
+
+    Run a single sync process per spool directory.
+    """
+
+    entry_suffix = ".task"
+    spool_database = "spool"
+    # collection of the embedded database of an entry holding its Firework
+    fireworks_collection = "fireworks"
+
+    def __init__(self, spool_dir, db_class, db_kwargs=None):
+        """
+        Args:
+            spool_dir (str): the spool directory, created if needed
+            db_class (class): CalcDb subclass that encodes the task documents,
+                e.g. VaspCalcDb
+            db_kwargs (dict): keyword arguments of the spooled databases, e.g.
+                the gridfs_compression of the target database
+        """
+        self.spool_dir = os.path.abspath(os.path.expanduser(spool_dir))
+        self.db_class = db_class
+        self.db_kwargs = db_kwargs or {}
+        os.makedirs(os.path.join(self.spool_dir, "failed"), exist_ok=True)
+
+    @classmethod
+    def from_db_file(cls, spool_dir, db_class, db_file):
+        """
+        Spool for the database of a db_file, whose GridFS compression policy,
+        GridFS encodings and document size budget are then used for the
+        spooled data. The database is not contacted.
+
+        Args:
+            spool_dir (str): the spool directory
+            db_class (class): CalcDb subclass, e.g. VaspCalcDb
+            db_file (str): path to the file containing the database credentials
+        """
+        creds = loadfn(db_file) if db_file else {}
+        db_kwargs = {k: creds[k] for k in ["gridfs_compression", "gridfs_encoding", "max_doc_size"]
+                     if k in creds and k in db_class.db_file_keys}
+        return cls(spool_dir, db_class, db_kwargs)
+
+    def put(self, task_doc, fw_id=None, spec_keys=None, **kwargs):
+        """
+        Spool a task document. Unless it is set in the document, the task_id
+        is assigned when the entry is synced.
+
+        Args:
+            task_doc (dict): the task document, modified as by insert_task
+            fw_id (int): id of the Firework whose paused children are resumed
+                once the entry is synced
+            spec_keys ([str]): keys of the spec of these children set to the
+                task_id
+            kwargs: keyword arguments of the insert_task method of the CalcDb
+                class, e.g. use_gridfs
+
+        Returns:
+            (str) name of the entry
+        """
+        name = "{:%Y%m%d%H%M%S%f}-{}".format(datetime.datetime.utcnow(), uuid.uuid4().hex)
+        tmp = os.path.join(self.spool_dir, ".{}.tmp".format(name))
+        db = self._open(tmp)
+        preset = task_doc.get("task_id")
+        try:
+            db.insert_task(task_doc, **kwargs)
+            if not preset:
+                db.collection.update_many({}, {"$unset": {"task_id": 1}})
+                task_doc.pop("task_id", None)
+            if fw_id is not None:
+                db.db[self.fireworks_collection].insert_one({"fw_id": fw_id,
+                                                             "spec_keys": spec_keys or []})
+        finally:
+            close_embedded_client(tmp)
+        os.rename(tmp, os.path.join(self.spool_dir, name + self.entry_suffix))
+        logger.info("Spooled {} as {}".format(task_doc.get("dir_name"), name))
+        return name
+
+    def entries(self):
+        """
+        Names of the entries, oldest first.
+        """
+        return sorted(f[:-len(self.entry_suffix)] for f in os.listdir(self.spool_dir)
+                      if f.endswith(self.entry_suffix))
+
+    def sync(self, target, batch_size=50, launchpad=None):
+        """
+        Move the spooled tasks to the database, a batch at a time: the
+        task_ids of a batch are assigned with a single query and counter
+        update, the GridFS files are copied as they are, then the task
+        documents are written with one bulk write. Of several entries of a
+        batch with the same dir_name, the newest one is written. Once the
+        task documents are written, the children held by the entries are
+        resumed, then the entries are removed. If the database can not be
+        reached, the sync stops and the remaining entries stay in the spool;
+        an entry that fails otherwise is moved to the "failed" directory of
+        the spool.
+
+        Args:
+            target (CalcDb): the database
+            batch_size (int): number of entries per batch
+            launchpad (LaunchPad): the launchpad of the Fireworks held by the
+                entries. Without it, these entries stay in the spool.
+
+        Returns:
+            (dict): dir_name -> task_id of the synced tasks
+
+        Raises:
+            ConnectionFailure: if the database can not be reached
+        """
+        synced = {}
+        names = self.entries()
+        for i in range(0, len(names), batch_size):
+            batch = names[i:i + batch_size]
+            try:
+                synced.update(self._sync_batch(target, batch, launchpad))
+            except ConnectionFailure:
+                raise
+            except Exception as e:
+                # find the bad entries
+                logger.warning("Syncing a batch failed ({}), syncing its entries one at a "
+                               "time".format(e))
+                for name in batch:
+                    try:
+                        synced.update(self._sync_batch(target, [name], launchpad))
+                    except ConnectionFailure:
+                        raise
+                    except Exception:
+                        logger.exception("Could not sync {}, moving it to failed".format(name))
+                        close_embedded_client(self._path(name))
+                        os.rename(self._path(name), os.path.join(self.spool_dir, "failed", name))
+        return synced
+
+    def run(self, target, interval=60, batch_size=50, max_wait=3600, stop_when_empty=False,
+            launchpad=None):
+        """
+        Sync the spool repeatedly, e.g. in a sync process running alongside
+        the allocations that spool their tasks. The wait after a failure to
+        reach the database doubles with every failure, up to max_wait.
+
+        Args:
+            target (CalcDb): the database
+            interval (float): seconds between the syncs
+            batch_size (int): number of entries per batch
+            max_wait (float): longest wait, in seconds, after failures
+            stop_when_empty (bool): whether to stop once the spool is empty
+            launchpad (LaunchPad): the launchpad of the Fireworks held by the
+                entries, see sync
+
+        Returns:
+            (dict): dir_name -> task_id of the synced tasks
+        """
+        synced = {}
+        wait = interval
+        while True:
+            try:
+                synced.update(self.sync(target, batch_size, launchpad))
+                wait = interval
+            except ConnectionFailure as e:
+                wait = min(2 * wait, max_wait)
+                logger.warning("Database unreachable ({}), retrying in {} s".format(e, wait))
+            if stop_when_empty and not self.entries():
+                return synced
+            time.sleep(wait)
+
+    def _path(self, name):
+        return os.path.join(self.spool_dir, name + self.entry_suffix)
+
+    def _open(self, path):
+        return self.db_class(host=path, port=0, database=self.spool_database, collection="tasks",
+                             user=None, password=None, backend="sqlite", **self.db_kwargs)
+
+    def _sync_batch(self, target, names, launchpad=None):
+        entries, held = [], []
+        for name in names:
+            db = self._open(self._path(name))
+            fireworks = list(db.db[self.fireworks_collection].find())
+            if fireworks and launchpad is None:
+                logger.warning("{} holds Fireworks, leaving it in the spool until a launchpad "
+                               "is given".format(name))
+                close_embedded_client(self._path(name))
+                held.append(name)
+                continue
+            for doc in db.collection.find():
+                doc.pop("_id")
+                entries.append((name, db, doc, fireworks))
+        names = [name for name in names if name not in held]
+
+        # the newest entry of a dir_name is written, the older ones are superseded
+        latest = {doc["dir_name"]: (name, db, doc) for name, db, doc, _ in entries}
+        task_ids = target.assign_task_ids([doc for _, _, doc in latest.values()])
+        written = [(name, db, doc) for name, db, doc in latest.values()
+                   if task_ids[doc["dir_name"]] is not None]
+        for name, db, doc in written:
+            self._copy_files(db, target, doc["task_id"])
+        target.write_tasks([doc for _, _, doc in written])
+
+        for name, db, doc, fireworks in entries:
+            for fw in fireworks:
+                self._resume_children(launchpad, fw, task_ids[doc["dir_name"]])
+
+        with open(os.path.join(self.spool_dir, "synced.log"), "a") as f:
+            for name, db, doc, _ in entries:
+                f.write(json.dumps({"entry": name, "dir_name": doc["dir_name"],
+                                    "task_id": task_ids[doc["dir_name"]],
+                                    "superseded": latest[doc["dir_name"]][0] != name,
+                                    "synced_at": datetime.datetime.utcnow().isoformat()}) + "\n")
+        for name in names:
+            close_embedded_client(self._path(name))
+            shutil.rmtree(self._path(name))
+        logger.info("Synced {} spooled tasks".format(len(entries)))
+        return {dir_name: task_ids[dir_name] for dir_name in latest}
+
+    @staticmethod
+    def _resume_children(launchpad, fw, task_id):
+        """
+        Set the task_id in the spec of the children of a Firework held by an
+        entry, and resume them.
+        """
+        children = launchpad.get_wf_by_fw_id_lzyfw(fw["fw_id"]).links[fw["fw_id"]]
+        if fw["spec_keys"] and task_id is not None:
+            launchpad.update_spec(children, {k: task_id for k in fw["spec_keys"]})
+        for child in children:
+            launchpad.resume_fw(child)
+
+    @staticmethod
+    def _copy_files(db, target, task_id):
+        """
+        Copy the GridFS files of the spooled task of an entry, as they are
+        encoded, with the task_id assigned by the target database.
+        """
+        for files in db.db.collection_names():
+            if not files.endswith(".files"):
+                continue
+            collection = files[:-len(".files")]
+            source_fs = get_gridfs(db.db, collection)
+            target_fs = get_gridfs(target.db, collection)
+            for d in db.db[files].find():
+                metadata = dict(d.get("metadata") or {}, task_id=task_id)
+                f = source_fs.get(d["_id"])
+                try:
+                    target_fs.put(f, _id=d["_id"], metadata=metadata)
+                except FileExists:
+                    # copied by an interrupted sync, which may have assigned another task_id
+                    target.db[files].update_one({"_id": d["_id"]},
+                                                {"$set": {"metadata.task_id": task_id}})
+                finally:
+                    f.close()
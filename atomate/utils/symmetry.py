@@ -0,0 +1,183 @@
+# coding: utf-8
+
+
+"""
+This module defines a cache for the symmetry analysis of structures, so that
+the same structure is analyzed by spglib only once, whether it is seen by the
+drone, a ToDb task or a workflow generator.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from pymatgen.core.operations import SymmOp
+from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+
+from atomate.utils.utils import get_logger
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+logger = get_logger(__name__)
+
+
+def get_structure_hash(structure, decimals=6):
+    """
+    Hash of a structure that is the same for structures that spglib sees as
+    identical: the lattice, the species, the fractional coordinates wrapped to
+    [0, 1) and the magnetic moments, rounded to the given number of decimals.
+    The order of the sites is kept, since the equivalent atoms are site indices.
+
+    Args:
+        structure (Structure): the structure
+        decimals (int): number of decimals the lattice and coordinates are
+            rounded to
+
+    Returns:
+        (str): hex digest
+    """
+    lattice = np.round(structure.lattice.matrix, decimals) + 0.0
+    frac_coords = np.round(np.round(structure.frac_coords, decimals) % 1.0, decimals) + 0.0
+    sha = hashlib.sha1()
+    sha.update(lattice.tobytes())
+    sha.update(frac_coords.tobytes())
+    sha.update("|".join(site.species_string for site in structure).encode())
+    if "magmom" in structure.site_properties:
+        magmoms = [np.round(np.array(m, dtype=float), decimals) + 0.0
+                   for m in structure.site_properties["magmom"]]
+        sha.update(json.dumps([m.tolist() for m in magmoms]).encode())
+    return sha.hexdigest()
+
+
+def analyze_symmetry(structure, symprec=0.01, angle_tolerance=5.0):
+    """
+    Run the symmetry analysis of a structure with spglib.
+
+    Args:
+        structure (Structure): the structure
+        symprec (float): distance tolerance, see SpacegroupAnalyzer
+        angle_tolerance (float): angle tolerance, see SpacegroupAnalyzer
+
+    Returns:
+        (dict): symbol, number, point_group, crystal_system, hall,
+            equivalent_atoms and has_inversion; None if spglib does not find
+            the symmetry
+    """
+    sga = SpacegroupAnalyzer(structure, symprec, angle_tolerance)
+    dataset = sga.get_symmetry_dataset()
+    if not dataset:
+        return None
+    return {"symbol": sga.get_space_group_symbol(),
+            "number": sga.get_space_group_number(),
+            "point_group": sga.get_point_group_symbol(),
+            "crystal_system": sga.get_crystal_system(),
+            "hall": sga.get_hall(),
+            "equivalent_atoms": [int(i) for i in dataset["equivalent_atoms"]],
+            "has_inversion": SymmOp.inversion() in sga.get_symmetry_operations()}
+
+
+class SymmetryCache(object):
+    """
+    Cache of symmetry analyses keyed by the structure hash and the tolerances.
+    Results are kept in memory in least-recently-used order and, if cache_dir
+    is set, also stored as one JSON file per entry so that they are shared
+    between processes and runs.
+    """
+
+    def __init__(self, maxsize=1024, cache_dir=None):
+        """
+        Args:
+            maxsize (int): maximum number of entries kept in memory
+            cache_dir (str): directory of the on-disk cache. Default: no disk cache.
+        """
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_symmetry(self, structure, symprec=0.01, angle_tolerance=5.0):
+        """
+        Symmetry analysis of a structure, see analyze_symmetry. The result is
+        computed only if it is neither in memory nor on disk.
+
+        Args:
+            structure (Structure): the structure
+            symprec (float): distance tolerance, see SpacegroupAnalyzer
+            angle_tolerance (float): angle tolerance, see SpacegroupAnalyzer
+
+        Returns:
+            (dict)
+        """
+        key = "{}_{}_{}".format(get_structure_hash(structure), float(symprec),
+                                float(angle_tolerance))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        found, result = self._load(key)
+        if found:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            result = analyze_symmetry(structure, symprec, angle_tolerance)
+            self._dump(key, result)
+
+        with self._lock:
+            self._entries[key] = result
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return result
+
+    def clear(self):
+        """
+        Empty the in-memory cache and reset the statistics. The disk cache is
+        left as is.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits, self.disk_hits, self.misses = 0, 0, 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _load(self, key):
+        if not self.cache_dir or not os.path.exists(self._path(key)):
+            return False, None
+        try:
+            with open(self._path(key)) as f:
+                return True, json.load(f)
+        except (IOError, ValueError):
+            logger.warning("Ignoring unreadable symmetry cache entry {}".format(key))
+            return False, None
+
+    def _dump(self, key, result):
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = "{}.{}.tmp".format(self._path(key), os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(result, f)
+        os.replace(tmp, self._path(key))
+
+
+# cache shared by the drones, ToDb tasks and workflows of this process.
+# Set symmetry_cache.cache_dir to persist it on disk.
+symmetry_cache = SymmetryCache()
+
+
+def get_symmetry(structure, symprec=0.01, angle_tolerance=5.0):
+    """
+    Symmetry analysis of a structure through the shared symmetry cache, see
+    SymmetryCache.get_symmetry.
+    """
+    return symmetry_cache.get_symmetry(structure, symprec, angle_tolerance)
@@ -0,0 +1,64 @@
+# coding: utf-8
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from atomate.utils.blobs import write_array_blob, read_array_blob, read_blob_array, \
+    read_blob_header, memmap_blob_array
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+
+class TestBlobs(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp()
+        self.arrays = {"grid": np.random.rand(4, 5, 6),
+                       "ints": np.arange(7, dtype="int32"),
+                       "small": np.random.rand(3).astype("float32")}
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch_dir)
+
+    def test_round_trip(self):
+        f = io.BytesIO()
+        nbytes = write_array_blob(f, self.arrays, {"name": "test", "value": np.float64(1.5)})
+        self.assertEqual(nbytes, len(f.getvalue()))
+        f.seek(0)
+        meta, arrays = read_array_blob(f)
+        self.assertEqual(meta, {"name": "test", "value": 1.5})
+        for k, v in self.arrays.items():
+            self.assertEqual(arrays[k].dtype, v.dtype)
+            self.assertTrue(np.array_equal(arrays[k], v))
+
+        f.seek(0)
+        header = read_blob_header(f)
+        self.assertEqual(header["arrays"]["grid"]["shape"], [4, 5, 6])
+        self.assertTrue(np.array_equal(read_blob_array(f, "ints"), self.arrays["ints"]))
+
+        self.assertRaises(ValueError, read_blob_header, io.BytesIO(b"not a blob at all"))
+
+    def test_rows(self):
+        f = io.BytesIO()
+        write_array_blob(f, self.arrays)
+        rows = read_blob_array(f, "grid", rows=[0, 2, 3, -1])
+        self.assertTrue(np.array_equal(rows, self.arrays["grid"][[0, 2, 3, 3]]))
+        self.assertEqual(read_blob_array(f, "ints", rows=[]).shape, (0,))
+
+    def test_memmap(self):
+        filename = os.path.join(self.scratch_dir, "blob")
+        with open(filename, "wb") as f:
+            write_array_blob(f, self.arrays)
+        grid = memmap_blob_array(filename, "grid")
+        self.assertTrue(np.array_equal(grid, self.arrays["grid"]))
+        del grid
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+# coding: utf-8
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from atomate.utils.cache import ObjectCache
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+
+class TestObjectCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.reads = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def read(self, value):
+        def f():
+            self.reads.append(value)
+            return {"value": value}
+        return f
+
+    def test_memory(self):
+        cache = ObjectCache(maxsize=2)
+        self.assertEqual(cache.get("a", self.read(1)), {"value": 1})
+        self.assertEqual(cache.get("a", self.read(1)), {"value": 1})
+        cache.get("b", self.read(2))
+        cache.get("c", self.read(3))
+        # "a" was evicted
+        cache.get("a", self.read(1))
+        self.assertEqual(self.reads, [1, 2, 3, 1])
+        stats = cache.get_stats()
+        self.assertEqual((stats["hits"], stats["disk_hits"], stats["misses"]), (1, 0, 4))
+        self.assertEqual(stats["evictions"], 2)
+        self.assertAlmostEqual(stats["hit_rate"], 0.2)
+        self.assertEqual(stats["memory_entries"], 2)
+        cache.clear()
+        self.assertIsNone(cache.get_stats()["hit_rate"])
+
+    def test_threads(self):
+        cache = ObjectCache(maxsize=4)
+
+        def work(i):
+            for j in range(200):
+                cache.get(str((i * 7 + j) % 10), lambda: j)
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats = cache.get_stats()
+        self.assertEqual(stats["hits"] + stats["disk_hits"] + stats["misses"], 8 * 200)
+        self.assertEqual(stats["memory_entries"], 4)
+        self.assertLessEqual(stats["evictions"] + stats["memory_entries"], stats["misses"])
+
+    def test_disk(self):
+        cache = ObjectCache(maxsize=1, cache_dir=self.cache_dir)
+        cache.get("a", self.read(1))
+        cache.get("b", self.read(2))
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ["a.pkl", "b.pkl"])
+        self.assertEqual(cache.get("a", self.read(1)), {"value": 1})
+        self.assertEqual(self.reads, [1, 2])
+        self.assertEqual(cache.get_stats()["disk_hits"], 1)
+
+        # shared with another cache using the same directory
+        other = ObjectCache(cache_dir=self.cache_dir)
+        self.assertEqual(other.get("b", self.read(2)), {"value": 2})
+        self.assertEqual(self.reads, [1, 2])
+
+        other.clear(disk=True)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_disk_eviction(self):
+        cache = ObjectCache(maxsize=1, cache_dir=self.cache_dir, max_disk_mb=1e-6)
+        cache.get("a", self.read(1))
+        cache.get("b", self.read(2))
+        self.assertLessEqual(len(os.listdir(self.cache_dir)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
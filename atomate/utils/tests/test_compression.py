@@ -0,0 +1,46 @@
+# coding: utf-8
+
+import unittest
+
+from atomate.utils.compression import compress, decompress, parse_codec, available_codecs, \
+    benchmark_codecs, register_codec
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.data = b"".join(str(i % 97).encode() for i in range(10000))
+
+    def test_codecs(self):
+        for name in ["zlib", "bz2", "lzma"]:
+            self.assertIn(name, available_codecs())
+        for codec in ["zlib", "zlib:9", "bz2:1", "lzma:0"] + \
+                [c for c in ["lz4", "zstd:3"] if c.split(":")[0] in available_codecs()]:
+            compressed, name = compress(self.data, codec)
+            self.assertEqual(name, codec.split(":")[0])
+            self.assertLess(len(compressed), len(self.data))
+            self.assertEqual(decompress(compressed, name), self.data)
+        self.assertEqual(compress(self.data, None), (self.data, None))
+        self.assertEqual(decompress(self.data, None), self.data)
+
+    def test_parse_codec(self):
+        self.assertEqual(parse_codec("zlib"), ("zlib", 6))
+        self.assertEqual(parse_codec("lzma:1"), ("lzma", 1))
+        self.assertRaises(ValueError, parse_codec, "rar")
+        self.assertRaises(ValueError, decompress, b"", "rar")
+        register_codec("identity", lambda data, level: data, lambda data: data)
+        self.assertEqual(compress(self.data, "identity"), (self.data, "identity"))
+
+    def test_benchmark(self):
+        results = benchmark_codecs([self.data], codecs=["zlib:1", "lzma:6"], repeat=1)
+        self.assertEqual([r["codec"] for r in results], ["zlib:1", "lzma:6"])
+        for r in results:
+            self.assertGreater(r["ratio"], 1)
+            self.assertGreater(r["compress_mb_s"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
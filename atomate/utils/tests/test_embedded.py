@@ -0,0 +1,111 @@
+# coding: utf-8
+
+import datetime
+import shutil
+import tempfile
+import unittest
+
+from bson import ObjectId
+from gridfs.errors import NoFile
+from pymongo import ReturnDocument, UpdateOne, DESCENDING
+from pymongo.errors import DuplicateKeyError
+
+from atomate.utils.embedded import EmbeddedClient, get_embedded_client, get_gridfs
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+
+class TestEmbeddedDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = get_embedded_client(self.path)["vasp"]
+        self.tasks = self.db.tasks
+        self.tasks.create_index("task_id", unique=True)
+        self.tasks.create_index([("formula_pretty", 1), ("output.energy", -1)])
+        self.now = datetime.datetime.utcnow().replace(microsecond=0)
+        for i in range(1, 6):
+            self.tasks.insert_one({"task_id": i, "dir_name": "dir_{}".format(i),
+                                   "formula_pretty": "Si" if i % 2 else "Al",
+                                   "output": {"energy": -1.5 * i}, "tags": ["t{}".format(i)],
+                                   "last_updated": self.now,
+                                   "calcs_reversed": [{"x": i}, {"x": -i}]})
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.path)
+
+    def test_find(self):
+        self.assertEqual([d["task_id"] for d in self.tasks.find({"formula_pretty": "Si"}).sort(
+            "output.energy", 1)], [5, 3, 1])
+        self.assertEqual(self.tasks.find({"task_id": {"$in": [1, 2, 9]}}).count(), 2)
+        self.assertEqual(self.tasks.count_documents({"task_id": {"$gte": 4}}), 2)
+        self.assertEqual(self.tasks.find_one({"tags": "t3"})["task_id"], 3)
+        self.assertEqual(self.tasks.find_one({"calcs_reversed.x": -4})["task_id"], 4)
+        self.assertEqual(self.tasks.find_one({"dir_name": {"$regex": "_2$"}})["task_id"], 2)
+        self.assertEqual(self.tasks.find_one({"$or": [{"task_id": 9}, {"tags": "t5"}]})["task_id"], 5)
+        self.assertEqual(self.tasks.find_one({"last_updated": {"$lte": self.now}})["last_updated"],
+                         self.now)
+        self.assertEqual(self.tasks.find_one({}, ["task_id"], sort=[("task_id", DESCENDING)]),
+                         {"_id": self.tasks.find_one({"task_id": 5})["_id"], "task_id": 5})
+        self.assertEqual(self.tasks.find_one({"task_id": 2}, {"calcs_reversed.x": 1, "_id": 0}),
+                         {"calcs_reversed": [{"x": 2}, {"x": -2}]})
+        self.assertEqual(self.tasks.find_one({"task_id": 2}, {"task_id": 1, "_id": 0,
+                                                              "calcs_reversed": {"$slice": [1, 1]}}),
+                         {"task_id": 2, "calcs_reversed": [{"x": -2}]})
+        self.assertEqual(sorted(self.tasks.distinct("formula_pretty")), ["Al", "Si"])
+        self.assertEqual(len(list(self.tasks.find().skip(1).limit(2))), 2)
+
+    def test_write(self):
+        self.assertRaises(DuplicateKeyError, self.tasks.insert_one, {"task_id": 3})
+        result = self.tasks.update_one({"dir_name": "dir_9"}, {"$set": {"task_id": 9}}, upsert=True)
+        self.assertIsNotNone(result.upserted_id)
+        self.assertEqual(self.tasks.find_one({"task_id": 9}, {"_id": 0}),
+                         {"dir_name": "dir_9", "task_id": 9})
+        self.tasks.update_many({"formula_pretty": "Si"}, {"$push": {"tags": "odd"},
+                                                         "$unset": {"output": 1}})
+        self.assertEqual(self.tasks.find_one({"task_id": 3})["tags"], ["t3", "odd"])
+        self.assertNotIn("output", self.tasks.find_one({"task_id": 3}))
+
+        counter = self.db.counter
+        for _ in range(2):
+            doc = counter.find_one_and_update({"_id": "taskid"}, {"$inc": {"c": 5}}, upsert=True,
+                                              return_document=ReturnDocument.AFTER)
+        self.assertEqual(doc["c"], 10)
+
+        result = self.tasks.bulk_write([UpdateOne({"dir_name": "dir_1"}, {"$set": {"a": 1}}, upsert=True),
+                                        UpdateOne({"dir_name": "dir_10"}, {"$set": {"a": 1}}, upsert=True)],
+                                       ordered=False)
+        self.assertEqual((result.matched_count, result.upserted_count), (1, 1))
+        self.assertEqual(self.tasks.delete_many({"a": 1}).deleted_count, 2)
+        self.assertEqual(self.tasks.count(), 5)
+        self.tasks.drop()
+        self.assertIsNone(self.tasks.find_one())
+
+    def test_concurrent_index(self):
+        # a database of another process, whose indexed columns predate an index
+        other = EmbeddedClient(self.path)["vasp"]
+        other.tasks.find_one({"dir_name": "dir_1"})
+        self.tasks.create_index("dir_name", unique=True)
+        self.assertRaises(DuplicateKeyError, other.tasks.insert_one, {"dir_name": "dir_1"})
+        self.assertEqual(self.db.connection().execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        other.close()
+
+    def test_gridfs(self):
+        fs = get_gridfs(self.db, "dos_fs")
+        oid = fs.put(b"data", _id=ObjectId(), metadata={"task_id": 1})
+        f = fs.get(oid)
+        self.assertEqual(f.read(), b"data")
+        self.assertEqual(f.metadata, {"task_id": 1})
+        with fs.new_file(metadata={"task_id": 2}) as f:
+            f.write(b"more ")
+            f.write(b"data")
+        self.assertEqual(fs.get(f._id).read(), b"more data")
+        self.assertEqual(self.db.dos_fs.files.count(), 2)
+        fs.delete(oid)
+        self.assertRaises(NoFile, fs.get, oid)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+# coding: utf-8
+
+import os
+import unittest
+from unittest.mock import patch
+
+from atomate.utils.ingestion import BulkIngester
+from atomate.utils.testing import AtomateTest
+from atomate.vasp.database import VaspCalcDb
+from atomate.vasp.drones import VaspDrone
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+module_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)))
+db_dir = os.path.join(module_dir, "..", "..", "common", "test_files")
+vasp_dir = os.path.join(module_dir, "..", "..", "vasp", "test_files")
+
+
+class TestBulkIngester(AtomateTest):
+
+    def setUp(self):
+        super(TestBulkIngester, self).setUp()
+        self.db = VaspCalcDb.from_db_file(os.path.join(db_dir, "db.json"))
+        self.paths = [os.path.join(vasp_dir, "Si_static", "outputs"),
+                      os.path.join(vasp_dir, "Si_structure_optimization", "outputs"),
+                      os.path.join(vasp_dir, "setup_test")]
+
+    def test_get_valid_paths(self):
+        ingester = BulkIngester(VaspDrone(), self.db)
+        paths = ingester.get_valid_paths(os.path.join(vasp_dir, "Si_static"))
+        self.assertEqual(paths, [os.path.join(vasp_dir, "Si_static", "outputs")])
+
+    def test_run(self):
+        checkpoint = os.path.join(self.scratch_dir, "checkpoint.json")
+        ingester = BulkIngester(VaspDrone(), self.db, checkpoint_file=checkpoint, nworkers=2,
+                                batch_size=1)
+        summary = ingester.run(paths=self.paths)
+        self.assertEqual(len(summary["inserted"]), 2)
+        self.assertEqual(list(summary["failed"].keys()), [self.paths[2]])
+        self.assertEqual(self.db.collection.count_documents({}), 2)
+
+        records = ingester.load_checkpoint()
+        self.assertEqual(records[self.paths[0]]["state"], "inserted")
+        self.assertEqual(records[self.paths[2]]["state"], "failed")
+
+        # resuming only retries the failed directory
+        summary = ingester.run(paths=self.paths)
+        self.assertEqual(summary["inserted"], {})
+        self.assertEqual(list(summary["failed"].keys()), [self.paths[2]])
+        self.assertEqual(self.db.collection.count_documents({}), 2)
+
+    def test_batch_insert(self):
+        # the documents without GridFS data are written in one bulk write
+        ingester = BulkIngester(VaspDrone(), self.db, nworkers=1, batch_size=2,
+                                insert_kwargs={"use_gridfs_force_constants": True})
+        with patch.object(self.db, "insert_task", wraps=self.db.insert_task) as insert_task, \
+                patch.object(self.db, "insert_tasks", wraps=self.db.insert_tasks) as insert_tasks:
+            summary = ingester.run(paths=self.paths[:2])
+        self.assertEqual(len(summary["inserted"]), 2)
+        self.assertEqual(insert_task.call_count, 0)
+        self.assertEqual(insert_tasks.call_count, 1)
+
+        doc = {"calcs_reversed": [{"output": {}, "dos": {}}]}
+        self.assertFalse(self.db.needs_insert_task(doc))
+        self.assertTrue(self.db.needs_insert_task(doc, use_gridfs=True))
+
+    def test_skip_unchanged(self):
+        ingester = BulkIngester(VaspDrone(), self.db, nworkers=1, skip_unchanged=True)
+        summary = ingester.run(paths=self.paths[:2])
+        self.assertEqual(len(summary["inserted"]), 2)
+        doc = self.db.collection.find_one({"task_id": summary["inserted"][self.paths[0]]})
+        self.assertIn("hash", doc["fingerprint"])
+
+        summary = ingester.run(paths=self.paths[:2])
+        self.assertEqual(summary["inserted"], {})
+        self.assertEqual(sorted(summary["unchanged"]), sorted(self.paths[:2]))
+
+        # a changed mtime alone falls back to the content hash
+        fingerprint = doc["fingerprint"]
+        fingerprint["files"][0]["mtime"] -= 1
+        self.db.collection.update_one({"task_id": doc["task_id"]},
+                                      {"$set": {"fingerprint": fingerprint}})
+        summary = ingester.run(paths=self.paths[:1])
+        self.assertEqual(summary["unchanged"], self.paths[:1])
+
+        # a changed key output is parsed again
+        fingerprint["hash"] = "outdated"
+        self.db.collection.update_one({"task_id": doc["task_id"]},
+                                      {"$set": {"fingerprint": fingerprint}})
+        summary = ingester.run(paths=self.paths[:1])
+        self.assertEqual(list(summary["inserted"].values()), [doc["task_id"]])
+
+        # a task removed after its fingerprint was read is parsed again
+        fingerprints = ingester.get_stored_fingerprints(self.paths[:1])
+        self.db.collection.delete_one({"task_id": doc["task_id"]})
+        with patch.object(ingester, "get_stored_fingerprints", return_value=fingerprints):
+            summary = ingester.run(paths=self.paths[:1])
+        self.assertEqual(list(summary["inserted"]), self.paths[:1])
+        self.assertEqual(self.db.collection.count_documents({}), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
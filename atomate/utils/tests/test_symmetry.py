@@ -0,0 +1,59 @@
+# coding: utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pymatgen import Lattice, Structure
+
+from atomate.utils.symmetry import SymmetryCache, get_structure_hash
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+
+class TestSymmetryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.si = Structure(Lattice.cubic(5.47), ["Si", "Si"], [[0, 0, 0], [0.25, 0.25, 0.25]])
+        self.scratch_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch_dir)
+
+    def test_structure_hash(self):
+        shifted = Structure(Lattice.cubic(5.47), ["Si", "Si"],
+                            [[1, 0, -1e-9], [0.25, 0.25, 0.25]])
+        self.assertEqual(get_structure_hash(self.si), get_structure_hash(shifted))
+        perturbed = self.si.copy()
+        perturbed.translate_sites([1], [0.01, 0, 0])
+        self.assertNotEqual(get_structure_hash(self.si), get_structure_hash(perturbed))
+        magnetic = self.si.copy(site_properties={"magmom": [1, -1]})
+        self.assertNotEqual(get_structure_hash(self.si), get_structure_hash(magnetic))
+
+    def test_get_symmetry(self):
+        cache = SymmetryCache(maxsize=1)
+        sym = cache.get_symmetry(self.si, 0.1)
+        self.assertEqual(sym["number"], 227)
+        self.assertEqual(sym["equivalent_atoms"], [0, 0])
+        self.assertTrue(sym["has_inversion"])
+        self.assertIs(cache.get_symmetry(self.si.copy(), 0.1), sym)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # different tolerance is a different entry, and evicts the first one
+        cache.get_symmetry(self.si, 1e-3, 1)
+        cache.get_symmetry(self.si, 0.1)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_disk_cache(self):
+        cache = SymmetryCache(cache_dir=self.scratch_dir)
+        sym = cache.get_symmetry(self.si)
+        self.assertEqual(len(os.listdir(self.scratch_dir)), 1)
+        other = SymmetryCache(cache_dir=self.scratch_dir)
+        self.assertEqual(other.get_symmetry(self.si), sym)
+        self.assertEqual((other.disk_hits, other.misses), (1, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,7 +7,8 @@ from pymongo.database import Database
 
 from fireworks import FiretaskBase, Firework, Workflow, explicit_serialize, FWAction
 
-from atomate.utils.utils import env_chk, get_logger, get_mongolike, recursive_get_result, recursive_update, get_database, get_uri
+from atomate.utils.utils import env_chk, get_logger, get_mongolike, recursive_get_result, recursive_update, get_database, get_uri, \
+    get_fingerprint, get_mongo_client
 
 from atomate.utils.testing import AtomateTest
 
@@ -103,6 +104,31 @@ class UtilsTests(AtomateTest):
     def test_get_uri(self):
         self.assertTrue(MODULE_DIR in get_uri(MODULE_DIR))
 
+    def test_get_fingerprint(self):
+        with open(os.path.join(self.scratch_dir, "OUTCAR"), "w") as f:
+            f.write("outcar")
+        with open(os.path.join(self.scratch_dir, "INCAR"), "w") as f:
+            f.write("incar")
+        fp = get_fingerprint(self.scratch_dir, patterns=("OUTCAR*",))
+        self.assertEqual([f["name"] for f in fp["files"]], ["INCAR", "OUTCAR"])
+        self.assertEqual(fp["files"][1]["size"], 6)
+
+        # only the key outputs are hashed
+        with open(os.path.join(self.scratch_dir, "INCAR"), "w") as f:
+            f.write("incar2")
+        fp2 = get_fingerprint(self.scratch_dir, patterns=("OUTCAR*",))
+        self.assertNotEqual(fp["files"], fp2["files"])
+        self.assertEqual(fp["hash"], fp2["hash"])
+        with open(os.path.join(self.scratch_dir, "OUTCAR"), "w") as f:
+            f.write("outcar2")
+        fp3 = get_fingerprint(self.scratch_dir, patterns=("OUTCAR*",))
+        self.assertNotEqual(fp["hash"], fp3["hash"])
+
+        # the files are not hashed again while the manifest is unchanged
+        stored = dict(fp3, hash="stored")
+        self.assertEqual(get_fingerprint(self.scratch_dir, ("OUTCAR*",), stored=stored), stored)
+        self.assertEqual(get_fingerprint(self.scratch_dir, ("OUTCAR*",), stored=fp), fp3)
+
     def test_get_database(self):
         d = {"host": "localhost", "port": 27017, "database": "atomate_unittest"}
 
@@ -112,3 +138,10 @@ class UtilsTests(AtomateTest):
         self.assertTrue(isinstance(db, Database))
         self.assertEqual(db.client.address[0], "localhost")
         self.assertEqual(db.name, "atomate_unittest")
+
+    def test_get_mongo_client(self):
+        client = get_mongo_client("localhost", 27017)
+        self.assertIs(get_mongo_client("localhost", "27017"), client)
+        self.assertIsNot(get_mongo_client("localhost", 27017, connect=False), client)
+        self.assertIs(get_database(settings={"host": "localhost", "port": 27017,
+                                             "database": "atomate_unittest"}).client, client)
@@ -1,10 +1,13 @@
 # coding: utf-8
 
 
+import hashlib
 import logging
 import os
 import sys
 import socket
+import threading
+from fnmatch import fnmatch
 from random import randint
 from time import time
 
@@ -333,9 +336,121 @@ def get_uri(dir_name):
     return "{}:{}".format(hostname, fullpath)
 
 
+def get_file_manifest(dir_name):
+    """
+    Sizes and modification times of all the files in a directory tree.
+
+    Args:
+        dir_name (str): path to the directory
+
+    Returns:
+        ([dict]): {"name": path relative to dir_name, "size": size in bytes,
+            "mtime": modification time}, sorted by name
+    """
+    manifest = []
+    for parent, subdirs, files in os.walk(dir_name):
+        for f in files:
+            path = os.path.join(parent, f)
+            stat = os.stat(path)
+            manifest.append({"name": os.path.relpath(path, dir_name),
+                             "size": stat.st_size, "mtime": stat.st_mtime})
+    return sorted(manifest, key=lambda x: x["name"])
+
+
+def get_content_hash(dir_name, patterns=("*",), manifest=None):
+    """
+    SHA1 hash of the names and contents of the files in a directory tree
+    whose file name matches one of the patterns.
+
+    Args:
+        dir_name (str): path to the directory
+        patterns (tuple): fnmatch patterns of the file names to hash, e.g. ("OUTCAR*",)
+        manifest ([dict]): file manifest of the directory, if already known
+
+    Returns:
+        (str): hex digest
+    """
+    sha1 = hashlib.sha1()
+    for entry in manifest or get_file_manifest(dir_name):
+        if any(fnmatch(os.path.basename(entry["name"]), p) for p in patterns):
+            sha1.update(entry["name"].encode())
+            with open(os.path.join(dir_name, entry["name"]), "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_fingerprint(dir_name, patterns=("*",), stored=None):
+    """
+    Fingerprint of a calculation directory, used to detect whether it changed
+    since it was parsed: the file manifest and the content hash of the key
+    output files.
+
+    Args:
+        dir_name (str): path to the directory
+        patterns (tuple): fnmatch patterns of the key output files to hash
+        stored (dict): a previous fingerprint of the directory, returned as
+            it is if the file manifest is unchanged, without hashing the files
+
+    Returns:
+        (dict): {"files": file manifest, "hash": content hash}
+    """
+    manifest = get_file_manifest(dir_name)
+    if stored and stored["files"] == manifest:
+        return stored
+    return {"files": manifest, "hash": get_content_hash(dir_name, patterns, manifest)}
+
+
+# MongoClients shared by the callers of a process, see get_mongo_client
+_mongo_clients = {}
+_mongo_clients_lock = threading.Lock()
+
+
+def get_mongo_client(host, port, username=None, password=None, **kwargs):
+    """
+    Get the MongoClient of the process for the given host, credentials and
+    client options, creating it on first use. A MongoClient is thread-safe
+    and keeps a pool of connections, so sharing it saves the connection and
+    the authentication of every database access, e.g. of every firetask of a
+    rapidfire launch. Forked processes get their own clients.
+
+    Args:
+        host (str): database host
+        port (int): database port
+        username (str): user name
+        password (str): password
+        kwargs: other MongoClient keyword arguments
+
+    Returns:
+        MongoClient
+    """
+    key = (os.getpid(), host, int(port), username,
+           hashlib.sha1(password.encode()).hexdigest() if password else None,
+           repr(sorted(kwargs.items())))
+    with _mongo_clients_lock:
+        if key not in _mongo_clients:
+            _mongo_clients[key] = MongoClient(host=host, port=int(port), username=username,
+                                              password=password, **kwargs)
+        return _mongo_clients[key]
+
+
+def close_mongo_clients():
+    """
+    Close the MongoClients shared by the process, see get_mongo_client.
+    """
+    with _mongo_clients_lock:
+        for client in _mongo_clients.values():
+            client.close()
+        _mongo_clients.clear()
+
+
 def get_database(config_file=None, settings=None, admin=False, **kwargs):
     d = loadfn(config_file) if settings is None else settings
 
+    if d.get("backend") == "sqlite":
+        from atomate.utils.embedded import get_embedded_client
+        return get_embedded_client(d["path"])[d["database"]]
+
     try:
         user = d["admin_user"] if admin else d["readonly_user"]
         passwd = d["admin_password"] if admin else d["readonly_password"]
@@ -348,8 +463,7 @@ def get_database(config_file=None, settings=None, admin=False, **kwargs):
     if "authsource" in d and "authsource" not in kwargs:
         kwargs["authsource"] = d["authsource"]
 
-    conn = MongoClient(host=d["host"], port=d["port"], username=user,
-                       password=passwd, **kwargs)
+    conn = get_mongo_client(d["host"], d["port"], username=user, password=passwd, **kwargs)
     db = conn[d["database"]]
 
     return db
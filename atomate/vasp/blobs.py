@@ -0,0 +1,408 @@
+# coding: utf-8
+
+
+"""
+This module converts VASP output objects to and from the binary array blobs
+of atomate.utils.blobs, for storage in GridFS.
+"""
+
+import numpy as np
+
+from pymatgen import Lattice, Structure
+from pymatgen.electronic_structure.bandstructure import BandStructure, BandStructureSymmLine
+from pymatgen.electronic_structure.core import Spin, Orbital
+from pymatgen.electronic_structure.dos import Dos, CompleteDos
+from pymatgen.io.vasp import Chgcar, Poscar
+
+from atomate.utils.blobs import write_array_blob, read_array_blob, read_blob_header, \
+    read_blob_array
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+
+def write_chgcar_blob(f, chgcar, dtype="float64"):
+    """
+    Write a Chgcar (CHGCAR, AECCAR0, AECCAR2, ...) as an array blob: one
+    array per grid ("total", "diff", ...) plus the POSCAR and the augmentation
+    data in the header.
+
+    Args:
+        f: writable binary stream
+        chgcar (Chgcar): the charge density
+        dtype (str): precision of the stored grids, "float64" or "float32"
+    """
+    meta = {"@class": chgcar.__class__.__name__,
+            "poscar": chgcar.poscar.as_dict(),
+            "data_aug": chgcar.data_aug or None}
+    arrays = {k: np.asarray(v, dtype=dtype) for k, v in chgcar.data.items()}
+    write_array_blob(f, arrays, meta)
+
+
+def read_chgcar_blob(f):
+    """
+    Rebuild a Chgcar from an array blob written by write_chgcar_blob.
+
+    Args:
+        f: readable, seekable binary stream positioned at the start of the blob
+
+    Returns:
+        Chgcar
+    """
+    meta, data = read_array_blob(f)
+    data = {k: np.asarray(v, dtype="float64") for k, v in data.items()}
+    return Chgcar(Poscar.from_dict(meta["poscar"]), data, data_aug=meta["data_aug"])
+
+
+def write_trajectory_blob(f, ionic_steps):
+    """
+    Write the ionic steps of a calc (calcs_reversed.N.output.ionic_steps) as
+    an array blob with one column per quantity: lattice, fractional
+    coordinates, forces and stress of every step, the energies and other
+    scalars of every step, and the electronic steps of all ionic steps
+    concatenated, with the offsets of each ionic step. The species and site
+    properties of the first structure are stored once in the header.
+
+    Args:
+        f: writable binary stream
+        ionic_steps ([dict]): the ionic steps
+    """
+    first = ionic_steps[0]["structure"]
+    arrays = {"lattice": np.array([s["structure"]["lattice"]["matrix"] for s in ionic_steps],
+                                  dtype="float64"),
+              "frac_coords": np.array([[site["abc"] for site in s["structure"]["sites"]]
+                                       for s in ionic_steps], dtype="float64")}
+    for key in ("forces", "stress"):
+        if all(s.get(key) is not None for s in ionic_steps):
+            arrays[key] = np.array([s[key] for s in ionic_steps], dtype="float64")
+
+    scalar_keys = [k for k, v in ionic_steps[0].items()
+                   if isinstance(v, (int, float)) and all(k in s for s in ionic_steps)]
+    for k in scalar_keys:
+        arrays[k] = np.array([s[k] for s in ionic_steps], dtype="float64")
+
+    electronic_steps = [e for s in ionic_steps for e in s.get("electronic_steps", [])]
+    electronic_keys = sorted({k for e in electronic_steps for k in e})
+    arrays["electronic_offsets"] = np.cumsum(
+        [0] + [len(s.get("electronic_steps", [])) for s in ionic_steps]).astype("int64")
+    for k in electronic_keys:
+        arrays["electronic_" + k] = np.array([e.get(k, np.nan) for e in electronic_steps],
+                                             dtype="float64")
+
+    meta = {"@class": "Trajectory",
+            "nsteps": len(ionic_steps),
+            "species": [site["species"] for site in first["sites"]],
+            "site_properties": [site.get("properties", {}) for site in first["sites"]],
+            "scalar_keys": scalar_keys,
+            "electronic_keys": electronic_keys}
+    write_array_blob(f, arrays, meta)
+
+
+def get_ionic_steps(meta, arrays, steps=None):
+    """
+    Rebuild ionic steps in the task doc format from the columns of a blob
+    written by write_trajectory_blob.
+
+    Args:
+        meta (dict): header metadata of the blob
+        arrays (dict): columns of the blob; only the columns present are put
+            in the steps, e.g. without "frac_coords" no structure is rebuilt
+        steps ([int]): indices of the steps to rebuild. Default: all of them.
+
+    Returns:
+        ([dict]): the ionic steps
+    """
+    steps = range(meta["nsteps"]) if steps is None else [i % meta["nsteps"] for i in steps]
+    species = [{sp["element"]: sp["occu"] for sp in site} for site in meta["species"]]
+    site_properties = {}
+    for i, props in enumerate(meta["site_properties"]):
+        for k, v in props.items():
+            site_properties.setdefault(k, [None] * len(species))[i] = v
+
+    ionic_steps = []
+    for i in steps:
+        step = {k: float(arrays[k][i]) for k in meta["scalar_keys"] if k in arrays}
+        for key in ("forces", "stress"):
+            if key in arrays:
+                step[key] = arrays[key][i].tolist()
+        if "lattice" in arrays and "frac_coords" in arrays:
+            step["structure"] = Structure(Lattice(arrays["lattice"][i]), species,
+                                          arrays["frac_coords"][i],
+                                          site_properties=site_properties or None).as_dict()
+        if "electronic_offsets" in arrays:
+            start, end = arrays["electronic_offsets"][i], arrays["electronic_offsets"][i + 1]
+            keys = [k for k in meta["electronic_keys"] if "electronic_" + k in arrays]
+            step["electronic_steps"] = [
+                {k: float(arrays["electronic_" + k][j]) for k in keys
+                 if not np.isnan(arrays["electronic_" + k][j])} for j in range(start, end)]
+        ionic_steps.append(step)
+    return ionic_steps
+
+
+def write_dos_blob(f, dos, dtype="float64"):
+    """
+    Write a complete DOS as an array blob: the energy grid, the total DOS
+    (spin, energy) and the projected DOS (site, orbital, spin, energy), so that
+    the total DOS or the projections of some sites can be read on their own.
+
+    Args:
+        f: writable binary stream
+        dos (dict): CompleteDos.as_dict()
+        dtype (str): precision of the stored densities, "float64" or "float32"
+    """
+    spins = sorted(dos["densities"], key=lambda spin: -int(spin))
+    orbitals = []
+    for site_pdos in dos["pdos"]:
+        orbitals.extend(orb for orb in site_pdos if orb not in orbitals)
+    pdos = np.zeros((len(dos["pdos"]), len(orbitals), len(spins), len(dos["energies"])),
+                    dtype=dtype)
+    for i, site_pdos in enumerate(dos["pdos"]):
+        for orb, orb_pdos in site_pdos.items():
+            for k, spin in enumerate(spins):
+                pdos[i, orbitals.index(orb), k] = orb_pdos["densities"][spin]
+    arrays = {"energies": np.asarray(dos["energies"], dtype="float64"),
+              "total": np.array([dos["densities"][spin] for spin in spins], dtype=dtype),
+              "pdos": pdos}
+    meta = {"@class": "CompleteDos",
+            "efermi": dos["efermi"],
+            "structure": dos["structure"],
+            "spins": [int(spin) for spin in spins],
+            "orbitals": orbitals,
+            "site_orbitals": [list(site_pdos) for site_pdos in dos["pdos"]],
+            "elements": [site["species"][0]["element"] for site in dos["structure"]["sites"]]}
+    write_array_blob(f, arrays, meta)
+
+
+def read_dos_blob(f):
+    """
+    Rebuild a CompleteDos from an array blob written by write_dos_blob.
+
+    Args:
+        f: readable, seekable binary stream positioned at the start of the blob
+
+    Returns:
+        CompleteDos
+    """
+    meta, arrays = read_array_blob(f)
+    structure = Structure.from_dict(meta["structure"])
+    spins = [Spin(spin) for spin in meta["spins"]]
+    energies = np.asarray(arrays["energies"], dtype="float64")
+    total = Dos(meta["efermi"], energies,
+                {spin: np.asarray(arrays["total"][k], dtype="float64")
+                 for k, spin in enumerate(spins)})
+    pdoss = {}
+    for i, site_orbitals in enumerate(meta["site_orbitals"]):
+        site = structure[i]
+        pdoss[site] = {}
+        for orb in site_orbitals:
+            j = meta["orbitals"].index(orb)
+            pdoss[site][Orbital[orb]] = {spin: np.asarray(arrays["pdos"][i, j, k], dtype="float64")
+                                         for k, spin in enumerate(spins)}
+    return CompleteDos(structure, total, pdoss)
+
+
+def read_partial_dos(f, element=None, orbital=None, sites=None):
+    """
+    Read the total DOS, or the sum of the projected DOS of some sites and
+    orbitals, from an array blob written by write_dos_blob. Only the energy
+    grid and the densities of the selected sites are read.
+
+    Args:
+        f: readable, seekable binary stream positioned at the start of the blob
+        element (str): only the sites of this element, e.g. "Fe"
+        orbital (str): only this orbital, e.g. "dxy", or all orbitals of this
+            type, i.e. "s", "p", "d" or "f"
+        sites ([int]): only these sites
+
+    Returns:
+        Dos: the total DOS if no selection is given, else the projected DOS
+    """
+    start = f.tell()
+    header = read_blob_header(f)
+    meta = header["meta"]
+    spins = [Spin(spin) for spin in meta["spins"]]
+    energies = read_blob_array(f, "energies", header, start)
+    if element is None and orbital is None and sites is None:
+        densities = read_blob_array(f, "total", header, start)
+    elif not meta["orbitals"]:
+        raise ValueError("The DOS has no projections")
+    else:
+        rows = range(len(meta["elements"])) if sites is None else sites
+        if element is not None:
+            rows = [i for i in rows if meta["elements"][i] == element]
+        orbs = [j for j, orb in enumerate(meta["orbitals"])
+                if orbital is None or orb == orbital or orb[0] == orbital]
+        pdos = read_blob_array(f, "pdos", header, start, rows=rows)
+        densities = pdos[:, orbs].sum(axis=(0, 1))
+    return Dos(meta["efermi"], np.asarray(energies, dtype="float64"),
+               {spin: np.asarray(densities[k], dtype="float64") for k, spin in enumerate(spins)})
+
+
+def _bs_segments(bs):
+    """
+    Index ranges [start, end) of the kpoints of the branches of a band
+    structure dict; a single segment if it is not a line-mode band structure.
+    """
+    branches = bs.get("branches") or []
+    return [[b["start_index"], b["end_index"] + 1] for b in branches] or [[0, len(bs["kpoints"])]]
+
+
+def write_bandstructure_blob(f, bs, dtype="float64"):
+    """
+    Write the kpoints and eigenvalues of a band structure as an array blob.
+    The eigenvalues are stored per spin and per branch ("segment") as
+    (band, kpoint) arrays, so that one branch, or some bands of every branch,
+    can be read on their own. The projections are not written, see
+    write_bs_projections_blob.
+
+    Args:
+        f: writable binary stream
+        bs (dict): BandStructure.as_dict() or BandStructureSymmLine.as_dict()
+        dtype (str): precision of the stored eigenvalues, "float64" or "float32"
+    """
+    segments = _bs_segments(bs)
+    spins = sorted(bs["bands"], key=lambda spin: -int(spin))
+    arrays = {"kpoints": np.asarray(bs["kpoints"], dtype="float64")}
+    band_min, band_max = {}, {}
+    for spin in spins:
+        bands = np.asarray(bs["bands"][spin], dtype=dtype)
+        band_min[spin] = bands.min(axis=1)
+        band_max[spin] = bands.max(axis=1)
+        for i, (start, end) in enumerate(segments):
+            arrays["bands_{}_{}".format(spin, i)] = bands[:, start:end]
+    meta = {"@class": bs["@class"],
+            "efermi": bs["efermi"],
+            "lattice_rec": bs["lattice_rec"]["matrix"],
+            "labels_dict": bs["labels_dict"],
+            "branches": bs.get("branches") or [],
+            "segments": segments,
+            "spins": [int(spin) for spin in spins],
+            "structure": bs.get("structure"),
+            "is_metal": bs.get("is_metal"),
+            "band_gap": bs.get("band_gap"),
+            "band_min": band_min,
+            "band_max": band_max}
+    for edge in ["vbm", "cbm"]:
+        if bs.get(edge):
+            meta[edge] = {k: v for k, v in bs[edge].items() if k != "projections"}
+    write_array_blob(f, arrays, meta)
+
+
+def write_bs_projections_blob(f, bs, dtype="float64"):
+    """
+    Write the projections of a band structure as an array blob, segmented
+    like the eigenvalues written by write_bandstructure_blob: one (band,
+    kpoint, orbital, ion) array per spin and branch.
+
+    Args:
+        f: writable binary stream
+        bs (dict): BandStructure.as_dict() or BandStructureSymmLine.as_dict(),
+            with projections
+        dtype (str): precision of the stored projections, "float64" or "float32"
+    """
+    segments = _bs_segments(bs)
+    arrays = {}
+    for spin, projections in bs["projections"].items():
+        projections = np.asarray(projections, dtype=dtype)
+        for i, (start, end) in enumerate(segments):
+            arrays["projections_{}_{}".format(spin, i)] = projections[:, start:end]
+    write_array_blob(f, arrays, {"segments": segments})
+
+
+def get_band_edge_indices(meta, nbands=2):
+    """
+    Indices of the bands around the Fermi level of a band structure blob,
+    from the band ranges in its header: the nbands highest bands that start
+    below the Fermi level and the nbands lowest bands above them, i.e. the
+    top valence and bottom conduction bands of an insulator.
+
+    Args:
+        meta (dict): header metadata of a blob written by write_bandstructure_blob
+        nbands (int): number of bands on each side of the Fermi level
+
+    Returns:
+        ([int]): band indices, the same for all spins
+    """
+    noccupied = [int(np.sum(np.array(meta["band_min"][str(spin)]) < meta["efermi"]))
+                 for spin in meta["spins"]]
+    total = len(meta["band_min"][str(meta["spins"][0])])
+    return list(range(max(0, min(noccupied) - nbands), min(total, max(noccupied) + nbands)))
+
+
+def _branch_index(meta, branch):
+    if not meta["branches"]:
+        raise ValueError("The band structure has no branches")
+    if isinstance(branch, str):
+        names = [b["name"] for b in meta["branches"]]
+        if branch not in names:
+            raise ValueError("Unknown branch {}, expected one of {}".format(branch, names))
+        return names.index(branch)
+    return int(branch) % len(meta["branches"])
+
+
+def read_bandstructure_blob(f, projections=None, branch=None, bands=None):
+    """
+    Rebuild a band structure, or a part of it, from an array blob written by
+    write_bandstructure_blob. Only the eigenvalues (and projections) of the
+    selected branch and bands are read.
+
+    Args:
+        f: readable, seekable binary stream positioned at the start of the blob
+        projections: readable, seekable binary stream positioned at the start
+            of the blob written by write_bs_projections_blob. Default: the
+            band structure is built without projections.
+        branch (int or str): only this branch of a line-mode band structure,
+            by index or name, e.g. "\\Gamma-X"
+        bands ([int]): only these bands, in increasing order
+
+    Returns:
+        BandStructure or BandStructureSymmLine
+    """
+    start = f.tell()
+    header = read_blob_header(f)
+    meta = header["meta"]
+    segments = range(len(meta["segments"])) if branch is None else [_branch_index(meta, branch)]
+    spins = [Spin(spin) for spin in meta["spins"]]
+
+    kpoints = read_blob_array(f, "kpoints", header, start)
+    kpoints = np.concatenate([kpoints[slice(*meta["segments"][i])] for i in segments])
+    eigenvals = {spin: np.concatenate(
+        [np.asarray(read_blob_array(f, "bands_{}_{}".format(int(spin), i), header, start,
+                                    rows=bands), dtype="float64") for i in segments], axis=1)
+        for spin in spins}
+
+    projs = {}
+    if projections is not None:
+        proj_start = projections.tell()
+        proj_header = read_blob_header(projections)
+        projs = {spin: np.concatenate(
+            [np.asarray(read_blob_array(projections, "projections_{}_{}".format(int(spin), i),
+                                        proj_header, proj_start, rows=bands), dtype="float64")
+             for i in segments], axis=1) for spin in spins}
+
+    structure = Structure.from_dict(meta["structure"]) if meta["structure"] else None
+    # strip the blank added by as_dict in front of labels starting with "$"
+    labels_dict = {k.strip(): v for k, v in meta["labels_dict"].items()}
+    cls = BandStructureSymmLine if meta["@class"] == "BandStructureSymmLine" else BandStructure
+    return cls(list(kpoints), eigenvals, Lattice(meta["lattice_rec"]), meta["efermi"], labels_dict,
+               structure=structure, projections=projs)
+
+
+def read_band_edges(f, nbands=2, projections=None):
+    """
+    Read the bands around the Fermi level of a band structure blob, see
+    get_band_edge_indices.
+
+    Args:
+        f: readable, seekable binary stream positioned at the start of the blob
+        nbands (int): number of bands on each side of the Fermi level
+        projections: stream of the projections blob, see read_bandstructure_blob
+
+    Returns:
+        (BandStructure, [int]): band structure with the selected bands only,
+            and the indices of these bands in the full band structure
+    """
+    start = f.tell()
+    indices = get_band_edge_indices(read_blob_header(f)["meta"], nbands)
+    f.seek(start)
+    return read_bandstructure_blob(f, projections, bands=indices), indices
@@ -7,18 +7,33 @@ from monty.json import MontyEncoder, MontyDecoder
 This module defines the database classes.
 """
 
-import zlib
+import hashlib
+import io
 import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 from bson import ObjectId
 
+import numpy as np
+
 from pymatgen.electronic_structure.bandstructure import BandStructure, BandStructureSymmLine
 from pymatgen.electronic_structure.dos import CompleteDos
 
-import gridfs
 from pymongo import ASCENDING, DESCENDING
 
-from atomate.utils.database import CalcDb
+from atomate.utils.blobs import BLOB_ENCODING, write_array_blob, read_blob_array, \
+    read_array_blob, memmap_blob_array
+from atomate.utils.compression import compress as compress_data, \
+    decompress as decompress_data, parse_codec, benchmark_codecs
+from atomate.utils.database import CalcDb, _get_parent
+from atomate.utils.embedded import get_gridfs
+from atomate.utils.profiling import StageProfiler, aggregate_profile
 from atomate.utils.utils import get_logger
+from atomate.vasp.blobs import write_chgcar_blob, read_chgcar_blob, write_trajectory_blob, \
+    get_ionic_steps, write_dos_blob, read_dos_blob, read_partial_dos, write_bandstructure_blob, \
+    write_bs_projections_blob, read_bandstructure_blob, read_band_edges
 
 __author__ = 'Kiran Mathew'
 __credits__ = 'Anubhav Jain'
@@ -26,14 +41,63 @@ __email__ = 'kmathew@lbl.gov'
 
 logger = get_logger(__name__)
 
+# DFPT outputs of a calc that are stored in GridFS as binary arrays
+FORCE_CONSTANTS_KEYS = ("force_constants", "normalmode_eigenvals", "normalmode_eigenvecs")
+
+# data of a task that can be stored in GridFS, see retrieve_tasks
+TASK_GRIDFS_FIELDS = ("bandstructure", "dos", "chgcar", "aeccar", "force_constants", "trajectory")
+
+# GridFS collection of the files referenced by the "<prefix>_fs_id" fields of
+# the calcs, by prefix, see get_gridfs_references
+TASK_GRIDFS_COLLECTIONS = {"bandstructure": "bandstructure_fs", "dos": "dos_fs",
+                           "chgcar": "chgcar_fs", "aeccar0": "aeccar0_fs", "aeccar2": "aeccar2_fs",
+                           "force_constants": "force_constants_fs", "trajectory": "trajectory_fs"}
+
+
+def _is_offloaded_stub(value):
+    """
+    Whether a value of a task document is the stub of a field moved to GridFS
+    for size, see CalcDb.offload_fields.
+    """
+    return isinstance(value, dict) and set(value) == {"fs_id", "compression", "nbytes"}
+
+
+class _HashingWriter(object):
+    """
+    Binary stream that hashes the data written to another stream.
+    """
+
+    def __init__(self, f, hasher):
+        self.f = f
+        self.hasher = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.f.write(data)
+
 
 class VaspCalcDb(CalcDb):
     """
     Class to help manage database insertions of Vasp drones
     """
 
+    # collection of the aggregated ingestion profiles, see record_profile
+    profile_collection = "ingestion_profiles"
+
+    db_file_keys = CalcDb.db_file_keys + ("gridfs_encoding",)
+
     def __init__(self, host="localhost", port=27017, database="vasp", collection="tasks", user=None,
                  password=None, **kwargs):
+        """
+        Args:
+            kwargs: see CalcDb, and
+                gridfs_encoding (dict): default encoding of the data stored in
+                    GridFS by insert_task, by kind ("chgcar", "dos" and
+                    "bandstructure"), e.g. {"chgcar": "float32"} to store the
+                    charge densities as binary arrays. Default: "json", the
+                    compressed JSON read by other tools.
+        """
+        self.gridfs_encoding = kwargs.pop("gridfs_encoding", None) or {}
         super(VaspCalcDb, self).__init__(host, port, database, collection, user,
                                          password, **kwargs)
 
@@ -67,16 +131,52 @@ class VaspCalcDb(CalcDb):
                                           ("completed_at", DESCENDING)],
                                          background=background)
 
-    def insert_task(self, task_doc, use_gridfs=False):
+    def insert_task(self, task_doc, use_gridfs=False, chgcar_encoding=None,
+                    use_gridfs_force_constants=False, use_gridfs_trajectory=False,
+                    dos_encoding=None, bs_encoding=None, gridfs_workers=1,
+                    update_duplicates=True):
         """
         Inserts a task document (e.g., as returned by Drone.assimilate()) into the database.
         Handles putting DOS, band structure and charge density into GridFS as needed.
+        The GridFS files are uploaded before the task document, which is then
+        written in a single operation with the file ids and compression types set.
         During testing, a percentage of runs on some clusters had corrupted AECCAR files when even if everything else about the calculation looked OK.
         So we do a quick check here and only record the AECCARs if they are valid
 
+        If the task doc has a "_profile" key (see VaspDrone(profile=True)), the
+        time spent serializing, inserting and uploading to GridFS is added to it
+        and the profile is aggregated, see record_profile.
+
         Args:
             task_doc: (dict) the task document
             use_gridfs (bool) use gridfs for  bandstructures and DOS
+            chgcar_encoding (str): how the CHGCAR and AECCARs are stored in GridFS:
+                "json" for compressed JSON, or "float64" or "float32" for binary
+                grids of that precision (see atomate.vasp.blobs). Default: the
+                "chgcar" entry of gridfs_encoding (see __init__), else "json"
+            use_gridfs_force_constants (bool): store the force constants and normal
+                modes of every calc in GridFS as binary arrays rather than as
+                nested lists in the task doc; see get_force_constants. This
+                is independent of use_gridfs.
+            use_gridfs_trajectory (bool): store the ionic steps of every calc in
+                GridFS as columns of arrays (lattices, coordinates, forces,
+                stresses, energies) rather than in the task doc; see
+                get_ionic_steps. The final forces and stress stay in "output".
+            dos_encoding (str): how the DOS is stored in GridFS: "json" for
+                compressed JSON, or "float64" or "float32" for binary arrays of
+                that precision, which can be read in part with get_total_dos and
+                get_partial_dos. Default: the "dos" entry of gridfs_encoding,
+                else "json"
+            bs_encoding (str): how the band structure is stored in GridFS:
+                "json" for compressed JSON, or "float64" or "float32" for binary
+                arrays of that precision, with the projections in their own
+                file, so that a branch or the band edges can be read without
+                them (see get_band_branch and get_band_edges). Default: the
+                "bandstructure" entry of gridfs_encoding, else "json"
+            gridfs_workers (int): number of threads uploading the GridFS files
+                concurrently
+            update_duplicates (bool): whether to update a task with the same
+                dir_name; if False, nothing is written for a duplicate
         Returns:
             (int) - task_id of inserted document
         """
@@ -85,20 +185,24 @@ class VaspCalcDb(CalcDb):
         chgcar = None
         aeccar0 = None
         write_aeccar = False
+        profiler = StageProfiler(enabled="_profile" in task_doc)
+        chgcar_encoding = chgcar_encoding or self.gridfs_encoding.get("chgcar", "json")
+        dos_encoding = dos_encoding or self.gridfs_encoding.get("dos", "json")
+        bs_encoding = bs_encoding or self.gridfs_encoding.get("bandstructure", "json")
 
         # move dos BS and CHGCAR from doc to gridfs
         if use_gridfs and "calcs_reversed" in task_doc:
 
             if "dos" in task_doc["calcs_reversed"][0]:  # only store idx=0 (last step)
-                dos = json.dumps(task_doc["calcs_reversed"][0]["dos"], cls=MontyEncoder)
+                dos = task_doc["calcs_reversed"][0]["dos"]
                 del task_doc["calcs_reversed"][0]["dos"]
 
             if "bandstructure" in task_doc["calcs_reversed"][0]:  # only store idx=0 (last step)
-                bs = json.dumps(task_doc["calcs_reversed"][0]["bandstructure"], cls=MontyEncoder)
+                bs = task_doc["calcs_reversed"][0]["bandstructure"]
                 del task_doc["calcs_reversed"][0]["bandstructure"]
 
             if "chgcar" in task_doc["calcs_reversed"][0]:  # only store idx=0 DOS
-                chgcar = json.dumps(task_doc["calcs_reversed"][0]["chgcar"], cls=MontyEncoder)
+                chgcar = task_doc["calcs_reversed"][0]["chgcar"]
                 del task_doc["calcs_reversed"][0]["chgcar"]
 
             if "aeccar0" in task_doc["calcs_reversed"][0]:
@@ -109,54 +213,132 @@ class VaspCalcDb(CalcDb):
                     logger.warning(f"The AECCAR seems to be corrupted for task_in directory {task_doc['dir_name']}\nSkipping storage of AECCARs")
                     write_aeccar = False
                 else:
-                    # overwrite the aeccar variable with their string representations to be inserted in GridFS
-                    aeccar0 = json.dumps(task_doc["calcs_reversed"][0]["aeccar0"], cls=MontyEncoder)
-                    aeccar2 = json.dumps(task_doc["calcs_reversed"][0]["aeccar2"], cls=MontyEncoder)
                     write_aeccar = True
 
                 del task_doc["calcs_reversed"][0]["aeccar0"]
                 del task_doc["calcs_reversed"][0]["aeccar2"]
 
-        # insert the task document
-        t_id = self.insert(task_doc)
+        # move the force constants and normal modes of all calcs to gridfs
+        force_constants = {}
+        if use_gridfs_force_constants:
+            for i, calc in enumerate(task_doc.get("calcs_reversed", [])):
+                output = calc.get("output", {})
+                arrays = {k: output.pop(k) for k in FORCE_CONSTANTS_KEYS if k in output}
+                if arrays:
+                    force_constants[i] = arrays
 
-        # insert the dos into gridfs and update the task document
-        if dos:
-            dos_gfs_id, compression_type = self.insert_gridfs(dos, "dos_fs", task_id=t_id)
-            self.collection.update_one(
-                {"task_id": t_id}, {"$set": {"calcs_reversed.0.dos_compression": compression_type}})
-            self.collection.update_one({"task_id": t_id}, {"$set": {"calcs_reversed.0.dos_fs_id": dos_gfs_id}})
+        # move the ionic steps of all calcs to gridfs
+        trajectories = {}
+        if use_gridfs_trajectory:
+            for i, calc in enumerate(task_doc.get("calcs_reversed", [])):
+                if calc.get("output", {}).get("ionic_steps"):
+                    trajectories[i] = calc["output"].pop("ionic_steps")
+
+        t_id = self.assign_task_id(task_doc, update_duplicates)
+        if t_id is None:
+            return None
 
-        # insert the bandstructure into gridfs and update the task documents
+        # GridFS uploads as (calc index, field prefix, whether the compression
+        # is recorded, function uploading the data under a given file id)
+        uploads = []
+        if dos:
+            uploads.append((0, "dos", True, partial(self.insert_dos, dos, "dos_fs", task_id=t_id,
+                                                    encoding=dos_encoding)))
         if bs:
-            bfs_gfs_id, compression_type = self.insert_gridfs(bs, "bandstructure_fs", task_id=t_id)
-            self.collection.update_one(
-                {"task_id": t_id}, {"$set": {"calcs_reversed.0.bandstructure_compression": compression_type}})
-            self.collection.update_one(
-                {"task_id": t_id}, {"$set": {"calcs_reversed.0.bandstructure_fs_id": bfs_gfs_id}})
-
-        # insert the CHGCAR file into gridfs and update the task documents
-        if chgcar:
-            chgcar_gfs_id, compression_type = self.insert_gridfs(chgcar, "chgcar_fs", task_id=t_id)
-            self.collection.update_one(
-                {"task_id": t_id}, {"$set": {"calcs_reversed.0.chgcar_compression": compression_type}})
-            self.collection.update_one({"task_id": t_id}, {"$set": {"calcs_reversed.0.chgcar_fs_id": chgcar_gfs_id}})
-
-        # insert the AECCARs file into gridfs and update the task documents
+            uploads.append((0, "bandstructure", True, partial(
+                self.insert_band_structure, bs, "bandstructure_fs", task_id=t_id, encoding=bs_encoding)))
+        if chgcar is not None:
+            uploads.append((0, "chgcar", True, partial(self.insert_chgcar, chgcar, "chgcar_fs",
+                                                       task_id=t_id, encoding=chgcar_encoding)))
         if write_aeccar:
-            aeccar0_gfs_id, compression_type = self.insert_gridfs(aeccar0, "aeccar0_fs", task_id=t_id)
-            self.collection.update_one(
-                {"task_id": t_id}, {"$set": {"calcs_reversed.0.aeccar0_compression": compression_type}})
-            self.collection.update_one({"task_id": t_id}, {"$set": {"calcs_reversed.0.aeccar0_fs_id": aeccar0_gfs_id}})
-            aeccar2_gfs_id, compression_type = self.insert_gridfs(aeccar2, "aeccar2_fs", task_id=t_id)
-            self.collection.update_one(
-                {"task_id": t_id}, {"$set": {"calcs_reversed.0.aeccar2_compression": compression_type}})
-            self.collection.update_one({"task_id": t_id}, {"$set": {"calcs_reversed.0.aeccar2_fs_id": aeccar2_gfs_id}})
+            uploads.append((0, "aeccar0", True, partial(self.insert_chgcar, aeccar0, "aeccar0_fs",
+                                                        task_id=t_id, encoding=chgcar_encoding)))
+            uploads.append((0, "aeccar2", True, partial(self.insert_chgcar, aeccar2, "aeccar2_fs",
+                                                        task_id=t_id, encoding=chgcar_encoding)))
+        for i, arrays in force_constants.items():
+            uploads.append((i, "force_constants", False,
+                            partial(self.insert_force_constants, arrays, task_id=t_id)))
+        for i, ionic_steps in trajectories.items():
+            uploads.append((i, "trajectory", False, partial(
+                self.insert_gridfs_blob, partial(write_trajectory_blob, ionic_steps=ionic_steps),
+                "trajectory_fs", task_id=t_id)))
+
+        # upload to gridfs first, so that the task document is written once,
+        # with all the file ids, and is never seen without them
+        with profiler.stage("gridfs"):
+            oids = [ObjectId() for _ in uploads]
+            if gridfs_workers > 1 and len(uploads) > 1:
+                with ThreadPoolExecutor(max_workers=gridfs_workers) as executor:
+                    results = list(executor.map(lambda u, oid: u[3](oid=oid), uploads, oids))
+            else:
+                results = [u[3](oid=oid) for u, oid in zip(uploads, oids)]
+            for (i, prefix, has_compression, _), (fs_id, compression_type) in zip(uploads, results):
+                calc = task_doc["calcs_reversed"][i]
+                calc["{}_fs_id".format(prefix)] = fs_id
+                if has_compression:
+                    calc["{}_compression".format(prefix)] = compression_type
+
+        # insert the task document
+        with profiler.stage("insert"):
+            self.write_task(task_doc)
+
+        if profiler.enabled:
+            self.record_profile(task_doc, profiler)
         return t_id
 
+    def needs_insert_task(self, task_doc, use_gridfs=False, use_gridfs_force_constants=False,
+                          use_gridfs_trajectory=False, **kwargs):
+        """
+        Whether insert_task, with the given options, would do more for a task
+        document than writing it: upload some of its data to GridFS or record
+        its profile. The other documents can be written in batches with
+        insert_tasks, e.g. by atomate.utils.ingestion.BulkIngester.
+
+        Args:
+            task_doc (dict): the task document
+            use_gridfs, use_gridfs_force_constants, use_gridfs_trajectory, kwargs:
+                the keyword arguments of insert_task
+
+        Returns:
+            bool
+        """
+        if "_profile" in task_doc:
+            return True
+        calcs = task_doc.get("calcs_reversed", [])
+        if use_gridfs and calcs and any(
+                k in calcs[0] for k in ("dos", "bandstructure", "chgcar", "aeccar0")):
+            return True
+        if use_gridfs_force_constants and any(
+                k in calc.get("output", {}) for calc in calcs for k in FORCE_CONSTANTS_KEYS):
+            return True
+        return bool(use_gridfs_trajectory and any(
+            calc.get("output", {}).get("ionic_steps") for calc in calcs))
+
+    def record_profile(self, task_doc, profiler):
+        """
+        Add the stages of the insertion to the profile of an inserted task doc
+        and aggregate the profile per task type (the task_label of the doc) in
+        the profile_collection, e.g. to find the task types that are expensive
+        to ingest with:
+
+            db[VaspCalcDb.profile_collection].find().sort("total_time", -1)
+
+        Args:
+            task_doc (dict): the inserted task doc, with "task_id" and "_profile"
+            profiler (StageProfiler): profiler of the insertion
+        """
+        profile = StageProfiler()
+        profile.update(task_doc["_profile"]["stages"])
+        profile.update(profiler.stages)
+        profile = profile.as_dict()
+        self.collection.update_one({"task_id": task_doc["task_id"]}, {"$set": {"_profile": profile}})
+        aggregate_profile(self.db[self.profile_collection], profile,
+                          task_doc.get("task_label", "unknown"))
+
     def retrieve_task(self, task_id):
         """
-        Retrieves a task document and unpacks the band structure and DOS as dict
+        Retrieves a task document and unpacks the band structure and DOS as
+        dict, and the fields moved to GridFS for size (see offload_fields)
 
         Args:
             task_id: (int) task_id to retrieve
@@ -165,59 +347,469 @@ class VaspCalcDb(CalcDb):
             (dict) complete task document with BS + DOS included
 
         """
-        task_doc = self.collection.find_one({"task_id": task_id})
-        calc = task_doc["calcs_reversed"][0]
-        if 'bandstructure_fs_id' in calc:
-            bs = self.get_band_structure(task_id)
-            calc["bandstructure"] = bs.as_dict()
-        if 'dos_fs_id' in calc:
-            dos = self.get_dos(task_id)
-            calc["dos"] = dos.as_dict()
-        if 'chgcar_fs_id' in calc:
-            chgcar = self.get_chgcar(task_id)
-            calc["chgcar"] = chgcar
-        if 'aeccar0_fs_id' in calc:
-            aeccar = self.get_aeccar(task_id)
-            calc["aeccar0"] = aeccar['aeccar0']
-            calc["aeccar2"] = aeccar['aeccar2']
-        return task_doc
+        for task_doc in self.retrieve_tasks([task_id], nworkers=1):
+            return task_doc
+        return None
+
+    def retrieve_tasks(self, task_ids, fields=None, nworkers=8, batch_size=100):
+        """
+        Retrieve task documents with their GridFS data unpacked as in
+        retrieve_task, and the fields moved to GridFS for size put back (see
+        offload_fields). The task documents of a batch are fetched with a single
+        query and their GridFS files are downloaded and decoded concurrently
+        by a pool of threads. The documents are yielded one at a time, so that
+        at most one batch is held in memory.
+
+        Args:
+            task_ids ([int or str]): the task_ids
+            fields ([str]): the GridFS data to unpack, among TASK_GRIDFS_FIELDS.
+                Default: all of them.
+            nworkers (int): number of download threads
+            batch_size (int): number of tasks fetched per query
+
+        Yields:
+            (dict) task documents, in the order of task_ids. Missing tasks
+                are skipped.
+        """
+        fields = TASK_GRIDFS_FIELDS if fields is None else fields
+        # the GridFS data stored for every calc
+        calc_fields = [f for f in fields if f in ("force_constants", "trajectory")]
+        task_ids = list(task_ids)
+        with ThreadPoolExecutor(max_workers=nworkers) as executor:
+            for i in range(0, len(task_ids), batch_size):
+                batch = task_ids[i:i + batch_size]
+                found = {d["task_id"]: d for d in self.collection.find({"task_id": {"$in": batch}})}
+                task_docs = [found[t] for t in batch if t in found]
+                # the fields moved to GridFS for size may hold the calcs unpacked below
+                list(executor.map(self.load_offloaded_fields,
+                                  [d for d in task_docs if d.get("_offloaded")]))
+                jobs = []
+                for task_doc in task_docs:
+                    for j, calc in enumerate(task_doc["calcs_reversed"]):
+                        # the band structure, DOS and charge densities are only stored for the last calc
+                        for field in fields if j == 0 else calc_fields:
+                            for key in (["aeccar0", "aeccar2"] if field == "aeccar" else [field]):
+                                if "{}_fs_id".format(key) in calc:
+                                    jobs.append(partial(self._unpack_gridfs_field, calc, key))
+                list(executor.map(lambda job: job(), jobs))
+                for task_doc in task_docs:
+                    yield task_doc
+
+    def _unpack_gridfs_field(self, calc, key):
+        """
+        Download and decode a GridFS field of a calc into the calc.
+        """
+        if key == "bandstructure":
+            calc["bandstructure"] = self._load_band_structure(calc["bandstructure_fs_id"]).as_dict()
+        elif key == "dos":
+            calc["dos"] = self._load_dos(calc["dos_fs_id"]).as_dict()
+        elif key in ("chgcar", "aeccar0", "aeccar2"):
+            calc[key] = self._read_chgcar(calc["{}_fs_id".format(key)], "{}_fs".format(key))
+        elif key == "force_constants":
+            f = self.get_gridfs_file("force_constants_fs", calc["force_constants_fs_id"])
+            calc["output"].update({k: v.tolist() for k, v in read_array_blob(f)[1].items()})
+        elif key == "trajectory":
+            f = self.get_gridfs_file("trajectory_fs", calc["trajectory_fs_id"])
+            calc["output"]["ionic_steps"] = get_ionic_steps(*read_array_blob(f))
 
     def insert_gridfs(self, d, collection="fs", compress=True, oid=None, task_id=None):
         """
-        Insert the given document into GridFS.
+        Insert the given document into GridFS, unless the collection already
+        has a file with the same content (see find_gridfs_file).
 
         Args:
-            d (dict): the document
+            d (str or bytes): the document
             collection (string): the GridFS collection name
-            compress (bool): Whether to compress the data or not
+            compress (bool, int or str): Whether to compress the data or not:
+                True for the codec of the collection (see get_gridfs_codec), a
+                zlib compression level, or the codec, e.g. "lzma:9"
             oid (ObjectId()): the _id of the file; if specified, it must not already exist in GridFS
             task_id(int or str): the task_id to store into the gridfs metadata
         Returns:
-            file id, the type of compression used.
+            file id, the type of compression used. The id of the file with the
+            same content if there is one.
         """
         oid = oid or ObjectId()
-        compression_type = None
-
-        if compress:
-            d = zlib.compress(d.encode(), compress)
-            compression_type = "zlib"
+        if isinstance(d, str):
+            d = d.encode()
+        content_hash = hashlib.sha256(d).hexdigest()
+        existing = self.find_gridfs_file(collection, content_hash)
+        if existing:
+            return existing["_id"], existing["metadata"]["compression"]
+        if compress is True:
+            codec = self.get_gridfs_codec(collection)
+        elif isinstance(compress, int) and not isinstance(compress, bool):
+            codec = "zlib:{}".format(compress)
+        else:
+            codec = compress or None
+        d, compression_type = compress_data(d, codec)
 
-        fs = gridfs.GridFS(self.db, collection)
+        fs = get_gridfs(self.db, collection)
+        metadata = {"compression": compression_type, "content_hash": content_hash}
         if task_id:
             # Putting task id in the metadata subdocument as per mongo specs:
             # https://github.com/mongodb/specifications/blob/master/source/gridfs/gridfs-spec.rst#terms
-            fs_id = fs.put(d, _id=oid, metadata={"task_id": task_id, "compression": compression_type})
-        else:
-            fs_id = fs.put(d, _id=oid, metadata={"compression": compression_type})
+            metadata["task_id"] = task_id
+        fs_id = fs.put(d, _id=oid, metadata=metadata)
 
         return fs_id, compression_type
 
-    def get_band_structure(self, task_id):
-        m_task = self.collection.find_one({"task_id": task_id}, {"calcs_reversed": 1})
-        fs_id = m_task['calcs_reversed'][0]['bandstructure_fs_id']
-        fs = gridfs.GridFS(self.db, 'bandstructure_fs')
-        bs_json = zlib.decompress(fs.get(fs_id).read())
-        bs_dict = json.loads(bs_json.decode())
+    def insert_gridfs_blob(self, write, collection="fs", oid=None, task_id=None, metadata=None):
+        """
+        Stream a binary array blob (see atomate.utils.blobs) into GridFS. If
+        the collection has a compression codec (see get_gridfs_codec), the
+        blob is written to memory and compressed first. A blob identical to a
+        file of the collection, metadata included, is not kept (see
+        find_gridfs_file); streamed blobs are hashed as they are uploaded, and
+        removed once found to be duplicates.
+
+        Args:
+            write (callable): function that writes the blob to a binary stream
+            collection (string): the GridFS collection name
+            oid (ObjectId()): the _id of the file; if specified, it must not already exist in GridFS
+            task_id(int or str): the task_id to store into the gridfs metadata
+            metadata (dict): additional gridfs metadata
+        Returns:
+            file id, the type of compression used. The id of the identical
+            file if there is one.
+        """
+        oid = oid or ObjectId()
+        codec = self.get_gridfs_codec(collection, blob=True)
+        hasher = hashlib.sha256(json.dumps(metadata or {}, sort_keys=True, default=str).encode())
+        metadata = dict(metadata or {}, compression=parse_codec(codec)[0], encoding=BLOB_ENCODING)
+        if task_id:
+            metadata["task_id"] = task_id
+        fs = get_gridfs(self.db, collection)
+        if codec is None:
+            with fs.new_file(_id=oid, metadata=metadata) as f:
+                write(_HashingWriter(f, hasher))
+            # the hash is recorded before looking for an older file, so that
+            # of two concurrent uploads of a blob, the newer one is removed
+            content_hash = hasher.hexdigest()
+            self.db["{}.files".format(collection)].update_one(
+                {"_id": oid}, {"$set": {"metadata.content_hash": content_hash}})
+            existing = self.find_gridfs_file(collection, content_hash, before=oid)
+            if existing:
+                fs.delete(oid)
+                return existing["_id"], existing["metadata"]["compression"]
+        else:
+            buffer = io.BytesIO()
+            write(buffer)
+            hasher.update(buffer.getvalue())
+            existing = self.find_gridfs_file(collection, hasher.hexdigest())
+            if existing:
+                return existing["_id"], existing["metadata"]["compression"]
+            metadata["content_hash"] = hasher.hexdigest()
+            fs.put(compress_data(buffer.getvalue(), codec)[0], _id=oid, metadata=metadata)
+        return oid, metadata["compression"]
+
+    def get_gridfs_references(self):
+        """
+        Ids of the GridFS files referenced by the documents of all the task
+        collections of the database, per GridFS collection: the files of the
+        calcs (see TASK_GRIDFS_COLLECTIONS), the projections of the band
+        structure files that are referenced, and the fields moved to GridFS
+        for size.
+
+        Returns:
+            (dict): collection -> set of file ids, as strings
+        """
+        references = super(VaspCalcDb, self).get_gridfs_references()
+        references.update({collection: set() for collection in TASK_GRIDFS_COLLECTIONS.values()})
+        fields = ["calcs_reversed.{}_fs_id".format(prefix) for prefix in TASK_GRIDFS_COLLECTIONS]
+        for name in self.get_task_collections():
+            for d in self.db[name].find({"calcs_reversed": {"$exists": True}}, fields):
+                for calc in d.get("calcs_reversed", []):
+                    for prefix, collection in TASK_GRIDFS_COLLECTIONS.items():
+                        if "{}_fs_id".format(prefix) in calc:
+                            references[collection].add(str(calc["{}_fs_id".format(prefix)]))
+        references["bandstructure_projections_fs"] = {
+            str(f["metadata"]["projections_fs_id"]) for f in self.db["bandstructure_fs.files"].find(
+                {"metadata.projections_fs_id": {"$exists": True}}, ["metadata.projections_fs_id"])
+            if str(f["_id"]) in references["bandstructure_fs"]}
+        return references
+
+    def get_gridfs_file(self, collection, fs_id):
+        """
+        Open a GridFS file for reading, decompressed with the codec recorded in
+        its metadata. Files without a recorded codec are zlib compressed JSON,
+        as written by older versions, unless they are binary array blobs.
+
+        Args:
+            collection (string): the GridFS collection name
+            fs_id (ObjectId): the file id
+        Returns:
+            readable, seekable binary stream, with the GridFS metadata as its
+            "metadata" attribute. Uncompressed files are read from GridFS on
+            demand.
+        """
+        f = get_gridfs(self.db, collection).get(fs_id)
+        metadata = f.metadata or {}
+        compression = metadata.get("compression", None if metadata.get("encoding") else "zlib")
+        if compression is None:
+            return f
+        data = io.BytesIO(decompress_data(f.read(), compression))
+        data.metadata = metadata
+        return data
+
+    def benchmark_gridfs_codecs(self, collection, limit=10, codecs=None, repeat=3):
+        """
+        Compare compression codecs on the (decompressed) files of a GridFS
+        collection, e.g. to choose its codec in the gridfs_compression policy.
+
+        Args:
+            collection (string): the GridFS collection name
+            limit (int): number of files used, the most recent ones
+            codecs ([str]): codecs to compare, see atomate.utils.compression.benchmark_codecs
+            repeat (int): number of runs of each codec
+        Returns:
+            ([dict]): see atomate.utils.compression.benchmark_codecs
+        """
+        files = self.db["{}.files".format(collection)].find({}, ["_id"]).sort(
+            "uploadDate", DESCENDING).limit(limit)
+        samples = [self.get_gridfs_file(collection, f["_id"]).read() for f in files]
+        return benchmark_codecs(samples, codecs, repeat)
+
+    def insert_chgcar(self, chgcar, collection="chgcar_fs", task_id=None, encoding="json",
+                      oid=None):
+        """
+        Insert a Chgcar (CHGCAR or AECCAR) into GridFS.
+
+        Args:
+            chgcar (Chgcar): the charge density
+            collection (string): the GridFS collection name
+            task_id(int or str): the task_id to store into the gridfs metadata
+            oid (ObjectId()): the _id of the file; if specified, it must not already exist in GridFS
+            encoding (str): "json" for compressed JSON, or "float64" or
+                "float32" for a binary blob of that precision
+        Returns:
+            file id, the type of compression used.
+        """
+        if encoding == "json":
+            return self.insert_gridfs(json.dumps(chgcar, cls=MontyEncoder), collection,
+                                      oid=oid, task_id=task_id)
+        return self.insert_gridfs_blob(lambda f: write_chgcar_blob(f, chgcar, dtype=encoding),
+                                       collection, oid=oid, task_id=task_id)
+
+    def insert_dos(self, dos, collection="dos_fs", task_id=None, encoding="json", oid=None):
+        """
+        Insert a DOS into GridFS.
+
+        Args:
+            dos (dict): CompleteDos.as_dict()
+            collection (string): the GridFS collection name
+            task_id(int or str): the task_id to store into the gridfs metadata
+            oid (ObjectId()): the _id of the file; if specified, it must not already exist in GridFS
+            encoding (str): "json" for compressed JSON, or "float64" or
+                "float32" for a binary blob of that precision
+        Returns:
+            file id, the type of compression used.
+        """
+        if encoding == "json":
+            return self.insert_gridfs(json.dumps(dos, cls=MontyEncoder), collection,
+                                      oid=oid, task_id=task_id)
+        return self.insert_gridfs_blob(lambda f: write_dos_blob(f, dos, dtype=encoding),
+                                       collection, oid=oid, task_id=task_id)
+
+    def insert_band_structure(self, bs, collection="bandstructure_fs", task_id=None,
+                              encoding="json", oid=None):
+        """
+        Insert a band structure into GridFS. With a binary encoding the
+        projections, if any, are stored in the "bandstructure_projections_fs"
+        collection and their file id in the metadata of the band structure file.
+
+        Args:
+            bs (dict): BandStructure.as_dict() or BandStructureSymmLine.as_dict()
+            collection (string): the GridFS collection name
+            task_id(int or str): the task_id to store into the gridfs metadata
+            oid (ObjectId()): the _id of the file; if specified, it must not already exist in GridFS
+            encoding (str): "json" for compressed JSON, or "float64" or
+                "float32" for binary blobs of that precision
+        Returns:
+            file id, the type of compression used.
+        """
+        if encoding == "json":
+            return self.insert_gridfs(json.dumps(bs, cls=MontyEncoder), collection,
+                                      oid=oid, task_id=task_id)
+        metadata = {}
+        if bs.get("projections"):
+            metadata["projections_fs_id"], _ = self.insert_gridfs_blob(
+                lambda f: write_bs_projections_blob(f, bs, dtype=encoding),
+                "bandstructure_projections_fs", task_id=task_id)
+        return self.insert_gridfs_blob(lambda f: write_bandstructure_blob(f, bs, dtype=encoding),
+                                       collection, oid=oid, task_id=task_id, metadata=metadata)
+
+    def insert_force_constants(self, arrays, collection="force_constants_fs", task_id=None,
+                               oid=None):
+        """
+        Insert the force constants and normal modes of a calc into GridFS as a
+        binary array blob.
+
+        Args:
+            arrays (dict): name -> array, for the keys of FORCE_CONSTANTS_KEYS
+            collection (string): the GridFS collection name
+            task_id(int or str): the task_id to store into the gridfs metadata
+            oid (ObjectId()): the _id of the file; if specified, it must not already exist in GridFS
+        Returns:
+            file id, the type of compression used.
+        """
+        arrays = {k: np.asarray(v, dtype="float64") for k, v in arrays.items()}
+        return self.insert_gridfs_blob(lambda f: write_array_blob(f, arrays), collection,
+                                       oid=oid, task_id=task_id)
+
+    def get_calc_array(self, calc, key):
+        """
+        Read the force constants or normal modes of a calc (an item of
+        calcs_reversed), whether they are stored in GridFS or in the task doc.
+        Only the requested array is downloaded.
+
+        Args:
+            calc (dict): the calc
+            key (str): "force_constants", "normalmode_eigenvals" or "normalmode_eigenvecs"
+        Returns:
+            numpy array
+        """
+        if "force_constants_fs_id" in calc:
+            f = self.get_gridfs_file("force_constants_fs", calc["force_constants_fs_id"])
+            return read_blob_array(f, key)
+        value = calc["output"][key]
+        if _is_offloaded_stub(value):
+            # moved to GridFS for size, see offload_fields
+            value = self.load_offloaded_value(value)
+        return np.array(value)
+
+    def get_force_constants(self, task_id, calc_index=-1):
+        """
+        Read the force constants of a task.
+
+        Args:
+            task_id(int or str): the task_id
+            calc_index (int): index of the calc in calcs_reversed, by default
+                the first calc of the run
+        Returns:
+            numpy array
+        """
+        return self.get_calc_array(self._get_calc(task_id, calc_index), "force_constants")
+
+    def get_normalmodes(self, task_id, calc_index=-1):
+        """
+        Read the normal mode eigenvalues and eigenvectors of a task.
+
+        Args:
+            task_id(int or str): the task_id
+            calc_index (int): index of the calc in calcs_reversed, by default
+                the first calc of the run
+        Returns:
+            (numpy array, numpy array): eigenvalues, eigenvectors
+        """
+        calc = self._get_calc(task_id, calc_index)
+        return (self.get_calc_array(calc, "normalmode_eigenvals"),
+                self.get_calc_array(calc, "normalmode_eigenvecs"))
+
+    def get_trajectory(self, task_id, calc_index=0, columns=None):
+        """
+        Read the columns of the ionic steps of a calc stored with
+        use_gridfs_trajectory, without rebuilding the steps. Only the
+        requested columns are downloaded.
+
+        Args:
+            task_id(int or str): the task_id
+            calc_index (int): index of the calc in calcs_reversed, by default
+                the last calc of the run
+            columns ([str]): e.g. ["lattice", "frac_coords", "forces", "stress",
+                "e_fr_energy", "electronic_offsets"]. Default: all columns.
+        Returns:
+            (dict, dict): metadata (species, site properties, number of steps,
+                ...) and column name -> numpy array with one row per step
+        """
+        calc = self._get_calc(task_id, calc_index)
+        f = self.get_gridfs_file("trajectory_fs", calc["trajectory_fs_id"])
+        return read_array_blob(f, columns)
+
+    def get_ionic_steps(self, task_id, calc_index=0, steps=None, columns=None):
+        """
+        Rebuild (some of) the ionic steps of a calc, whether they are stored
+        in GridFS or in the task doc.
+
+        Args:
+            task_id(int or str): the task_id
+            calc_index (int): index of the calc in calcs_reversed, by default
+                the last calc of the run
+            steps ([int]): indices of the steps, e.g. [-1] for the final step.
+                Default: all steps.
+            columns ([str]): columns to read, see get_trajectory, e.g. ["stress"]
+                for the stresses only. The electronic steps need the
+                "electronic_offsets" column. Default: all columns, i.e. complete steps.
+        Returns:
+            ([dict]): the ionic steps
+        """
+        calc = self._get_calc(task_id, calc_index)
+        if "trajectory_fs_id" not in calc:
+            ionic_steps = calc["output"]["ionic_steps"]
+            return ionic_steps if steps is None else [ionic_steps[i] for i in steps]
+        f = self.get_gridfs_file("trajectory_fs", calc["trajectory_fs_id"])
+        return get_ionic_steps(*read_array_blob(f, columns), steps=steps)
+
+    def _get_calc(self, task_id, calc_index):
+        """
+        Fetch a single calc of calcs_reversed, with its fields moved to GridFS
+        for size (see offload_fields) put back.
+        """
+        m_task = self.collection.find_one({"task_id": task_id},
+                                          {"task_id": 1, "_offloaded": 1,
+                                           "calcs_reversed": {"$slice": [calc_index, 1]}})
+        offloaded = [p.split(".") for p in m_task.get("_offloaded", [])
+                     if p.split(".")[0] == "calcs_reversed"]
+        if ["calcs_reversed"] in offloaded:
+            return self.load_offloaded_value(m_task["calcs_reversed"])[calc_index]
+        calc = m_task["calcs_reversed"][0]
+        # the index of the calc is not known for a negative calc_index, so the
+        # stubs are found at the paths moved from any calc
+        for keys in offloaded:
+            if calc_index >= 0 and int(keys[1]) != calc_index:
+                continue
+            if len(keys) == 2:
+                if _is_offloaded_stub(calc):
+                    calc = self.load_offloaded_value(calc)
+                continue
+            try:
+                parent, key = _get_parent(calc, ".".join(keys[2:]))
+                stub = parent[key]
+            except (KeyError, IndexError, TypeError, ValueError):
+                continue
+            if _is_offloaded_stub(stub):
+                parent[key] = self.load_offloaded_value(stub)
+        return calc
+
+    def get_band_structure(self, task_id, projections=True):
+        """
+        Read the band structure of a task.
+
+        Args:
+            task_id(int or str): the task_id
+            projections (bool): whether to read the projections. A band
+                structure stored as JSON always comes with them.
+        Returns:
+            BandStructure or BandStructureSymmLine
+        """
+        return self._load_band_structure(self._get_fs_id(task_id, "bandstructure"), projections)
+
+    def _load_band_structure(self, fs_id, projections=True):
+        """
+        Read a band structure by GridFS file id, through the object cache.
+        """
+        return self._get_cached(
+            "bandstructure_fs", fs_id, "projections" if projections else "bands",
+            lambda: self._read_band_structure(self.get_gridfs_file("bandstructure_fs", fs_id), projections))
+
+    def _read_band_structure(self, f, projections=True):
+        """
+        Read a band structure from its GridFS file, stored either as binary
+        arrays or as compressed JSON.
+        """
+        if (f.metadata or {}).get("encoding") == BLOB_ENCODING:
+            return read_bandstructure_blob(f, self._get_bs_projections_file(f) if projections else None)
+        bs_dict = json.loads(f.read().decode())
         if bs_dict["@class"] == "BandStructure":
             return BandStructure.from_dict(bs_dict)
         elif bs_dict["@class"] == "BandStructureSymmLine":
@@ -225,20 +817,155 @@ class VaspCalcDb(CalcDb):
         else:
             raise ValueError("Unknown class for band structure! {}".format(bs_dict["@class"]))
 
+    def get_band_branch(self, task_id, branch, projections=False):
+        """
+        Read a single high-symmetry branch of a line-mode band structure. For
+        a band structure stored as binary arrays only the eigenvalues (and
+        projections) of that branch are downloaded.
+
+        Args:
+            task_id(int or str): the task_id
+            branch (int or str): index of the branch, or its name, e.g. "\\Gamma-X"
+            projections (bool): whether to read the projections
+        Returns:
+            BandStructureSymmLine: band structure of the branch
+        """
+        f, proj = self._get_bs_blobs(task_id, projections)
+        return read_bandstructure_blob(f, proj, branch=branch)
+
+    def get_band_edges(self, task_id, nbands=2, projections=False):
+        """
+        Read the bands around the Fermi level of a band structure, e.g. the
+        top valence and bottom conduction bands of a semiconductor. For a band
+        structure stored as binary arrays only the eigenvalues (and
+        projections) of these bands are downloaded.
+
+        Args:
+            task_id(int or str): the task_id
+            nbands (int): number of bands read on each side of the Fermi level
+            projections (bool): whether to read the projections
+        Returns:
+            (BandStructure, [int]): band structure with the selected bands only,
+                and the indices of these bands in the full band structure
+        """
+        f, proj = self._get_bs_blobs(task_id, projections)
+        return read_band_edges(f, nbands, proj)
+
+    def _get_bs_file(self, task_id):
+        return self.get_gridfs_file('bandstructure_fs', self._get_fs_id(task_id, 'bandstructure'))
+
+    def _get_bs_projections_file(self, f):
+        fs_id = (f.metadata or {}).get("projections_fs_id")
+        return self.get_gridfs_file('bandstructure_projections_fs', fs_id) if fs_id else None
+
+    def _get_bs_blobs(self, task_id, projections):
+        """
+        Band structure and projections blobs of a task; a band structure
+        stored as JSON is read in full and re-encoded.
+        """
+        f = self._get_bs_file(task_id)
+        if (f.metadata or {}).get("encoding") == BLOB_ENCODING:
+            return f, self._get_bs_projections_file(f) if projections else None
+        bs = self.get_band_structure(task_id).as_dict()
+        f = io.BytesIO()
+        write_bandstructure_blob(f, bs)
+        f.seek(0)
+        proj = None
+        if projections and bs.get("projections"):
+            proj = io.BytesIO()
+            write_bs_projections_blob(proj, bs)
+            proj.seek(0)
+        return f, proj
+
     def get_dos(self, task_id):
-        m_task = self.collection.find_one({"task_id": task_id}, {"calcs_reversed": 1})
-        fs_id = m_task['calcs_reversed'][0]['dos_fs_id']
-        fs = gridfs.GridFS(self.db, 'dos_fs')
-        dos_json = zlib.decompress(fs.get(fs_id).read())
-        dos_dict = json.loads(dos_json.decode())
+        return self._load_dos(self._get_fs_id(task_id, "dos"))
+
+    def _load_dos(self, fs_id):
+        """
+        Read a CompleteDos by GridFS file id, through the object cache.
+        """
+        return self._get_cached("dos_fs", fs_id, "dos",
+                                lambda: self._read_dos(self.get_gridfs_file("dos_fs", fs_id)))
+
+    def _read_dos(self, f):
+        """
+        Read a CompleteDos from its GridFS file, stored either as binary
+        arrays or as compressed JSON.
+        """
+        if (f.metadata or {}).get("encoding") == BLOB_ENCODING:
+            return read_dos_blob(f)
+        dos_dict = json.loads(f.read().decode())
         return CompleteDos.from_dict(dos_dict)
 
+    def get_total_dos(self, task_id):
+        """
+        Read the total DOS of a task, without the projections.
+
+        Args:
+            task_id(int or str): the task_id
+        Returns:
+            Dos
+        """
+        return self.get_partial_dos(task_id)
+
+    def get_partial_dos(self, task_id, element=None, orbital=None, sites=None):
+        """
+        Read the DOS projected on some sites and orbitals, summed. For a DOS
+        stored as binary arrays only the densities of the selected sites are
+        downloaded; a DOS stored as JSON is read in full.
+
+        Args:
+            task_id(int or str): the task_id
+            element (str): only the sites of this element, e.g. "Fe"
+            orbital (str): only this orbital, e.g. "dxy", or all orbitals of this
+                type, i.e. "s", "p", "d" or "f"
+            sites ([int]): only these sites
+        Returns:
+            Dos: the total DOS if no selection is given, else the projected DOS
+        """
+        f = self._get_dos_file(task_id)
+        if (f.metadata or {}).get("encoding") != BLOB_ENCODING:
+            f = io.BytesIO()
+            write_dos_blob(f, self.get_dos(task_id).as_dict())
+            f.seek(0)
+        return read_partial_dos(f, element=element, orbital=orbital, sites=sites)
+
+    def _get_dos_file(self, task_id):
+        return self.get_gridfs_file('dos_fs', self._get_fs_id(task_id, 'dos'))
+
+    def _get_fs_id(self, task_id, key):
+        """
+        GridFS file id of the given data (e.g. "dos") of the last calc of a task.
+        """
+        m_task = self.collection.find_one({"task_id": task_id},
+                                          {"calcs_reversed.{}_fs_id".format(key): 1,
+                                           "_offloaded": 1})
+        if {"calcs_reversed", "calcs_reversed.0"} & set(m_task.get("_offloaded", [])):
+            # the calc itself was moved to GridFS for size
+            return self._get_calc(task_id, 0)['{}_fs_id'.format(key)]
+        return m_task['calcs_reversed'][0]['{}_fs_id'.format(key)]
+
+    def _get_cached(self, collection, fs_id, variant, read):
+        """
+        Object decoded from a GridFS file, from the object cache if there is
+        one (see CalcDb). GridFS files are never modified, so the file id
+        identifies the data.
+
+        Args:
+            collection (string): the GridFS collection name
+            fs_id (ObjectId): the file id
+            variant (str): what is decoded from the file, e.g. "bands" for a
+                band structure without its projections
+            read (callable): function reading the object from GridFS
+        """
+        if self.object_cache is None:
+            return read()
+        return self.object_cache.get("{}_{}_{}".format(collection, fs_id, variant), read)
+
     def get_chgcar_string(self, task_id):
         # Not really used now, consier deleting
-        m_task = self.collection.find_one({"task_id": task_id}, {"calcs_reversed": 1})
-        fs_id = m_task['calcs_reversed'][0]['chgcar_fs_id']
-        fs = gridfs.GridFS(self.db, 'chgcar_fs')
-        return zlib.decompress(fs.get(fs_id).read())
+        fs_id = self._get_fs_id(task_id, 'chgcar')
+        return self.get_gridfs_file('chgcar_fs', fs_id).read()
 
     def get_chgcar(self, task_id):
         """
@@ -248,12 +975,8 @@ class VaspCalcDb(CalcDb):
         Returns:
             chgcar: Chgcar object
         """
-        m_task = self.collection.find_one({"task_id": task_id}, {"calcs_reversed": 1})
-        fs_id = m_task['calcs_reversed'][0]['chgcar_fs_id']
-        fs = gridfs.GridFS(self.db, 'chgcar_fs')
-        chgcar_json = zlib.decompress(fs.get(fs_id).read())
-        chgcar= json.loads(chgcar_json, cls=MontyDecoder)
-        return chgcar
+        fs_id = self._get_fs_id(task_id, 'chgcar')
+        return self._read_chgcar(fs_id, 'chgcar_fs')
 
     def get_aeccar(self, task_id, check_valid = True):
         """
@@ -264,25 +987,57 @@ class VaspCalcDb(CalcDb):
         Returns:
             {"aeccar0" : Chgcar, "aeccar2" : Chgcar}: dict of Chgcar objects
         """
-        m_task = self.collection.find_one({"task_id": task_id}, {"calcs_reversed": 1})
-        fs_id = m_task['calcs_reversed'][0]['aeccar0_fs_id']
-        fs = gridfs.GridFS(self.db, 'aeccar0_fs')
-        aeccar_json = zlib.decompress(fs.get(fs_id).read())
-        aeccar0 = json.loads(aeccar_json, cls=MontyDecoder)
-        fs_id = m_task['calcs_reversed'][0]['aeccar2_fs_id']
-        fs = gridfs.GridFS(self.db, 'aeccar2_fs')
-        aeccar_json = zlib.decompress(fs.get(fs_id).read())
-        aeccar2 = json.loads(aeccar_json, cls=MontyDecoder)
+        m_task = self.collection.find_one({"task_id": task_id}, {"calcs_reversed.aeccar0_fs_id": 1,
+                                                                 "calcs_reversed.aeccar2_fs_id": 1})
+        aeccar0 = self._read_chgcar(m_task['calcs_reversed'][0]['aeccar0_fs_id'], 'aeccar0_fs')
+        aeccar2 = self._read_chgcar(m_task['calcs_reversed'][0]['aeccar2_fs_id'], 'aeccar2_fs')
 
         if check_valid and (aeccar0.data['total'] + aeccar2.data['total']).min() < 0:
             ValueError(f"The AECCAR seems to be corrupted for task_id = {task_id}")
 
         return {'aeccar0': aeccar0, 'aeccar2': aeccar2}
 
+    def get_chgcar_grid(self, task_id, key="total", chgcar_type="chgcar", filename=None):
+        """
+        Read a single grid of a binary stored CHGCAR or AECCAR, without
+        building a Chgcar. Only the bytes of that grid are downloaded.
+
+        Args:
+            task_id(int or str): the task_id containing the gridfs metadata
+            key (str): the grid, "total" or "diff"
+            chgcar_type (str): "chgcar", "aeccar0" or "aeccar2"
+            filename (str): if set, the whole blob is saved to this local file
+                and the grid is memory-mapped from it
+        Returns:
+            numpy array of the grid
+        """
+        fs_id = self._get_fs_id(task_id, chgcar_type)
+        f = self.get_gridfs_file('{}_fs'.format(chgcar_type), fs_id)
+        if (f.metadata or {}).get("encoding") != BLOB_ENCODING:
+            raise ValueError("The {} of task_id = {} is not stored as a binary blob".format(
+                chgcar_type, task_id))
+        if filename:
+            with open(filename, "wb") as out:
+                shutil.copyfileobj(f, out)
+            return memmap_blob_array(filename, key)
+        return read_blob_array(f, key)
+
+    def _read_chgcar(self, fs_id, collection):
+        """
+        Read a Chgcar from GridFS, stored either as a binary blob or as
+        compressed JSON, through the object cache.
+        """
+        def read():
+            f = self.get_gridfs_file(collection, fs_id)
+            if (f.metadata or {}).get("encoding") == BLOB_ENCODING:
+                return read_chgcar_blob(f)
+            return json.loads(f.read(), cls=MontyDecoder)
+
+        return self._get_cached(collection, fs_id, "chgcar", read)
+
     def reset(self):
         self.collection.delete_many({})
-        self.db.counter.delete_one({"_id": "taskid"})
-        self.db.counter.insert_one({"_id": "taskid", "c": 0})
+        self.reset_counter()
         self.db.boltztrap.delete_many({})
         self.db.dos_fs.files.delete_many({})
         self.db.dos_fs.chunks.delete_many({})
@@ -290,6 +1045,14 @@ class VaspCalcDb(CalcDb):
         self.db.dos_boltztrap_fs.chunks.delete_many({})
         self.db.bandstructure_fs.files.delete_many({})
         self.db.bandstructure_fs.chunks.delete_many({})
+        self.db.bandstructure_projections_fs.files.delete_many({})
+        self.db.bandstructure_projections_fs.chunks.delete_many({})
+        self.db.force_constants_fs.files.delete_many({})
+        self.db.force_constants_fs.chunks.delete_many({})
+        self.db.trajectory_fs.files.delete_many({})
+        self.db.trajectory_fs.chunks.delete_many({})
+        self.db[self.offload_collection].files.delete_many({})
+        self.db[self.offload_collection].chunks.delete_many({})
         self.build_indexes()
 
 
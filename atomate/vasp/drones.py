@@ -14,7 +14,10 @@ from fnmatch import fnmatch
 from collections import OrderedDict
 import json
 import glob
+import multiprocessing
 import traceback
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 from monty.io import zopen
 from monty.json import jsanitize
@@ -24,15 +27,16 @@ import numpy as np
 
 from pymatgen.core.composition import Composition
 from pymatgen.core.structure import Structure
-from pymatgen.core.operations import SymmOp
 from pymatgen.electronic_structure.bandstructure import BandStructureSymmLine
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
-from pymatgen.io.vasp import BSVasprun, Vasprun, Outcar, Locpot, Chgcar
+from pymatgen.io.vasp import Outcar, Locpot, Chgcar
 from pymatgen.io.vasp.inputs import Poscar, Potcar, Incar, Kpoints
 from pymatgen.apps.borg.hive import AbstractDrone
 from pymatgen.command_line.bader_caller import bader_analysis_from_path
 
 from atomate.utils.utils import get_uri
+from atomate.utils.profiling import StageProfiler
+from atomate.utils.symmetry import get_symmetry
+from atomate.vasp.parsers import StreamingVasprun, read_vasprun_incar, read_outcar_tail
 
 from atomate.utils.utils import get_logger
 from atomate import __version__ as atomate_version
@@ -46,6 +50,17 @@ logger = get_logger(__name__)
 
 bader_exe_exists = which("bader") or which("bader.exe")
 
+
+def _call_drone(drone, method, args):
+    """
+    Run a drone method in a worker process and return its result together
+    with the parse counts and the profiled stages of the worker.
+    """
+    drone._parse_counts.clear()
+    drone._profiler = StageProfiler(enabled=drone.profile)
+    return getattr(drone, method)(*args), drone._parse_counts, drone._profiler.stages
+
+
 class VaspDrone(AbstractDrone):
     """
     pymatgen-db VaspToDbTaskDrone with updated schema and documents processing methods.
@@ -54,6 +69,9 @@ class VaspDrone(AbstractDrone):
 
     __version__ = atomate_version  # note: the version is inserted into the task doc
 
+    # key output files hashed to detect changed runs on re-ingestion
+    fingerprint_patterns = ("vasprun.xml*", "OUTCAR*")
+
     # Schema def of important keys and sub-keys; used in validation
     schema = {
         "root": {
@@ -82,7 +100,8 @@ class VaspDrone(AbstractDrone):
 
     def __init__(self, runs=None, parse_dos="auto", bandstructure_mode="auto",
                  parse_locpot=True, additional_fields=None, use_full_uri=True,
-                 parse_bader=bader_exe_exists, parse_chgcar=False, parse_aeccar=False):
+                 parse_bader=bader_exe_exists, parse_chgcar=False, parse_aeccar=False,
+                 parallel=False, outcar_mode="full", profile=False):
         """
         Initialize a Vasp drone to parse vasp outputs
         Args:
@@ -105,6 +124,17 @@ class VaspDrone(AbstractDrone):
             parse_bader (bool): Run and parse Bader charge data. Defaults to True if Bader is present
             parse_chgcar (bool): Run and parse CHGCAR file
             parse_aeccar (bool): Run and parse AECCAR0 and AECCAR2 files
+            parallel (bool): Parse all the vasprun.xml and OUTCAR files of a run
+             (e.g. relax1, relax2) at the same time in a process pool
+            outcar_mode (str): How to parse the OUTCAR files, "full" or "tail".
+             "tail" reads only the end of the file (run stats, magnetization, charge,
+             final drift) instead of the whole file; the electrostatic potential is
+             not parsed and only the final drift is kept. Compressed files are
+             still decompressed in full, only the parsing is saved. Files with
+             LEPSILON, LCALCPOL, NMR or DFPT data are always parsed in full.
+            profile (bool): Record the wall time and peak memory of each stage of
+             the parsing (vasprun, outcar, bandstructure, symmetry, bader, ...) in
+             the "_profile" key of the task doc
         """
         self.parse_dos = parse_dos
         self.additional_fields = additional_fields or {}
@@ -116,6 +146,11 @@ class VaspDrone(AbstractDrone):
         self.parse_bader = parse_bader
         self.parse_chgcar = parse_chgcar
         self.parse_aeccar = parse_aeccar
+        self.parallel = parallel
+        self.outcar_mode = outcar_mode
+        self.profile = profile
+        self._parse_counts = Counter()
+        self._profiler = StageProfiler(enabled=False)
 
     def assimilate(self, path):
         """
@@ -131,14 +166,19 @@ class VaspDrone(AbstractDrone):
             (dict): a task dictionary
         """
         logger.info("Getting task doc for base dir :{}".format(path))
+        self._parse_counts.clear()
+        self._profiler = StageProfiler(enabled=self.profile)
         vasprun_files = self.filter_files(path, file_pattern="vasprun.xml")
         outcar_files = self.filter_files(path, file_pattern="OUTCAR")
         if len(vasprun_files) > 0 and len(outcar_files) > 0:
             d = self.generate_doc(path, vasprun_files, outcar_files)
-            self.post_process(path, d)
+            with self._profiler.stage("post_process"):
+                self.post_process(path, d)
         else:
             raise ValueError("No VASP files found!")
         self.validate_doc(d)
+        if self.profile:
+            d["_profile"] = self._profiler.as_dict()
         return d
 
     def filter_files(self, path, file_pattern="vasprun.xml"):
@@ -188,13 +228,13 @@ class VaspDrone(AbstractDrone):
             d = jsanitize(self.additional_fields, strict=True)
             d["schema"] = {"code": "atomate", "version": VaspDrone.__version__}
             d["dir_name"] = fullpath
-            d["calcs_reversed"] = [self.process_vasprun(dir_name, taskname, filename)
-                                   for taskname, filename in vasprun_files.items()]
-            outcar_data = [Outcar(os.path.join(dir_name, filename)).as_dict()
-                           for taskname, filename in outcar_files.items()]
+            d["calcs_reversed"], outcar_data = self.parse_files(dir_name, vasprun_files,
+                                                                 outcar_files)
             run_stats = {}
             for i, d_calc in enumerate(d["calcs_reversed"]):
                 run_stats[d_calc["task"]["name"]] = outcar_data[i].pop("run_stats")
+                outcar_file = os.path.join(dir_name, list(outcar_files.values())[i])
+                d_calc["parse_counts"]["outcar"] = self._parse_counts[outcar_file]
                 if d_calc.get("output"):
                     d_calc["output"].update({"outcar": outcar_data[i]})
                 else:
@@ -281,29 +321,31 @@ class VaspDrone(AbstractDrone):
                     raise
 
             # Store symmetry information
-            sg = SpacegroupAnalyzer(Structure.from_dict(d_calc_final["output"]["structure"]), 0.1)
-            if not sg.get_symmetry_dataset():
-                sg = SpacegroupAnalyzer(Structure.from_dict(d_calc_final["output"]["structure"]),
-                                        1e-3, 1)
+            with self._profiler.stage("symmetry"):
+                final_structure = Structure.from_dict(d_calc_final["output"]["structure"])
+                sym = get_symmetry(final_structure, 0.1)
+                if not sym:
+                    sym = get_symmetry(final_structure, 1e-3, 1)
             d["output"]["spacegroup"] = {
                 "source": "spglib",
-                "symbol": sg.get_space_group_symbol(),
-                "number": sg.get_space_group_number(),
-                "point_group": sg.get_point_group_symbol(),
-                "crystal_system": sg.get_crystal_system(),
-                "hall": sg.get_hall()}
+                "symbol": sym["symbol"],
+                "number": sym["number"],
+                "point_group": sym["point_group"],
+                "crystal_system": sym["crystal_system"],
+                "hall": sym["hall"]}
 
             # store dieelctric and piezo information
             if d["input"]["parameters"].get("LEPSILON"):
                 for k in ['epsilon_static', 'epsilon_static_wolfe', 'epsilon_ionic']:
                     d["output"][k] = d_calc_final["output"][k]
-                if SymmOp.inversion() not in sg.get_symmetry_operations():
+                if not sym["has_inversion"]:
                     for k in ["piezo_ionic_tensor", "piezo_tensor"]:
                         d["output"][k] = d_calc_final["output"]["outcar"][k]
 
             d["state"] = "successful" if d_calc["has_vasp_completed"] else "unsuccessful"
 
-            self.set_analysis(d)
+            with self._profiler.stage("analysis"):
+                self.set_analysis(d)
 
             d["last_updated"] = datetime.datetime.utcnow()
             return d
@@ -313,6 +355,55 @@ class VaspDrone(AbstractDrone):
             logger.error("Error in " + os.path.abspath(dir_name) + ".\n" + traceback.format_exc())
             raise
 
+    def parse_files(self, dir_name, vasprun_files, outcar_files):
+        """
+        Parse all the vasprun.xml and OUTCAR files of a run. The files are
+        independent, so if self.parallel is set they are parsed at the same
+        time in a process pool, largest files first. A drone used in a child
+        process, e.g. a worker of the process pool of a BulkIngester, parses
+        them one after the other, so that process pools are not nested: the
+        daemonic workers of a pool can not start processes.
+
+        Args:
+            dir_name (str): path to the run directory
+            vasprun_files (OrderedDict): task name -> vasprun.xml file name
+            outcar_files (OrderedDict): task name -> OUTCAR file name
+
+        Returns:
+            (list, list): processed vasprun docs and OUTCAR dicts, in the
+                order of the given files
+        """
+        jobs = [("process_vasprun", (dir_name, taskname, filename))
+                for taskname, filename in vasprun_files.items()]
+        jobs += [("process_outcar", (dir_name, filename)) for filename in outcar_files.values()]
+
+        if self.parallel and len(jobs) > 1 and \
+                multiprocessing.current_process().name == "MainProcess":
+            results = [None] * len(jobs)
+            order = sorted(range(len(jobs)), reverse=True,
+                           key=lambda i: os.path.getsize(os.path.join(dir_name, jobs[i][1][-1])))
+            nworkers = min(len(jobs), os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=nworkers) as executor:
+                futures = {i: executor.submit(_call_drone, self, *jobs[i]) for i in order}
+                for i, future in futures.items():
+                    results[i], parse_counts, stages = future.result()
+                    self._parse_counts.update(parse_counts)
+                    self._profiler.update(stages)
+        else:
+            results = [getattr(self, method)(*args) for method, args in jobs]
+
+        return results[:len(vasprun_files)], results[len(vasprun_files):]
+
+    def process_outcar(self, dir_name, filename):
+        """
+        Process an OUTCAR file.
+        """
+        outcar_file = os.path.join(dir_name, filename)
+        with self._profiler.stage("outcar"):
+            if self.outcar_mode == "tail":
+                return self._parse(read_outcar_tail, outcar_file)
+            return self._parse(Outcar, outcar_file).as_dict()
+
     def process_vasprun(self, dir_name, taskname, filename):
         """
         Adapted from matgendb.creator
@@ -321,9 +412,15 @@ class VaspDrone(AbstractDrone):
         """
         vasprun_file = os.path.join(dir_name, filename)
 
-        vrun = Vasprun(vasprun_file)
+        # parse the file once, skipping the projections and the DOS unless they are
+        # needed; the band structure, DOS and band gap below are all built from this object
+        with self._profiler.stage("vasprun"):
+            incar = read_vasprun_incar(vasprun_file)
+            vrun = self._parse(StreamingVasprun, vasprun_file,
+                               parse_dos=self._needs_dos(incar),
+                               parse_projected_eigen=self._needs_projections(incar))
 
-        d = vrun.as_dict()
+            d = vrun.as_dict()
 
         # rename formula keys
         for k, v in {"formula_pretty": "pretty_formula",
@@ -331,10 +428,6 @@ class VaspDrone(AbstractDrone):
                      "composition_unit_cell": "unit_cell_formula"}.items():
             d[k] = d.pop(v)
 
-        for k in ["eigenvalues", "projected_eigenvalues"]:  # large storage space breaks some docs
-            if k in d["output"]:
-                del d["output"][k]
-
         comp = Composition(d["composition_unit_cell"])
         d["formula_anonymous"] = comp.anonymized_formula
         d["formula_reduced_abc"] = comp.reduced_composition.alphabetical_formula
@@ -349,69 +442,81 @@ class VaspDrone(AbstractDrone):
             d["output"][k] = d["output"].pop(v)
 
         # Process bandstructure and DOS
-        if self.bandstructure_mode != False:
-            bs = self.process_bandstructure(vrun)
-            if bs:
-                d["bandstructure"] = bs
+        with self._profiler.stage("bandstructure"):
+            bs = None
+            if self.bandstructure_mode != False:
+                bs, store_bs = self.process_bandstructure(vrun)
+                if bs and store_bs:
+                    d["bandstructure"] = bs.as_dict()
 
         if self.parse_dos != False:
-            dos = self.process_dos(vrun)
+            with self._profiler.stage("dos"):
+                dos = self.process_dos(vrun)
             if dos:
                 d["dos"] = dos
 
         # Parse electronic information if possible.
         # For certain optimizers this is broken and we don't get an efermi resulting in the bandstructure
-        try:
-            bs = vrun.get_band_structure()
-            bs_gap = bs.get_band_gap()
-            d["output"]["vbm"] = bs.get_vbm()["energy"]
-            d["output"]["cbm"] = bs.get_cbm()["energy"]
-            d["output"]["bandgap"] = bs_gap["energy"]
-            d["output"]["is_gap_direct"] = bs_gap["direct"]
-            d["output"]["is_metal"] = bs.is_metal()
-            if not bs_gap["direct"]:
-                d["output"]["direct_gap"] = bs.get_direct_band_gap()
-            if isinstance(bs, BandStructureSymmLine):
-                d["output"]["transition"] = bs_gap["transition"]
+        with self._profiler.stage("bandstructure"):
+            try:
+                if bs is None:
+                    bs = vrun.get_band_structure()
+                bs_gap = bs.get_band_gap()
+                d["output"]["vbm"] = bs.get_vbm()["energy"]
+                d["output"]["cbm"] = bs.get_cbm()["energy"]
+                d["output"]["bandgap"] = bs_gap["energy"]
+                d["output"]["is_gap_direct"] = bs_gap["direct"]
+                d["output"]["is_metal"] = bs.is_metal()
+                if not bs_gap["direct"]:
+                    d["output"]["direct_gap"] = bs.get_direct_band_gap()
+                if isinstance(bs, BandStructureSymmLine):
+                    d["output"]["transition"] = bs_gap["transition"]
 
-        except Exception:
-            logger.warning("Error in parsing bandstructure")
-            if vrun.incar["IBRION"] == 1:
-                logger.warning("Vasp doesn't properly output efermi for IBRION == 1")
-            if self.bandstructure_mode is True:
-                logger.error(traceback.format_exc())
-                logger.error("Error in " + os.path.abspath(dir_name) + ".\n" + traceback.format_exc())
-                raise
+            except Exception:
+                logger.warning("Error in parsing bandstructure")
+                if vrun.incar["IBRION"] == 1:
+                    logger.warning("Vasp doesn't properly output efermi for IBRION == 1")
+                if self.bandstructure_mode is True:
+                    logger.error(traceback.format_exc())
+                    logger.error("Error in " + os.path.abspath(dir_name) + ".\n" + traceback.format_exc())
+                    raise
 
         # store run name and location ,e.g. relax1, relax2, etc.
         d["task"] = {"type": taskname, "name": taskname}
 
+        # record how many times the vasprun.xml was read, should always be 1
+        d["parse_counts"] = {"vasprun": self._parse_counts[vasprun_file]}
+
         # include output file names
         d["output_file_paths"] = self.process_raw_data(dir_name, taskname=taskname)
 
         # parse axially averaged locpot
         if "locpot" in d["output_file_paths"] and self.parse_locpot:
-            locpot = Locpot.from_file(os.path.join(dir_name, d["output_file_paths"]["locpot"]))
-            d["output"]["locpot"] = {i: locpot.get_average_along_axis(i) for i in range(3)}
+            with self._profiler.stage("locpot"):
+                locpot = Locpot.from_file(os.path.join(dir_name, d["output_file_paths"]["locpot"]))
+                d["output"]["locpot"] = {i: locpot.get_average_along_axis(i) for i in range(3)}
 
         if self.parse_chgcar != False:
             # parse CHGCAR file only for static calculations
             # TODO require static run later
             # if self.parse_chgcar == True and vrun.incar.get("NSW", 0) < 1:
             try:
-                chgcar = self.process_chgcar(os.path.join(dir_name, d["output_file_paths"]["chgcar"]))
+                with self._profiler.stage("chgcar"):
+                    chgcar = self.process_chgcar(os.path.join(dir_name, d["output_file_paths"]["chgcar"]))
             except:
                 raise ValueError("No valid charge data exist")
             d["chgcar"] = chgcar
 
         if self.parse_aeccar != False:
             try:
-                chgcar = self.process_chgcar(os.path.join(dir_name, d["output_file_paths"]["aeccar0"]))
+                with self._profiler.stage("chgcar"):
+                    chgcar = self.process_chgcar(os.path.join(dir_name, d["output_file_paths"]["aeccar0"]))
             except:
                 raise ValueError("No valid charge data exist")
             d["aeccar0"] = chgcar
             try:
-                chgcar = self.process_chgcar(os.path.join(dir_name, d["output_file_paths"]["aeccar2"]))
+                with self._profiler.stage("chgcar"):
+                    chgcar = self.process_chgcar(os.path.join(dir_name, d["output_file_paths"]["aeccar2"]))
             except:
                 raise ValueError("No valid charge data exist")
             d["aeccar2"] = chgcar
@@ -424,10 +529,11 @@ class VaspDrone(AbstractDrone):
 
         # Try and perform bader
         if self.parse_bader:
-            try:
-                bader = bader_analysis_from_path(dir_name, suffix=".{}".format(taskname))
-            except Exception as e:
-                bader = "Bader analysis failed: {}".format(e)
+            with self._profiler.stage("bader"):
+                try:
+                    bader = bader_analysis_from_path(dir_name, suffix=".{}".format(taskname))
+                except Exception as e:
+                    bader = "Bader analysis failed: {}".format(e)
             d["bader"] = bader
 
         return d
@@ -441,39 +547,77 @@ class VaspDrone(AbstractDrone):
         return chgcar
 
     def process_bandstructure(self, vrun):
+        """
+        Build the band structure from an already parsed Vasprun. The Vasprun
+        must have been parsed with projections if the band structure mode
+        requires them (see _needs_projections).
 
-        vasprun_file = vrun.filename
+        Args:
+            vrun (Vasprun): the parsed vasprun.xml
+
+        Returns:
+            (BandStructure, bool): the band structure (None if not parsed) and
+                whether it should be stored in the task doc
+        """
         # Band structure parsing logic
         if str(self.bandstructure_mode).lower() == "auto":
             # if NSCF calculation
             if vrun.incar.get("ICHARG", 0) > 10:
-                bs_vrun = BSVasprun(vasprun_file, parse_projected_eigen=True)
                 try:
                     # Try parsing line mode
-                    bs = bs_vrun.get_band_structure(line_mode=True)
+                    bs = vrun.get_band_structure(line_mode=True)
                 except:
                     # Just treat as a regular calculation
-                    bs = bs_vrun.get_band_structure()
+                    bs = vrun.get_band_structure()
             # else just regular calculation
             else:
-                bs_vrun = BSVasprun(vasprun_file, parse_projected_eigen=False)
-                bs = bs_vrun.get_band_structure()
+                bs = vrun.get_band_structure()
 
             # only save the bandstructure if not moving ions
-            if vrun.incar.get("NSW", 0) <= 1:
-                return bs.as_dict()
+            return bs, vrun.incar.get("NSW", 0) <= 1
 
         # legacy line/True behavior for bandstructure_mode
         elif self.bandstructure_mode:
-            bs_vrun = BSVasprun(vasprun_file, parse_projected_eigen=True)
-            bs = bs_vrun.get_band_structure(line_mode=(str(self.bandstructure_mode).lower() == "line"))
-            return bs.as_dict()
+            bs = vrun.get_band_structure(line_mode=(str(self.bandstructure_mode).lower() == "line"))
+            return bs, True
+
+        return None, False
+
+    def _needs_projections(self, incar):
+        """
+        Whether the vasprun.xml has to be parsed with projected eigenvalues
+        for the band structure mode of this drone. In "auto" mode only NSCF
+        calculations (ICHARG > 10) are parsed with projections.
+
+        Args:
+            incar (dict): INCAR tags as read by read_vasprun_incar
+        """
+        if str(self.bandstructure_mode).lower() == "auto":
+            return incar.get("ICHARG", 0) > 10
+        return bool(self.bandstructure_mode)
+
+    def _needs_dos(self, incar):
+        """
+        Whether the vasprun.xml has to be parsed with the DOS, i.e. whether
+        process_dos will store it.
+
+        Args:
+            incar (dict): INCAR tags as read by read_vasprun_incar
+        """
+        return self.parse_dos == True or (str(self.parse_dos).lower() == "auto" and
+                                          incar.get("NSW", 0) < 1)
 
-        return None
+    def _parse(self, parser, filename, **kwargs):
+        """
+        Parse a file with the given parser class and count the parse, so that
+        the task doc can record how often each file was read.
+        """
+        self._parse_counts[filename] += 1
+        return parser(filename, **kwargs)
 
     def process_dos(self, vrun):
         # parse dos if forced to or auto mode set and  0 ionic steps were performed -> static calculation and not DFPT
-        if self.parse_dos == True or (str(self.parse_dos).lower() == "auto" and vrun.incar.get("NSW", 0) < 1):
+        if self._needs_dos(vrun.incar):
             try:
                 return vrun.complete_dos.as_dict()
             except:
@@ -22,7 +22,6 @@ from pymatgen.analysis.elasticity.strain import Strain, Deformation
 from pymatgen.analysis.elasticity.stress import Stress
 from pymatgen.electronic_structure.boltztrap import BoltztrapAnalyzer
 from pymatgen.io.vasp.sets import get_vasprun_outcar
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 from pymatgen.analysis.ferroelectricity.polarization import Polarization, get_total_ionic_dipole, \
     EnergyTrend
 from pymatgen.analysis.magnetism import CollinearMagneticStructureAnalyzer, Ordering, magnetic_deformation
@@ -30,9 +29,12 @@ from pymatgen.command_line.bader_caller import bader_analysis_from_path
 
 from atomate.common.firetasks.glue_tasks import get_calc_loc
 from atomate.utils.utils import env_chk, get_meta_from_structure
+from atomate.utils.symmetry import get_symmetry
 from atomate.utils.utils import get_logger
+from atomate.utils.spool import TaskSpool
 from atomate.vasp.database import VaspCalcDb
 from atomate.vasp.drones import VaspDrone
+from atomate.vasp.parsers import StreamingVasprun
 
 __author__ = 'Anubhav Jain, Kiran Mathew, Shyam Dwaraknath'
 __email__ = 'ajain@lbl.gov, kmathew@lbl.gov, shyamd@lbl.gov'
@@ -72,10 +74,19 @@ class VaspToDb(FiretaskBase):
             The path is a full mongo-style path so subdocuments can be referneced
             using dot notation and array keys can be referenced using the index.
             E.g "calcs_reversed.0.output.outar.run_stats"
+        spool_dir (str): if set, the task doc and its GridFS data are written to
+            this local spool directory instead of the database, and moved to
+            the database of db_file by a separate sync process (see
+            atomate.utils.spool and "atdb sync"). The task_id is then assigned
+            by the sync, and is not in the stored_data. The children of the
+            Firework are paused until the task is synced, and the keys of
+            task_fields_to_push whose path is "task_id" are then set in their
+            spec; this needs "_add_launchpad_and_fw_id": True in the spec of
+            the Firework. Supports env_chk.
     """
     optional_params = ["calc_dir", "calc_loc", "parse_dos", "bandstructure_mode",
                        "additional_fields", "db_file", "fw_spec_field", "defuse_unsuccessful",
-                       "task_fields_to_push", "parse_chgcar", "parse_aeccar"]
+                       "task_fields_to_push", "parse_chgcar", "parse_aeccar", "spool_dir"]
 
     def run_task(self, fw_spec):
         # get the directory that contains the VASP dir to parse
@@ -103,18 +114,30 @@ class VaspToDb(FiretaskBase):
 
         # get the database connection
         db_file = env_chk(self.get('db_file'), fw_spec)
-
-        # db insertion or taskdoc dump
-        if not db_file:
+        spool_dir = env_chk(self.get('spool_dir'), fw_spec)
+        use_gridfs = self.get("parse_dos", False) or bool(self.get("bandstructure_mode", False)) \
+            or self.get("parse_chgcar", False) or self.get("parse_aeccar", False)
+
+        # db insertion, spooling or taskdoc dump
+        if spool_dir:
+            # the children must not look for the task before it is synced
+            if getattr(self, "launchpad", None) is None:
+                raise ValueError("VaspToDb with a spool_dir needs \"_add_launchpad_and_fw_id\": "
+                                 "True in the spec of its Firework")
+            for child in self.launchpad.get_wf_by_fw_id_lzyfw(self.fw_id).links[self.fw_id]:
+                self.launchpad.pause_fw(child)
+            spec_keys = [k for k, path in (self.get("task_fields_to_push") or {}).items()
+                         if path == "task_id"]
+            spool = TaskSpool.from_db_file(spool_dir, VaspCalcDb, db_file)
+            entry = spool.put(task_doc, fw_id=self.fw_id, spec_keys=spec_keys,
+                              use_gridfs=use_gridfs)
+            logger.info("Finished parsing, spooled as {}".format(entry))
+        elif not db_file:
             with open("task.json", "w") as f:
                 f.write(json.dumps(task_doc, default=DATETIME_HANDLER))
         else:
             mmdb = VaspCalcDb.from_db_file(db_file, admin=True)
-            t_id = mmdb.insert_task(
-                task_doc, use_gridfs=self.get("parse_dos", False)
-                or bool(self.get("bandstructure_mode", False))
-                or self.get("parse_chgcar", False)
-                or self.get("parse_aeccar", False))
+            t_id = mmdb.insert_task(task_doc, use_gridfs=use_gridfs)
             logger.info("Finished parsing with task_id: {}".format(t_id))
 
         defuse_children = False
@@ -158,7 +181,8 @@ class JsonToDb(FiretaskBase):
     """
     Insert the a JSON file (default: task.json) directly into the tasks database.
     Note that if the JSON file contains a "task_id" key, that task_id must not already be present
-    in the tasks collection.
+    in the tasks collection. A JSON file holding a list of task documents is
+    inserted as a batch, see CalcDb.insert_tasks.
 
     Optional params:
         json_filename (str): name of the JSON file to insert (default: "task.json")
@@ -181,7 +205,10 @@ class JsonToDb(FiretaskBase):
                 f.write(json.dumps(task_doc, default=DATETIME_HANDLER))
         else:
             mmdb = VaspCalcDb.from_db_file(db_file, admin=True)
-            mmdb.insert(task_doc)
+            if isinstance(task_doc, list):
+                mmdb.insert_tasks(task_doc)
+            else:
+                mmdb.insert(task_doc)
 
 
 @explicit_serialize
@@ -231,13 +258,13 @@ class BoltztrapToDb(FiretaskBase):
         d.update(get_meta_from_structure(structure))
 
         # add the spacegroup
-        sg = SpacegroupAnalyzer(Structure.from_dict(d["structure"]), 0.1)
-        d["spacegroup"] = {"symbol": sg.get_space_group_symbol(),
-                           "number": sg.get_space_group_number(),
-                           "point_group": sg.get_point_group_symbol(),
+        sym = get_symmetry(structure, 0.1)
+        d["spacegroup"] = {"symbol": sym["symbol"],
+                           "number": sym["number"],
+                           "point_group": sym["point_group"],
                            "source": "spglib",
-                           "crystal_system": sg.get_crystal_system(),
-                           "hall": sg.get_hall()}
+                           "crystal_system": sym["crystal_system"],
+                           "hall": sym["hall"]}
 
         d["created_at"] = datetime.utcnow()
 
@@ -299,12 +326,16 @@ class ElasticTensorToDb(FiretaskBase):
         if calc_locs_opt:
             optimize_loc = calc_locs_opt[-1]['path']
             logger.info("Parsing initial optimization directory: {}".format(optimize_loc))
-            drone = VaspDrone()
-            optimize_doc = drone.assimilate(optimize_loc)
-            opt_struct = Structure.from_dict(optimize_doc["calcs_reversed"][0]["output"]["structure"])
+            # only the final structure and stress are needed, so read the last
+            # vasprun.xml without the electronic steps, eigenvalues and DOS
+            vasprun_files = VaspDrone().filter_files(optimize_loc, file_pattern="vasprun.xml")
+            vrun = StreamingVasprun(os.path.join(optimize_loc, list(vasprun_files.values())[-1]),
+                                    skip_tags=("scstep",), parse_dos=False, parse_eigen=False,
+                                    parse_potcar_file=False)
+            opt_struct = vrun.final_structure
             d.update({"optimized_structure": opt_struct.as_dict()})
             ref_struct = opt_struct
-            eq_stress = -0.1*Stress(optimize_doc["calcs_reversed"][0]["output"]["ionic_steps"][-1]["stress"])
+            eq_stress = -0.1*Stress(vrun.ionic_steps[-1]["stress"])
         else:
             eq_stress = None
 
@@ -539,7 +570,8 @@ class GibbsAnalysisToDb(FiretaskBase):
             s = Structure.from_dict(d["calcs_reversed"][-1]["output"]['structure'])
             energies.append(d["calcs_reversed"][-1]["output"]['energy'])
             if qha_type not in ["debye_model"]:
-                force_constants.append(d["calcs_reversed"][-1]["output"]['force_constants'])
+                force_constants.append(mmdb.get_calc_array(d["calcs_reversed"][-1],
+                                                            "force_constants"))
             volumes.append(s.volume)
         gibbs_dict["energies"] = energies
         gibbs_dict["volumes"] = volumes
@@ -735,10 +767,10 @@ class ThermalExpansionCoeffToDb(FiretaskBase):
             s = Structure.from_dict(d["calcs_reversed"][-1]["output"]['structure'])
             energies.append(d["calcs_reversed"][-1]["output"]['energy'])
             volumes.append(s.volume)
-            force_constants.append(d["calcs_reversed"][-1]["output"]['force_constants'])
+            force_constants.append(mmdb.get_calc_array(d["calcs_reversed"][-1], "force_constants"))
         summary_dict["energies"] = energies
         summary_dict["volumes"] = volumes
-        summary_dict["force_constants"] = force_constants
+        summary_dict["force_constants"] = [fc.tolist() for fc in force_constants]
 
         alpha, T = get_phonopy_thermal_expansion(energies, volumes, force_constants, structure,
                                                  t_min, t_step, t_max, mesh, eos, pressure)
@@ -877,8 +909,9 @@ class MagneticOrderingsToDB(FiretaskBase):
             ordering_changed = not np.array_equal(np.sign(input_order_check),
                                                   np.sign(final_order_check))
 
-            symmetry_changed = (final_structure.get_space_group_info()[0]
-                                != input_structure.get_space_group_info()[0])
+            input_symmetry = get_symmetry(input_structure)["symbol"]
+            final_symmetry = get_symmetry(final_structure)["symbol"]
+            symmetry_changed = final_symmetry != input_symmetry
 
             total_magnetization = abs(d["calcs_reversed"][0]["output"]["outcar"]["total_magnetization"])
             num_formula_units = sum(d["calcs_reversed"][0]["composition_reduced"].values())/\
@@ -897,7 +930,7 @@ class MagneticOrderingsToDB(FiretaskBase):
                 "input": {
                     "structure": input_structure.as_dict(),
                     "ordering": input_analyzer.ordering.value,
-                    "symmetry": input_structure.get_space_group_info()[0],
+                    "symmetry": input_symmetry,
                     "index": ordering_index,
                     "origin": ordering_origin,
                     "input_index": self.get("input_index", None)
@@ -907,7 +940,7 @@ class MagneticOrderingsToDB(FiretaskBase):
                 "total_magnetization_per_unit_volume": total_magnetization_per_unit_volume,
                 "ordering": final_analyzer.ordering.value,
                 "ordering_changed": ordering_changed,
-                "symmetry": final_structure.get_space_group_info()[0],
+                "symmetry": final_symmetry,
                 "symmetry_changed": symmetry_changed,
                 "energy_per_atom": d["output"]["energy_per_atom"],
                 "stable": stable,
@@ -0,0 +1,347 @@
+# coding: utf-8
+
+
+"""
+This module defines lightweight parsers for VASP output files, used by the
+VaspDrone to read only what ends up in the task document.
+"""
+
+import re
+from xml.etree import ElementTree as ET
+
+from monty.io import zopen, reverse_readfile
+
+from pymatgen.electronic_structure.core import Magmom
+from pymatgen.io.vasp import Vasprun, Outcar
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+
+def read_vasprun_incar(vasprun_file):
+    """
+    Read the integer tags of the <incar> block of a vasprun.xml without parsing
+    the rest of the file. The block is at the top of the file, so only the
+    first few kB of even very large files are read.
+
+    Args:
+        vasprun_file (str): path to the (possibly compressed) vasprun.xml
+
+    Returns:
+        (dict): INCAR tag -> int value
+    """
+    incar = {}
+    with zopen(vasprun_file, "rb") as f:
+        for event, elem in ET.iterparse(f):
+            if elem.tag == "i" and elem.attrib.get("type") == "int":
+                try:
+                    incar[elem.attrib["name"]] = int(elem.text)
+                except (KeyError, TypeError, ValueError):
+                    pass
+            elif elem.tag == "incar":
+                break
+    return incar
+
+
+class SubtreeFilter(object):
+    """
+    Read-only file-like wrapper around a vasprun.xml stream that drops whole
+    XML subtrees line by line, before they reach the XML parser. VASP writes
+    every tag on its own line, so a subtree is skipped from the line opening
+    it to the line closing it.
+
+    The Fermi level of the <dos> block is always picked up, so that it is
+    available even if the DOS itself is skipped.
+    """
+
+    efermi_pattern = re.compile(r'<i name="efermi">\s*(\S+)\s*</i>')
+
+    def __init__(self, stream, skip_tags):
+        """
+        Args:
+            stream: text stream of the vasprun.xml
+            skip_tags (iterable): names of the elements to drop, e.g. "projected"
+        """
+        self.skip_tags = set(skip_tags)
+        self.efermi = None
+        self._lines = self._filter(stream)
+        self._buffer = ""
+
+    def _filter(self, stream):
+        skipping = None
+        depth = 0
+        for line in stream:
+            stripped = line.strip()
+            if stripped.startswith('<i name="efermi">'):
+                m = self.efermi_pattern.search(stripped)
+                if m:
+                    self.efermi = float(m.group(1))
+            tag = self._opening_tag(stripped)
+            if skipping:
+                if tag == skipping:
+                    depth += 1
+                elif stripped.startswith("</{}>".format(skipping)):
+                    depth -= 1
+                    if depth == 0:
+                        skipping = None
+                continue
+            if tag in self.skip_tags:
+                skipping, depth = tag, 1
+                continue
+            yield line
+
+    def _opening_tag(self, stripped):
+        """
+        Name of the element opened (but not closed) on this line, if any.
+        """
+        if not stripped.startswith("<") or stripped[1:2] in ("/", "?", "!"):
+            return None
+        name = re.split(r"[\s>/]", stripped[1:], 1)[0]
+        if stripped.endswith("/>") or "</{}>".format(name) in stripped:
+            return None
+        return name
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._lines)
+            except StopIteration:
+                break
+        if size is None or size < 0:
+            data, self._buffer = self._buffer, ""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class StreamingVasprun(Vasprun):
+    """
+    Vasprun that never materializes the parts of the vasprun.xml it is not
+    asked for. The projected eigenvalues, the DOS and (optionally) any other
+    subtree such as the electronic steps are dropped while the file is read,
+    instead of being built as XML elements and thrown away afterwards.
+
+    The eigenvalue arrays are also left out of as_dict(), since they are not
+    stored in task documents; use the attributes directly if needed.
+    """
+
+    def __init__(self, filename, skip_tags=(), **kwargs):
+        """
+        Args:
+            filename (str): filename to parse
+            skip_tags (iterable): names of additional elements to skip, e.g.
+                ("scstep",) to drop the electronic steps of every ionic step.
+            kwargs: passed on to Vasprun
+        """
+        self.skip_tags = tuple(skip_tags)
+        super(StreamingVasprun, self).__init__(filename, **kwargs)
+
+    def _parse(self, stream, parse_dos, parse_eigen, parse_projected_eigen):
+        skip_tags = set(self.skip_tags)
+        if not parse_dos:
+            skip_tags.add("dos")
+        if not parse_projected_eigen:
+            skip_tags.add("projected")
+            if not parse_eigen:
+                skip_tags.add("eigenvalues")
+        stream = SubtreeFilter(stream, skip_tags)
+        super(StreamingVasprun, self)._parse(stream, parse_dos, parse_eigen,
+                                             parse_projected_eigen)
+        if self.efermi is None:
+            self.efermi = stream.efermi
+
+    def as_dict(self):
+        eigenvalues, projected_eigenvalues = self.eigenvalues, self.projected_eigenvalues
+        self.eigenvalues, self.projected_eigenvalues = None, None
+        try:
+            d = super(StreamingVasprun, self).as_dict()
+        finally:
+            self.eigenvalues, self.projected_eigenvalues = eigenvalues, projected_eigenvalues
+        if eigenvalues:
+            (gap, cbm, vbm, is_direct) = self.eigenvalue_band_properties
+            d["output"].update(dict(bandgap=gap, cbm=cbm, vbm=vbm, is_gap_direct=is_direct))
+        return d
+
+
+def read_outcar_header(outcar_file):
+    """
+    Read the number of cores and the flags for the special calculation types
+    (DFPT, LEPSILON, LCALCPOL, NMR) from the header of an OUTCAR, i.e. the part
+    before the first electronic iteration.
+
+    Args:
+        outcar_file (str): path to the (possibly compressed) OUTCAR
+
+    Returns:
+        (dict): {"cores": ..., "special": bool}
+    """
+    header = {"cores": 0, "special": False}
+    special_patterns = [re.compile(p) for p in (r"LEPSILON\s*=\s*T", r"LCALCPOL\s*=\s*T",
+                                                r"LCHIMAG\s*=\s*T", r"LEFG\s*=\s*T")]
+    ibrion_pattern = re.compile(r"IBRION\s*=\s*([\-\d]+)")
+    with zopen(outcar_file, "rt") as f:
+        for line in f:
+            if "Iteration" in line:
+                break
+            if not header["cores"] and "running" in line:
+                header["cores"] = line.split()[2]
+            m = ibrion_pattern.search(line)
+            if (m and int(m.group(1)) > 6) or any(p.search(line) for p in special_patterns):
+                header["special"] = True
+    return header
+
+
+def _is_step_start(line):
+    """
+    Whether a line of an OUTCAR is the separator starting an electronic step.
+    """
+    line = line.strip()
+    return "Iteration" in line and line.startswith("-")
+
+
+def _rfind_step_start(text, end):
+    """
+    Offset of the start of the last line of text[:end] that starts an
+    electronic step, or -1.
+    """
+    i = text.rfind("Iteration", 0, end)
+    while i >= 0:
+        start = text.rfind("\n", 0, i) + 1
+        if _is_step_start(text[start:text.find("\n", i)]):
+            return start
+        i = text.rfind("Iteration", 0, start)
+    return -1
+
+
+# size of the chunks of decompressed text read by reverse_read_last_step
+_STREAM_CHUNK_SIZE = 1 << 20
+
+
+def reverse_read_last_step(outcar_file):
+    """
+    Lines of an OUTCAR in reverse order, from the end of the file back to the
+    start of the last electronic step. Plain files are read backwards and
+    memory-mapped, so only the last step is read. Compressed files cannot be
+    read backwards: they are decompressed in full, streamed forward in chunks
+    of which only the text since the start of the latest step is kept, so
+    that the memory used, but not the time, is independent of the size of
+    the file.
+
+    Args:
+        outcar_file (str): path to the (possibly compressed) OUTCAR
+
+    Yields:
+        (str) lines, the last one being the start of the last electronic
+            step, if there is one
+    """
+    if not outcar_file.endswith((".gz", ".GZ", ".bz2", ".BZ2", ".z", ".Z", ".xz", ".XZ",
+                                 ".lzma", ".LZMA")):
+        for line in reverse_readfile(outcar_file):
+            yield line
+            if _is_step_start(line):
+                return
+        return
+
+    last_step, partial = [], ""
+    with zopen(outcar_file, "rt") as f:
+        for chunk in iter(lambda: f.read(_STREAM_CHUNK_SIZE), ""):
+            # the complete lines of the chunk, the incomplete one is kept for the next chunk
+            text = partial + chunk
+            end = text.rfind("\n") + 1
+            partial = text[end:]
+            start = _rfind_step_start(text, end)
+            if start >= 0:
+                last_step = [text[start:end]]
+            else:
+                last_step.append(text[:end])
+    lines = ("".join(last_step) + partial).split("\n")
+    if not lines[-1]:
+        lines.pop()
+    for line in reversed(lines):
+        yield line
+
+
+def read_outcar_tail(outcar_file):
+    """
+    Read the data of an OUTCAR that ends up in task documents from the end of
+    the file: run statistics, Fermi level, number of electrons, total and
+    site-projected magnetization and charge, and the final drift. Only the
+    lines of the last electronic step are parsed (see reverse_read_last_step):
+    the parse time of plain files does not grow with the number of ionic
+    steps, while compressed files are still decompressed in full.
+
+    The result has the keys of Outcar.as_dict(), except that "drift" only
+    holds the final drift and that the electrostatic potential, ngf and
+    sampling radii are left out. Calculations with LEPSILON, LCALCPOL, NMR or
+    DFPT data, which are read from the body of the file, are parsed in full
+    with Outcar instead.
+
+    Args:
+        outcar_file (str): path to the (possibly compressed) OUTCAR
+
+    Returns:
+        (dict)
+    """
+    header = read_outcar_header(outcar_file)
+    if header["special"]:
+        return Outcar(outcar_file).as_dict()
+
+    time_pattern = re.compile(r"\((sec|kb)\)")
+    efermi_pattern = re.compile(r"E-fermi\s*:\s*(\S+)")
+    mag_pattern = re.compile(r"number of electron\s+(\S+)\s+magnetization\s*(\S*)")
+    drift_pattern = re.compile(r"total drift:\s+([\.\-\d]+)\s+([\.\-\d]+)\s+([\.\-\d]+)")
+
+    run_stats = {}
+    efermi, nelect, total_mag, drift = None, None, None, []
+    is_stopped = False
+    tail = []
+    for line in reverse_read_last_step(outcar_file):
+        clean = line.strip()
+        tail.append(clean)
+        if "soft stop encountered!  aborting job" in clean:
+            is_stopped = True
+        elif time_pattern.search(clean):
+            tok = clean.split(":")
+            run_stats[tok[0].strip()] = float(tok[1].strip())
+        elif efermi is None and efermi_pattern.search(clean):
+            try:
+                efermi = float(efermi_pattern.search(clean).group(1))
+            except ValueError:
+                pass
+        elif nelect is None and mag_pattern.search(clean):
+            m = mag_pattern.search(clean)
+            nelect = float(m.group(1))
+            total_mag = float(m.group(2)) if m.group(2) else None
+        elif not drift and drift_pattern.search(clean):
+            drift = [[float(i) for i in drift_pattern.search(clean).groups()]]
+        elif _is_step_start(clean):
+            break
+    run_stats["cores"] = header["cores"]
+    tail.reverse()
+
+    tables = {"total charge": [], "magnetization (x)": [], "magnetization (y)": [],
+              "magnetization (z)": []}
+    table, columns = None, []
+    for clean in tail:
+        if clean in tables:
+            table = clean
+            tables[table] = []
+        elif table and clean.startswith("# of ion"):
+            columns = re.split(r"\s{2,}", clean)[1:]
+        elif table and re.match(r"\s*(\d+)\s+(([\d\.\-]+)\s+)+", clean):
+            values = [float(i) for i in re.findall(r"[\d\.\-]+", clean)][1:]
+            tables[table].append(dict(zip(columns, values)))
+        elif table and (clean.startswith("tot") or "electrostatic" in clean):
+            table = None
+
+    mag_x, mag_y, mag_z = (tables["magnetization ({})".format(i)] for i in "xyz")
+    if mag_y and mag_z:
+        mag = [{k: Magmom([mag_x[i][k], mag_y[i][k], mag_z[i][k]]) for k in mag_x[0]}
+               for i in range(len(mag_x))]
+    else:
+        mag = mag_x
+
+    return {"@module": Outcar.__module__, "@class": Outcar.__name__,
+            "efermi": efermi, "run_stats": run_stats, "magnetization": tuple(mag),
+            "charge": tuple(tables["total charge"]), "total_magnetization": total_mag,
+            "nelect": nelect, "is_stopped": is_stopped, "drift": drift}
@@ -0,0 +1,605 @@
+# coding: utf-8
+
+import datetime
+import json
+import os
+import unittest
+import zlib
+from unittest.mock import patch
+
+import gridfs
+import numpy as np
+
+from pymatgen import Element, Structure
+from pymatgen.electronic_structure.bandstructure import BandStructureSymmLine
+from pymatgen.electronic_structure.core import Spin, OrbitalType
+from pymatgen.electronic_structure.dos import CompleteDos
+
+from fireworks import Firework, Workflow
+
+from atomate.utils import database, embedded
+from atomate.utils.cache import ObjectCache
+from atomate.utils.database import TaskIdAllocator, get_hash_tree
+from atomate.utils.spool import TaskSpool
+from atomate.utils.testing import AtomateTest
+from atomate.vasp.database import VaspCalcDb
+from atomate.vasp.drones import VaspDrone
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+module_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)))
+db_dir = os.path.join(module_dir, "..", "..", "common", "test_files")
+ref_dir = os.path.join(module_dir, "..", "test_files")
+
+# GridFS encodings of the tests of the binary arrays
+BINARY_ENCODING = {"chgcar": "float64", "dos": "float64", "bandstructure": "float64"}
+
+
+class TestVaspCalcDb(AtomateTest):
+
+    @classmethod
+    def setUpClass(cls):
+        drone = VaspDrone(parse_chgcar=True, parse_aeccar=True)
+        cls.task_doc = drone.assimilate(os.path.join(ref_dir, "Si_static", "outputs"))
+
+    def setUp(self):
+        super(TestVaspCalcDb, self).setUp()
+        self.db = VaspCalcDb.from_db_file(os.path.join(db_dir, "db.json"))
+        self.db.gridfs_encoding = BINARY_ENCODING
+
+    def get_task_doc(self):
+        # insert_task pops the GridFS fields from the doc, so insert a copy
+        doc = dict(self.task_doc)
+        doc["calcs_reversed"] = [dict(c) for c in self.task_doc["calcs_reversed"]]
+        return doc
+
+    def test_chgcar(self):
+        chgcar = self.task_doc["calcs_reversed"][0]["chgcar"]
+        t_id = self.db.insert_task(self.get_task_doc(), use_gridfs=True)
+        calc = self.db.collection.find_one({"task_id": t_id})["calcs_reversed"][0]
+        fs_file = gridfs.GridFS(self.db.db, "chgcar_fs").get(calc["chgcar_fs_id"])
+        self.assertEqual(fs_file.metadata["encoding"], "atomate-array-blob")
+
+        stored = self.db.get_chgcar(t_id)
+        self.assertTrue(np.array_equal(stored.data["total"], chgcar.data["total"]))
+        self.assertEqual(stored.structure, chgcar.structure)
+        aeccar = self.db.get_aeccar(t_id)
+        self.assertTrue(np.allclose(aeccar["aeccar2"].data["total"],
+                                    self.task_doc["calcs_reversed"][0]["aeccar2"].data["total"]))
+
+        grid = self.db.get_chgcar_grid(t_id)
+        self.assertTrue(np.array_equal(grid, chgcar.data["total"]))
+        grid = self.db.get_chgcar_grid(t_id, filename=os.path.join(self.scratch_dir, "chgcar.blob"))
+        self.assertTrue(np.array_equal(grid, chgcar.data["total"]))
+        del grid
+
+    def test_default_encoding(self):
+        # the GridFS data is compressed JSON unless binary arrays are asked for
+        db = VaspCalcDb.from_db_file(os.path.join(db_dir, "db.json"))
+        t_id = db.insert_task(self.get_task_doc(), use_gridfs=True)
+        calc = db.collection.find_one({"task_id": t_id})["calcs_reversed"][0]
+        for prefix in ["dos", "bandstructure", "chgcar", "aeccar0", "aeccar2"]:
+            self.assertEqual(calc["{}_compression".format(prefix)], "zlib")
+        dos_file = gridfs.GridFS(db.db, "dos_fs").get(calc["dos_fs_id"])
+        self.assertEqual(json.loads(zlib.decompress(dos_file.read()).decode())["@class"],
+                         "CompleteDos")
+        self.assertEqual(len(db.get_dos(t_id).energies),
+                         len(self.task_doc["calcs_reversed"][0]["dos"]["energies"]))
+
+    def test_chgcar_json(self):
+        chgcar = self.task_doc["calcs_reversed"][0]["chgcar"]
+        t_id = self.db.insert_task(self.get_task_doc(), use_gridfs=True, chgcar_encoding="json")
+        self.assertTrue(np.allclose(self.db.get_chgcar(t_id).data["total"], chgcar.data["total"]))
+        self.assertRaises(ValueError, self.db.get_chgcar_grid, t_id)
+
+    def test_build_indexes(self):
+        # the indexes of a dropped database are built again by a new process
+        self.db.collection.drop()
+        self.db.db.counter.drop()
+        database._initialized_collections.clear()
+        db = VaspCalcDb.from_db_file(os.path.join(db_dir, "db.json"))
+        self.assertIn("task_id_1", db.collection.index_information())
+        self.assertEqual(db.db.counter.find_one({"_id": "taskid"})["c"], 0)
+
+        # and the counter is checked once per process
+        with patch("pymongo.collection.Collection.find_one") as find_one:
+            VaspCalcDb.from_db_file(os.path.join(db_dir, "db.json"))
+        find_one.assert_not_called()
+
+    def test_insert_tasks(self):
+        t_id = self.db.insert({"dir_name": "a", "output": 1})
+        docs = [{"dir_name": d, "output": 2} for d in ["a", "b", "c"]]
+        task_ids = self.db.insert_tasks(docs)
+        self.assertEqual(task_ids, {"a": t_id, "b": t_id + 1, "c": t_id + 2})
+        self.assertEqual(self.db.collection.find_one({"task_id": t_id})["output"], 2)
+        self.assertEqual(self.db.collection.count_documents({}), 3)
+        self.assertEqual(self.db.db.counter.find_one({"_id": "taskid"})["c"], t_id + 2)
+
+        task_ids = self.db.insert_tasks([{"dir_name": "b"}, {"dir_name": "d"}],
+                                        update_duplicates=False)
+        self.assertEqual(task_ids, {"b": None, "d": t_id + 3})
+
+    def test_diff_updates(self):
+        self.db.diff_updates = True
+        doc = {"dir_name": "a", "output": {"energy": -1, "forces": [[0, 0, 1]]},
+               "calcs_reversed": [{"output": {"energy": -1}, "input": {"incar": {"ISMEAR": 0}}}]}
+        t_id = self.db.insert(doc)
+        stored = self.db.collection.find_one({"task_id": t_id})
+        self.assertEqual(stored["_field_hashes"]["output"]["energy"], get_hash_tree(-1, 0))
+
+        tree = stored["_field_hashes"]
+        update = self.db._get_update({"dir_name": "a", "task_id": t_id, "last_updated": 0,
+                                      "output": {"energy": -2, "forces": [[0, 0, 1]]},
+                                      "calcs_reversed": doc["calcs_reversed"]},
+                                     {"_field_hashes": tree})
+        self.assertEqual(sorted(update["$set"]), ["_field_hashes", "last_updated", "output.energy"])
+
+        doc = {"dir_name": "a", "output": {"energy": -2},
+               "calcs_reversed": [{"output": {"energy": -2}, "input": {"incar": {"ISMEAR": 0}}}]}
+        self.assertEqual(self.db.insert_tasks([doc]), {"a": t_id})
+        stored = self.db.collection.find_one({"task_id": t_id}, {"_id": 0, "_field_hashes": 0,
+                                                                 "last_updated": 0})
+        self.assertEqual(stored, dict(doc, task_id=t_id))
+
+        # a document written by another process since its hashes were read is set whole
+        stale = self.db.collection.find_one({"dir_name": "a"}, ["_field_hashes"])
+        self.db.insert(dict(doc, output={"energy": -3}))
+        new = {"dir_name": "a", "task_id": t_id, "output": {"energy": -2}, "calcs_reversed": []}
+        with patch.object(self.db.collection, "find_one", return_value=stale):
+            self.db.write_task(dict(new))
+        stored = self.db.collection.find_one({"task_id": t_id})
+        self.assertEqual((stored["output"], stored["calcs_reversed"]), ({"energy": -2}, []))
+        self.assertEqual(stored["_field_hashes"]["#"], get_hash_tree(new, self.db.diff_depth)["#"])
+
+        self.db.diff_updates = False
+        self.db.insert(doc)
+        self.assertNotIn("_field_hashes", self.db.collection.find_one({"task_id": t_id}))
+
+    def test_offload_fields(self):
+        self.db.max_doc_size = 200000
+        self.db.offload_min_size = 10000
+        steps = [{"e": float(i), "forces": [[0.1 * i, 0.2, 0.3]] * 8} for i in range(1000)]
+        doc = {"dir_name": "a", "output": {"energy": -1.0},
+               "custodian": [{"corrections": ["x" * 50000]}, {"corrections": []}],
+               "calcs_reversed": [{"output": {"energy": -1.0, "ionic_steps": steps}},
+                                  {"output": {"energy": -2.0, "ionic_steps": steps[:10]}}]}
+        t_id = self.db.insert(doc)
+
+        # the largest innermost fields are moved until the document fits
+        stored = self.db.collection.find_one({"task_id": t_id})
+        self.assertEqual(stored["_offloaded"], ["calcs_reversed.0.output.ionic_steps"])
+        self.assertEqual(stored["calcs_reversed"][0]["output"]["energy"], -1.0)
+        self.assertIn("fs_id", stored["calcs_reversed"][0]["output"]["ionic_steps"])
+        self.assertEqual(len(stored["calcs_reversed"][1]["output"]["ionic_steps"]), 10)
+
+        retrieved = self.db.retrieve_task(t_id)
+        self.assertNotIn("_offloaded", retrieved)
+        self.assertEqual(retrieved["calcs_reversed"][0]["output"]["ionic_steps"], steps)
+        self.assertEqual(retrieved["custodian"], doc["custodian"])
+
+        # the list of the moved fields goes when the document is written whole
+        self.db.max_doc_size = None
+        self.db.insert(doc)
+        stored = self.db.collection.find_one({"task_id": t_id})
+        self.assertNotIn("_offloaded", stored)
+        self.assertEqual(len(stored["calcs_reversed"][0]["output"]["ionic_steps"]), 1000)
+
+    def test_offload_reinsert(self):
+        self.db.max_doc_size = 20000
+        self.db.offload_min_size = 10000
+        steps = [{"e": float(i), "forces": [[0.1 * i, 0.2, 0.3]] * 8} for i in range(1000)]
+        t_id = self.db.insert({"dir_name": "a",
+                               "calcs_reversed": [{"output": {"ionic_steps": steps}}]})
+
+        # the fields moved by the first write stay listed, and their files referenced
+        self.db.insert({"dir_name": "a", "q": 1})
+        stored = self.db.collection.find_one({"task_id": t_id})
+        self.assertEqual(stored["_offloaded"], ["calcs_reversed.0.output.ionic_steps"])
+        report = self.db.collect_gridfs_garbage(min_age=0)
+        self.assertEqual(report["offloaded_fs"]["files"], 0)
+        retrieved = self.db.retrieve_task(t_id)
+        self.assertEqual(retrieved["calcs_reversed"][0]["output"]["ionic_steps"], steps)
+        self.assertEqual(retrieved["q"], 1)
+
+        # until the fields holding them are written again
+        self.db.insert({"dir_name": "a", "calcs_reversed": []})
+        self.assertNotIn("_offloaded", self.db.collection.find_one({"task_id": t_id}))
+        report = self.db.collect_gridfs_garbage(min_age=0)
+        self.assertEqual(report["offloaded_fs"]["files"], 1)
+
+    def test_offload_getters(self):
+        self.db.max_doc_size = 20000
+        self.db.offload_min_size = 10000
+        steps = [{"e": float(i), "forces": [[0.1 * i, 0.2, 0.3]] * 8} for i in range(1000)]
+        fc = np.arange(20 * 20 * 9, dtype=float).reshape(20, 20, 3, 3)
+        doc = {"dir_name": "a", "output": {"energy": -1.0},
+               "calcs_reversed": [{"output": {"energy": -1.0, "ionic_steps": steps,
+                                              "force_constants": fc.tolist()}}]}
+        t_id = self.db.insert(doc)
+        stored = self.db.collection.find_one({"task_id": t_id})
+        self.assertEqual(sorted(stored["_offloaded"]),
+                         ["calcs_reversed.0.output.force_constants",
+                          "calcs_reversed.0.output.ionic_steps"])
+
+        # the getters put the moved fields back
+        self.assertEqual(self.db.get_ionic_steps(t_id), steps)
+        self.assertEqual(self.db.get_ionic_steps(t_id, steps=[-1]), steps[-1:])
+        self.assertTrue(np.array_equal(self.db.get_force_constants(t_id), fc))
+        self.assertTrue(np.array_equal(
+            self.db.get_calc_array(stored["calcs_reversed"][0], "force_constants"), fc))
+
+        # a calc moved whole
+        self.db.offload_depth = 2
+        self.db.max_doc_size = 1000
+        self.db.offload_min_size = 100
+        t_id = self.db.insert_task(self.get_task_doc(), use_gridfs=True)
+        stored = self.db.collection.find_one({"task_id": t_id})
+        self.assertIn("calcs_reversed.0", stored["_offloaded"])
+        dos = self.db.get_dos(t_id)
+        self.assertEqual(len(dos.energies),
+                         len(self.task_doc["calcs_reversed"][0]["dos"]["energies"]))
+        self.assertIsNotNone(self.db.get_chgcar(t_id))
+
+    def test_task_id_allocator(self):
+        a = TaskIdAllocator(self.db.db, block_size=5, owner="a")
+        b = TaskIdAllocator(self.db.db, block_size=5, owner="b")
+        ids_a = a.get_ids(2)
+        ids_b = b.get_ids(1)
+        self.assertEqual((ids_a, ids_b), ([1, 2], [6]))
+        self.assertEqual(self.db.db.counter.find_one({"_id": "taskid"})["c"], 10)
+
+        # the ids released by a are used by b once its own lease is exhausted
+        a.release()
+        ids_b += b.get_ids(6)
+        self.assertEqual(ids_b, [6, 7, 8, 9, 10, 3, 4])
+
+        # the hand-outs are recorded in the lease, whose holder is alive
+        lease = self.db.db[TaskIdAllocator.lease_collection].find_one({"owner": "b"})
+        self.assertEqual((lease["next"], lease["end"]), (5, 5))
+        self.assertEqual(a.reclaim(max_age=60), 0)
+
+        # a lease without a recent heartbeat is reclaimed after the ids handed out
+        self.db.db[TaskIdAllocator.lease_collection].update_many(
+            {}, {"$set": {"heartbeat": datetime.datetime(2000, 1, 1)}})
+        self.assertEqual(a.reclaim(max_age=60), 1)
+        self.assertEqual(a.get_ids(2), [5, 11])
+
+        # its holder no longer hands out ids from it
+        self.assertEqual(b.get_ids(1), [16])
+        b.release()
+        self.assertEqual(self.db.db[TaskIdAllocator.lease_collection].find_one(
+            {"state": "released"})["next"], 17)
+        a.reset()
+        b.reset()
+
+    def test_single_write(self):
+        t_id = self.db.insert_task(self.get_task_doc(), use_gridfs=True, gridfs_workers=4)
+        calc = self.db.collection.find_one({"task_id": t_id})["calcs_reversed"][0]
+        for prefix in ["dos", "bandstructure", "chgcar", "aeccar0", "aeccar2"]:
+            self.assertIn("{}_fs_id".format(prefix), calc)
+            self.assertIsNone(calc["{}_compression".format(prefix)])
+            files = gridfs.GridFS(self.db.db, "{}_fs".format(prefix)).find({"metadata.task_id": t_id})
+            self.assertEqual([f._id for f in files], [calc["{}_fs_id".format(prefix)]])
+        self.assertTrue(np.array_equal(self.db.get_chgcar(t_id).data["total"],
+                                       self.task_doc["calcs_reversed"][0]["chgcar"].data["total"]))
+
+        # nothing is written for a skipped duplicate
+        self.assertIsNone(self.db.insert_task(self.get_task_doc(), use_gridfs=True,
+                                              update_duplicates=False))
+        self.assertEqual(self.db.db.chgcar_fs.files.count_documents({}), 1)
+
+    def test_gridfs_compression(self):
+        self.db.gridfs_compression = {"default": "bz2", "chgcar_fs": "lzma:1"}
+        chgcar = self.task_doc["calcs_reversed"][0]["chgcar"]
+        t_id = self.db.insert_task(self.get_task_doc(), use_gridfs=True, dos_encoding="json")
+        calc = self.db.collection.find_one({"task_id": t_id})["calcs_reversed"][0]
+        self.assertEqual(calc["chgcar_compression"], "lzma")
+        self.assertEqual(calc["dos_compression"], "bz2")
+        self.assertIsNone(calc["aeccar0_compression"])
+        self.assertTrue(np.array_equal(self.db.get_chgcar_grid(t_id), chgcar.data["total"]))
+        self.assertEqual(len(self.db.get_dos(t_id).energies),
+                         len(self.task_doc["calcs_reversed"][0]["dos"]["energies"]))
+
+        # an int is a zlib compression level
+        fs_id, compression = self.db.insert_gridfs(b'{"a": 1}', compress=9)
+        self.assertEqual(compression, "zlib")
+        self.assertEqual(zlib.decompress(gridfs.GridFS(self.db.db, "fs").get(fs_id).read()),
+                         b'{"a": 1}')
+
+        # files written without a codec in their metadata are zlib compressed
+        fs_id = gridfs.GridFS(self.db.db, "fs").put(zlib.compress(b"{}"))
+        self.assertEqual(self.db.get_gridfs_file("fs", fs_id).read(), b"{}")
+
+        results = self.db.benchmark_gridfs_codecs("chgcar_fs", codecs=["zlib:1"], repeat=1)
+        self.assertGreater(results[0]["ratio"], 1)
+
+    def test_retrieve_tasks(self):
+        t_ids = [self.db.insert_task(self.get_task_doc(), use_gridfs=True)]
+        doc = self.get_task_doc()
+        doc["dir_name"] = "other_dir"
+        t_ids.append(self.db.insert_task(doc, use_gridfs=True))
+
+        docs = list(self.db.retrieve_tasks(t_ids[::-1] + [-1], fields=["dos"], batch_size=1))
+        self.assertEqual([d["task_id"] for d in docs], t_ids[::-1])
+        for d in docs:
+            self.assertEqual(d["calcs_reversed"][0]["dos"]["@class"], "CompleteDos")
+            self.assertNotIn("chgcar", d["calcs_reversed"][0])
+
+        doc = self.db.retrieve_task(t_ids[0])
+        calc = doc["calcs_reversed"][0]
+        for key in ["bandstructure", "dos", "chgcar", "aeccar0", "aeccar2"]:
+            self.assertIn(key, calc)
+        self.assertTrue(np.array_equal(calc["chgcar"].data["total"],
+                                       self.task_doc["calcs_reversed"][0]["chgcar"].data["total"]))
+
+        # only the requested fields of the earlier calcs are unpacked
+        doc = self.get_task_doc()
+        doc["dir_name"] = "two_calcs"
+        fc = np.random.rand(2, 2, 3, 3).tolist()
+        doc["calcs_reversed"] = [dict(c, output=dict(c["output"], force_constants=fc))
+                                 for c in doc["calcs_reversed"] * 2]
+        t_id = self.db.insert_task(doc, use_gridfs=True, use_gridfs_force_constants=True)
+        calcs = next(self.db.retrieve_tasks([t_id], fields=["dos"]))["calcs_reversed"]
+        self.assertEqual(calcs[0]["dos"]["@class"], "CompleteDos")
+        for calc in calcs:
+            self.assertIn("force_constants_fs_id", calc)
+            self.assertNotIn("force_constants", calc["output"])
+        calcs = next(self.db.retrieve_tasks([t_id], fields=["force_constants"]))["calcs_reversed"]
+        self.assertNotIn("dos", calcs[0])
+        for calc in calcs:
+            self.assertEqual(calc["output"]["force_constants"], fc)
+
+    def test_gridfs_dedup(self):
+        t_ids = [self.db.insert_task(self.get_task_doc(), use_gridfs=True)]
+        doc = self.get_task_doc()
+        doc["dir_name"] = "other_dir"
+        t_ids.append(self.db.insert_task(doc, use_gridfs=True))
+        calcs = [self.db.collection.find_one({"task_id": t})["calcs_reversed"][0] for t in t_ids]
+        for prefix in ["dos", "bandstructure", "chgcar", "aeccar0"]:
+            key = "{}_fs_id".format(prefix)
+            self.assertEqual(calcs[0][key], calcs[1][key])
+            self.assertEqual(self.db.db["{}_fs.files".format(prefix)].count_documents({}), 1)
+
+        # the files are removed once no task references them
+        self.db.collection.update_many({}, {"$unset": {"calcs_reversed.0.dos_fs_id": ""}})
+        self.assertEqual(self.db.collect_gridfs_garbage()["dos_fs"], {"files": 0, "bytes": 0})
+        length = self.db.db["dos_fs.files"].find_one()["length"]
+        report = self.db.collect_gridfs_garbage(min_age=0, dry_run=True)
+        self.assertEqual(report["dos_fs"], {"files": 1, "bytes": length})
+        self.assertEqual(self.db.db["dos_fs.files"].count_documents({}), 1)
+        report = self.db.collect_gridfs_garbage(min_age=0)
+        self.assertEqual(report["dos_fs"], {"files": 1, "bytes": length})
+        self.assertEqual(report["chgcar_fs"]["files"], 0)
+        self.assertEqual(self.db.db["dos_fs.files"].count_documents({}), 0)
+        self.assertIsNotNone(self.db.get_chgcar(t_ids[1]))
+
+    def test_gridfs_garbage_shared(self):
+        # two task collections of the database share the GridFS collections
+        other = VaspCalcDb("localhost", 27017, "atomate_unittest", "other_tasks", None, None,
+                           gridfs_encoding=BINARY_ENCODING)
+        self.db.max_doc_size = other.max_doc_size = 20000
+        self.db.offload_min_size = other.offload_min_size = 10000
+        steps = [{"e": float(i), "forces": [[0.1 * i, 0.2, 0.3]] * 8} for i in range(1000)]
+        t_id = self.db.insert({"dir_name": "a",
+                               "calcs_reversed": [{"output": {"ionic_steps": steps}}]})
+        o_id = other.insert({"dir_name": "b",
+                             "calcs_reversed": [{"output": {"ionic_steps": steps[:500]}}]})
+        o_task = other.insert_task(self.get_task_doc(), use_gridfs=True)
+        self.assertEqual(self.db.db["offloaded_fs.files"].count_documents({}), 2)
+
+        # the files referenced by the other collection are kept
+        report = self.db.collect_gridfs_garbage(min_age=0)
+        self.assertEqual(report["offloaded_fs"]["files"], 0)
+        self.assertEqual(report["chgcar_fs"]["files"], 0)
+        self.assertEqual(other.retrieve_task(o_id)["calcs_reversed"][0]["output"]["ionic_steps"],
+                         steps[:500])
+        self.assertIsNotNone(other.get_chgcar(o_task))
+
+        # and those that no collection references are removed
+        self.db.collection.delete_one({"task_id": t_id})
+        report = self.db.collect_gridfs_garbage(min_age=0)
+        self.assertEqual(report["offloaded_fs"]["files"], 1)
+        self.assertEqual(self.db.db["offloaded_fs.files"].count_documents({}), 1)
+        self.assertEqual(other.retrieve_task(o_id)["calcs_reversed"][0]["output"]["ionic_steps"],
+                         steps[:500])
+
+    def test_dos(self):
+        dos = CompleteDos.from_dict(self.task_doc["calcs_reversed"][0]["dos"])
+        t_id = self.db.insert_task(self.get_task_doc(), use_gridfs=True)
+        stored = self.db.get_dos(t_id)
+        self.assertTrue(np.array_equal(stored.energies, dos.energies))
+        self.assertTrue(np.array_equal(stored.densities[Spin.up], dos.densities[Spin.up]))
+        self.assertEqual(stored.structure, dos.structure)
+        self.assertEqual(len(stored.pdos), len(dos.pdos))
+
+        total = self.db.get_total_dos(t_id)
+        self.assertTrue(np.array_equal(total.densities[Spin.up], dos.densities[Spin.up]))
+        self.assertAlmostEqual(total.efermi, dos.efermi)
+        si = self.db.get_partial_dos(t_id, element="Si")
+        self.assertTrue(np.allclose(si.densities[Spin.up],
+                                    dos.get_element_dos()[Element("Si")].densities[Spin.up]))
+        p = self.db.get_partial_dos(t_id, orbital="p", sites=[1])
+        self.assertTrue(np.allclose(p.densities[Spin.up],
+                                    dos.get_site_spd_dos(dos.structure[1])[OrbitalType.p].densities[Spin.up]))
+
+        t_id = self.db.insert_task(self.get_task_doc(), use_gridfs=True, dos_encoding="json")
+        si_json = self.db.get_partial_dos(t_id, element="Si")
+        self.assertTrue(np.allclose(si_json.densities[Spin.up], si.densities[Spin.up]))
+
+    def test_object_cache(self):
+        t_id = self.db.insert_task(self.get_task_doc(), use_gridfs=True)
+        self.db.object_cache = ObjectCache(cache_dir=os.path.join(self.scratch_dir, "cache"))
+        dos = self.db.get_dos(t_id)
+        self.assertIs(self.db.get_dos(t_id), dos)
+        chgcar = self.db.get_chgcar(t_id)
+        self.assertIs(self.db.get_chgcar(t_id), chgcar)
+        stats = self.db.object_cache.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 2))
+
+        # the disk cache outlives the in-memory one
+        self.db.object_cache.clear()
+        self.assertTrue(np.array_equal(self.db.get_dos(t_id).energies, dos.energies))
+        self.assertEqual(self.db.object_cache.get_stats()["disk_hits"], 1)
+
+    def test_embedded_backend(self):
+        db = VaspCalcDb(os.path.join(self.scratch_dir, "db"), database="vasp", backend="sqlite",
+                        gridfs_encoding=BINARY_ENCODING)
+        t_id = db.insert_task(self.get_task_doc(), use_gridfs=True)
+        self.assertEqual(db.collection.find_one({"dir_name": self.task_doc["dir_name"]})["task_id"], t_id)
+        dos = CompleteDos.from_dict(self.task_doc["calcs_reversed"][0]["dos"])
+        self.assertTrue(np.array_equal(db.get_dos(t_id).densities[Spin.up], dos.densities[Spin.up]))
+        self.assertTrue(np.array_equal(db.get_chgcar_grid(t_id),
+                                       self.task_doc["calcs_reversed"][0]["chgcar"].data["total"]))
+        self.assertEqual(db.retrieve_task(t_id)["task_id"], t_id)
+
+    def test_spool(self):
+        spool = TaskSpool(os.path.join(self.scratch_dir, "spool"), VaspCalcDb,
+                          {"gridfs_encoding": BINARY_ENCODING})
+        doc = self.get_task_doc()
+        spool.put(doc, use_gridfs=True)
+        self.assertNotIn("task_id", doc)
+        self.assertEqual(len(spool.entries()), 1)
+        self.assertIsNone(self.db.collection.find_one())
+
+        synced = spool.sync(self.db)
+        t_id = synced[self.task_doc["dir_name"]]
+        self.assertEqual(spool.entries(), [])
+        self.assertEqual(self.db.collection.find_one({"task_id": t_id})["dir_name"],
+                         self.task_doc["dir_name"])
+        self.assertTrue(np.array_equal(self.db.get_chgcar_grid(t_id),
+                                       self.task_doc["calcs_reversed"][0]["chgcar"].data["total"]))
+        fs_file = self.db.db["chgcar_fs.files"].find_one()
+        self.assertEqual(fs_file["metadata"]["task_id"], t_id)
+
+    def test_spool_duplicates(self):
+        spool = TaskSpool(os.path.join(self.scratch_dir, "spool"), VaspCalcDb)
+        for i in range(2):
+            spool.put(dict(self.get_task_doc(), spool_index=i), use_gridfs=True)
+
+        # the newest entry of a dir_name is written, without the files of the older one
+        t_id = spool.sync(self.db)[self.task_doc["dir_name"]]
+        self.assertEqual(self.db.collection.find_one({"task_id": t_id})["spool_index"], 1)
+        self.assertEqual(self.db.collection.count_documents({}), 1)
+        self.assertEqual(self.db.db["chgcar_fs.files"].count_documents({}), 1)
+        self.assertFalse([k for k in embedded._clients if k[1].startswith(spool.spool_dir)])
+
+    def test_spool_children(self):
+        parent = Firework([], name="parent")
+        child = Firework([], parents=[parent], name="child")
+        ids = self.lp.add_wf(Workflow([parent, child]))
+        fw_ids = {"parent": ids[parent.fw_id], "child": ids[child.fw_id]}
+        self.lp.pause_fw(fw_ids["child"])
+
+        spool = TaskSpool(os.path.join(self.scratch_dir, "spool"), VaspCalcDb)
+        spool.put(self.get_task_doc(), fw_id=fw_ids["parent"], spec_keys=["prev_task_id"])
+        # the children are only resumed by a sync with their launchpad
+        self.assertEqual(spool.sync(self.db), {})
+        self.assertEqual(len(spool.entries()), 1)
+
+        t_id = spool.sync(self.db, launchpad=self.lp)[self.task_doc["dir_name"]]
+        fw = self.lp.get_fw_by_id(fw_ids["child"])
+        self.assertEqual(fw.spec["prev_task_id"], t_id)
+        self.assertNotEqual(fw.state, "PAUSED")
+
+    def test_band_structure(self):
+        doc = VaspDrone().assimilate(os.path.join(ref_dir, "Al"))
+        bs = BandStructureSymmLine.from_dict(doc["calcs_reversed"][0]["bandstructure"])
+        t_id = self.db.insert_task(doc, use_gridfs=True)
+        stored = self.db.get_band_structure(t_id)
+        self.assertEqual(stored.__class__.__name__, "BandStructureSymmLine")
+        self.assertTrue(np.array_equal(stored.bands[Spin.up], bs.bands[Spin.up]))
+        self.assertTrue(np.array_equal(stored.projections[Spin.up], bs.projections[Spin.up]))
+        self.assertEqual(stored.branches, bs.branches)
+        self.assertEqual(len(self.db.get_band_structure(t_id, projections=False).projections), 0)
+
+        branch = bs.branches[1]
+        stored = self.db.get_band_branch(t_id, branch["name"])
+        self.assertTrue(np.array_equal(
+            stored.bands[Spin.up], bs.bands[Spin.up][:, branch["start_index"]:branch["end_index"] + 1]))
+        self.assertEqual(len(stored.projections), 0)
+
+        edges, indices = self.db.get_band_edges(t_id, nbands=1, projections=True)
+        self.assertTrue(np.array_equal(edges.bands[Spin.up], bs.bands[Spin.up][indices]))
+        self.assertTrue(np.array_equal(edges.projections[Spin.up], bs.projections[Spin.up][indices]))
+        self.assertEqual(len(indices), 2)
+
+        t_id = self.db.insert_task(VaspDrone().assimilate(os.path.join(ref_dir, "Al")),
+                                   use_gridfs=True, bs_encoding="json")
+        stored = self.db.get_band_branch(t_id, 1)
+        self.assertTrue(np.array_equal(
+            stored.bands[Spin.up], bs.bands[Spin.up][:, branch["start_index"]:branch["end_index"] + 1]))
+
+    def test_force_constants(self):
+        doc = self.get_task_doc()
+        output = dict(doc["calcs_reversed"][0]["output"])
+        fc = np.random.rand(2, 2, 3, 3)
+        output.update({"force_constants": fc.tolist(),
+                       "normalmode_eigenvals": [1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+                       "normalmode_eigenvecs": np.eye(6).reshape(6, 2, 3).tolist()})
+        doc["calcs_reversed"][0]["output"] = output
+        t_id = self.db.insert_task(dict(doc, calcs_reversed=[dict(c) for c in doc["calcs_reversed"]]),
+                                   use_gridfs=True)
+
+        # the task doc keeps the arrays unless asked otherwise
+        calc = self.db.collection.find_one({"task_id": t_id})["calcs_reversed"][0]
+        self.assertEqual(calc["output"]["force_constants"], fc.tolist())
+        self.assertTrue(np.array_equal(self.db.get_force_constants(t_id), fc))
+
+        doc["dir_name"] = "other_dir"
+        t_id = self.db.insert_task(doc, use_gridfs=True, use_gridfs_force_constants=True)
+
+        calc = self.db.collection.find_one({"task_id": t_id})["calcs_reversed"][0]
+        self.assertNotIn("force_constants", calc["output"])
+        self.assertIn("force_constants_fs_id", calc)
+        self.assertTrue(np.array_equal(self.db.get_force_constants(t_id), fc))
+        self.assertTrue(np.array_equal(self.db.get_calc_array(calc, "force_constants"), fc))
+        eigenvals, eigenvecs = self.db.get_normalmodes(t_id)
+        self.assertEqual(eigenvals.tolist(), [1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+        self.assertEqual(eigenvecs.shape, (6, 2, 3))
+        output = self.db.retrieve_task(t_id)["calcs_reversed"][0]["output"]
+        self.assertEqual(output["force_constants"], fc.tolist())
+
+    def test_trajectory(self):
+        doc = VaspDrone().assimilate(os.path.join(ref_dir, "Si_structure_optimization", "outputs"))
+        ionic_steps = doc["calcs_reversed"][0]["output"]["ionic_steps"]
+        t_id = self.db.insert_task(doc, use_gridfs_trajectory=True)
+        stored = self.db.collection.find_one({"task_id": t_id})
+        self.assertNotIn("ionic_steps", stored["calcs_reversed"][0]["output"])
+        self.assertEqual(stored["output"]["stress"], ionic_steps[-1]["stress"])
+
+        steps = self.db.get_ionic_steps(t_id)
+        self.assertEqual(len(steps), len(ionic_steps))
+        for step, ref in zip(steps, ionic_steps):
+            self.assertAlmostEqual(step["e_fr_energy"], ref["e_fr_energy"])
+            self.assertTrue(np.allclose(step["forces"], ref["forces"]))
+            self.assertEqual(len(step["electronic_steps"]), len(ref["electronic_steps"]))
+            self.assertEqual(Structure.from_dict(step["structure"]),
+                             Structure.from_dict(ref["structure"]))
+
+        final = self.db.get_ionic_steps(t_id, steps=[-1], columns=["stress"])
+        self.assertEqual(final, [{"stress": ionic_steps[-1]["stress"]}])
+        meta, columns = self.db.get_trajectory(t_id, columns=["e_0_energy"])
+        self.assertEqual(meta["nsteps"], len(ionic_steps))
+        self.assertEqual(list(columns), ["e_0_energy"])
+        retrieved = self.db.retrieve_task(t_id)["calcs_reversed"][0]["output"]["ionic_steps"]
+        self.assertEqual(len(retrieved), len(ionic_steps))
+
+    def test_profile(self):
+        doc = self.get_task_doc()
+        doc["task_label"] = "static"
+        doc["_profile"] = {"stages": {"vasprun": {"wall_time": 1.0, "count": 1, "peak_rss_mb": 100,
+                                                  "peak_rss_growth_mb": 10}}}
+        t_id = self.db.insert_task(doc, use_gridfs=True)
+        stages = self.db.collection.find_one({"task_id": t_id})["_profile"]["stages"]
+        self.assertEqual(set(stages), {"vasprun", "insert", "gridfs"})
+
+        self.db.insert_task(doc, use_gridfs=True)
+        stats = self.db.db[VaspCalcDb.profile_collection].find_one({"task_type": "static",
+                                                                    "stage": "vasprun"})
+        self.assertEqual(stats["count"], 2)
+        self.assertAlmostEqual(stats["total_time"], 2.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,8 +2,10 @@
 # Copyright (c) Materials Virtual Lab.
 # Distributed under the terms of the BSD License.
 
+import multiprocessing
 import os
 import unittest
+from unittest.mock import patch
 
 from pymatgen.io.vasp import Outcar, Oszicar
 
@@ -155,6 +157,57 @@ class VaspToDbTaskDroneTest(unittest.TestCase):
         cc = doc['calcs_reversed'][0]['aeccar2']
         self.assertAlmostEqual(cc.data['total'].sum()/cc.ngridpts, 8.01314480789829, 4)
 
+    def test_parse_once(self):
+        drone = VaspDrone()
+        doc = drone.assimilate(self.Al)
+        self.assertEqual(doc["calcs_reversed"][0]["parse_counts"], {"vasprun": 1, "outcar": 1})
+
+        doc = drone.assimilate(self.relax2)
+        for calc in doc["calcs_reversed"]:
+            self.assertEqual(calc["parse_counts"], {"vasprun": 1, "outcar": 1})
+
+    def test_parallel(self):
+        drone = VaspDrone(runs=["relax1", "relax2"])
+        doc = drone.assimilate(self.relax2)
+        drone = VaspDrone(runs=["relax1", "relax2"], parallel=True)
+        doc_parallel = drone.assimilate(self.relax2)
+        self.assertEqual(len(doc_parallel["calcs_reversed"]), 2)
+        for calc, calc_parallel in zip(doc["calcs_reversed"], doc_parallel["calcs_reversed"]):
+            self.assertEqual(calc["task"], calc_parallel["task"])
+            self.assertEqual(calc["output"]["energy"], calc_parallel["output"]["energy"])
+            self.assertEqual(calc["output"]["outcar"], calc_parallel["output"]["outcar"])
+            self.assertEqual(calc_parallel["parse_counts"], {"vasprun": 1, "outcar": 1})
+        self.assertEqual(doc["run_stats"], doc_parallel["run_stats"])
+
+        # unknown number of cpus
+        with patch("os.cpu_count", return_value=None):
+            self.assertEqual(drone.assimilate(self.relax2)["run_stats"], doc["run_stats"])
+
+        # the files are parsed one after the other in a pool worker
+        with multiprocessing.Pool(1) as pool:
+            doc_worker = pool.apply(drone.assimilate, (self.relax2,))
+        self.assertEqual(doc["run_stats"], doc_worker["run_stats"])
+
+    def test_outcar_tail(self):
+        drone = VaspDrone(runs=["relax1", "relax2"], outcar_mode="tail")
+        doc = drone.assimilate(self.relax2)
+        self.assertEqual(doc["run_stats"], VaspDrone(runs=["relax1", "relax2"]).assimilate(
+            self.relax2)["run_stats"])
+        outcar = doc["calcs_reversed"][0]["output"]["outcar"]
+        self.assertEqual(len(outcar["drift"]), 1)
+        self.assertEqual(len(outcar["magnetization"]), 2)
+
+    def test_profile(self):
+        self.assertNotIn("_profile", VaspDrone().assimilate(self.Si_static))
+        drone = VaspDrone(runs=["relax1", "relax2"], profile=True, parallel=True)
+        profile = drone.assimilate(self.relax2)["_profile"]
+        stages = profile["stages"]
+        for stage in ["vasprun", "outcar", "bandstructure", "symmetry", "post_process"]:
+            self.assertIn(stage, stages)
+        self.assertEqual(stages["vasprun"]["count"], 2)
+        self.assertNotIn("bader", stages)
+        self.assertGreater(profile["wall_time"], 0)
+
 
 if __name__ == "__main__":
     unittest.main()
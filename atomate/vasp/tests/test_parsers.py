@@ -0,0 +1,104 @@
+# coding: utf-8
+
+import gzip
+import os
+import tempfile
+import unittest
+
+from monty.io import zopen
+
+from pymatgen.io.vasp import Vasprun, Outcar
+
+from atomate.vasp.parsers import StreamingVasprun, SubtreeFilter, read_vasprun_incar, \
+    read_outcar_tail, reverse_read_last_step
+
+__author__ = 'Kiran Mathew'
+__email__ = 'kmathew@lbl.gov'
+
+module_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestParsers(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.Al = os.path.join(module_dir, "..", "test_files", "Al", "vasprun.xml.gz")
+        cls.Si_static = os.path.join(module_dir, "..", "test_files", "Si_static", "outputs",
+                                     "vasprun.xml.gz")
+
+    def test_read_vasprun_incar(self):
+        incar = read_vasprun_incar(self.Al)
+        self.assertEqual(incar["ICHARG"], 11)
+        self.assertEqual(incar["NSW"], 0)
+        incar = read_vasprun_incar(self.Si_static)
+        self.assertEqual(incar["ICHARG"], 0)
+
+    def test_subtree_filter(self):
+        with zopen(self.Si_static, "rt") as f:
+            stream = SubtreeFilter(f, {"dos", "projected"})
+            text = stream.read()
+        self.assertNotIn("<dos>", text)
+        self.assertNotIn("<projected>", text)
+        self.assertNotIn("<partial>", text)
+        self.assertIn("<eigenvalues>", text)
+        self.assertAlmostEqual(stream.efermi, 5.63347331)
+
+    def test_streaming_vasprun(self):
+        vrun = Vasprun(self.Si_static, parse_projected_eigen=True)
+        svrun = StreamingVasprun(self.Si_static, parse_dos=False)
+        self.assertEqual(svrun.efermi, vrun.efermi)
+        self.assertIsNone(svrun.projected_eigenvalues)
+        self.assertFalse(hasattr(svrun, "tdos"))
+        self.assertEqual(svrun.final_energy, vrun.final_energy)
+        self.assertEqual(len(svrun.ionic_steps), len(vrun.ionic_steps))
+
+        d = vrun.as_dict()
+        sd = svrun.as_dict()
+        self.assertNotIn("eigenvalues", sd["output"])
+        for k in ["bandgap", "cbm", "vbm", "is_gap_direct", "efermi", "final_energy"]:
+            self.assertEqual(sd["output"][k], d["output"][k])
+        self.assertEqual(set(sd["output"].keys()),
+                         set(d["output"].keys()) - {"eigenvalues", "projected_eigenvalues"})
+
+        svrun = StreamingVasprun(self.Si_static, parse_projected_eigen=True, skip_tags=("scstep",))
+        self.assertIsNotNone(svrun.projected_eigenvalues)
+        self.assertEqual(svrun.ionic_steps[-1]["electronic_steps"], [])
+        self.assertEqual(svrun.get_band_structure().get_band_gap(),
+                         vrun.get_band_structure().get_band_gap())
+
+    def test_read_outcar_tail(self):
+        for outcar_file in [self.Si_static.replace("vasprun.xml", "OUTCAR"),
+                            os.path.join(module_dir, "..", "test_files", "Al", "OUTCAR.gz")]:
+            d = Outcar(outcar_file).as_dict()
+            td = read_outcar_tail(outcar_file)
+            for k in ["efermi", "run_stats", "magnetization", "charge", "total_magnetization",
+                      "nelect", "is_stopped"]:
+                self.assertEqual(td[k], d[k])
+            self.assertEqual(td["drift"], d["drift"][-1:])
+
+        # LEPSILON runs are parsed in full
+        outcar_file = os.path.join(module_dir, "..", "test_files", "raman_wf", "3", "outputs",
+                                   "OUTCAR.gz")
+        self.assertEqual(read_outcar_tail(outcar_file), Outcar(outcar_file).as_dict())
+
+    def test_read_outcar_tail_gzip(self):
+        outcar_file = os.path.join(module_dir, "..", "test_files", "Al", "OUTCAR.gz")
+        with zopen(outcar_file, "rt") as f:
+            lines = f.readlines()
+        last = max(i for i, l in enumerate(lines) if "Iteration" in l and l.strip().startswith("-"))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # an OUTCAR of many ionic steps, only the last of which is kept
+            large_file = os.path.join(tmp_dir, "OUTCAR.gz")
+            with gzip.open(large_file, "wt") as f:
+                f.writelines(lines[:last])
+                for _ in range(20):
+                    f.writelines(lines[:last][-2000:])
+                f.writelines(lines[last:])
+            tail = list(reverse_read_last_step(large_file))
+            self.assertEqual(len(tail), len(lines) - last)
+            self.assertEqual(tail[0], lines[-1].rstrip("\n"))
+            self.assertEqual(read_outcar_tail(large_file), read_outcar_tail(outcar_file))
+
+
+if __name__ == "__main__":
+    unittest.main()